@@ -4,10 +4,17 @@ import datetime
 import json
 import os
 import asyncio
+import contextlib
+import functools
+import heapq
+import threading
 import qrcode
 from io import BytesIO
-from collections import defaultdict
-from services.panel_api import safe_api_request as api_safe_request, get_panel_user as api_get_panel_user, get_user_by_telegram_id as api_get_user_by_telegram_id, get_user_by_username as api_get_user_by_username, get_user_by_short_uuid as api_get_user_by_short_uuid, get_nodes_status as api_get_nodes_status, get_subscription_history_stats as api_get_subscription_history_stats, get_user_subscription_history as api_get_user_subscription_history, get_subscription_settings as api_get_subscription_settings, patch_subscription_settings as api_patch_subscription_settings, get_internal_squads as api_get_internal_squads, get_internal_squad_accessible_nodes as api_get_internal_squad_accessible_nodes, get_bandwidth_nodes_realtime as api_get_bandwidth_nodes_realtime, bulk_move_users_to_squad as api_bulk_move_users_to_squad, create_user as api_create_user, patch_user as api_patch_user, delete_user as api_delete_user, enable_user as api_enable_user, disable_user as api_disable_user, reset_user_traffic as api_reset_user_traffic, get_subscription_request_history as api_get_subscription_request_history, bulk_delete_users as api_bulk_delete_users, bulk_update_users as api_bulk_update_users, probe_api_capabilities as api_probe_api_capabilities, set_user_metadata as api_set_user_metadata, block_ip_address as api_block_ip_address, get_system_health as api_get_system_health, get_system_stats as api_get_system_stats, get_system_stats_recap as api_get_system_stats_recap, get_snippet_by_key as api_get_snippet_by_key, get_subscription_page_configs as api_get_subscription_page_configs, get_external_squads as api_get_external_squads, get_config_profiles as api_get_config_profiles, get_user_accessible_nodes as api_get_user_accessible_nodes, close_all_clients, extract_payload
+from collections import Counter, OrderedDict
+from collections.abc import Mapping
+from operator import itemgetter
+from types import MappingProxyType
+from services.panel_api import safe_api_request as api_safe_request, get_panel_user as api_get_panel_user, get_all_panel_users as api_get_all_panel_users, get_user_by_telegram_id as api_get_user_by_telegram_id, get_user_by_username as api_get_user_by_username, get_user_by_short_uuid as api_get_user_by_short_uuid, get_nodes_status as api_get_nodes_status, get_subscription_history_stats as api_get_subscription_history_stats, get_user_subscription_history as api_get_user_subscription_history, get_subscription_settings as api_get_subscription_settings, patch_subscription_settings as api_patch_subscription_settings, get_internal_squads as api_get_internal_squads, get_internal_squad_accessible_nodes as api_get_internal_squad_accessible_nodes, get_bandwidth_nodes_realtime as api_get_bandwidth_nodes_realtime, bulk_move_users_to_squad as api_bulk_move_users_to_squad, create_user as api_create_user, patch_user as api_patch_user, delete_user as api_delete_user, enable_user as api_enable_user, disable_user as api_disable_user, reset_user_traffic as api_reset_user_traffic, get_subscription_request_history as api_get_subscription_request_history, bulk_delete_users as api_bulk_delete_users, bulk_update_users as api_bulk_update_users, probe_api_capabilities as api_probe_api_capabilities, set_user_metadata as api_set_user_metadata, block_ip_address as api_block_ip_address, get_system_health as api_get_system_health, get_system_stats as api_get_system_stats, get_system_stats_recap as api_get_system_stats_recap, get_snippet_by_key as api_get_snippet_by_key, get_subscription_page_configs as api_get_subscription_page_configs, get_external_squads as api_get_external_squads, get_config_profiles as api_get_config_profiles, get_user_accessible_nodes as api_get_user_accessible_nodes, close_all_clients, extract_payload
 from services.orders import (
     create_order,
     get_order,
@@ -23,16 +30,31 @@ from services.orders import (
     STATUS_DELIVERED,
     STATUS_FAILED,
 )
-from storage.db import init_db as storage_init_db, db_query as storage_db_query, db_execute as storage_db_execute
-from utils.formatting import escape_markdown_v2
+from storage.db import init_db as storage_init_db, db_query as storage_db_query, db_execute as storage_db_execute, db_execute_batch as storage_db_execute_batch, close_connections as storage_close_connections
+from utils.formatting import escape_markdown_v2, format_minute
 from handlers.bulk_actions import parse_uuids, parse_expire_days_and_uuids, parse_traffic_and_uuids, run_bulk_action
-from handlers.admin import format_order_detail, format_order_row, order_status_label
+from handlers.admin import format_order_detail, format_order_row, order_status_label, parse_orders_page_callback
 from handlers.client import build_nodes_status_message
-from jobs.anomaly import build_anomaly_incidents
-from jobs.expiry import should_send_expire_notice
+from handlers.dispatch import NOT_COMMAND, MessageState, build_prefix_table, resolve_callback_handler, resolve_message_state
+from jobs.anomaly import build_anomaly_incidents, extract_log_ts
+from jobs.expiry import parse_expire_datetime, should_send_expire_notice
 from utils.constants import APP_VERSION, USER_STATUS_ACTIVE, USER_STATUS_LIMITED, USER_STATUS_DISABLED
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+from telegram.error import BadRequest
+from telegram.ext import AIORateLimiter, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps(value, indent=False):
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(value, option=option).decode()
+except ImportError:  # orjson 为可选加速依赖
+    _json_loads = json.loads
+
+    def _json_dumps(value, indent=False):
+        return json.dumps(value, ensure_ascii=False, indent=2 if indent else None)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.getenv("REMNASHOP_CONFIG", os.path.join(BASE_DIR, 'config.json'))
@@ -41,19 +63,24 @@ DB_FILE = os.getenv("REMNASHOP_DB", os.path.join(BASE_DIR, 'starlight.db'))
 ANOMALY_IP_THRESHOLD = 50
 
 
+_TRUE_VALUES = frozenset({"1", "true", "yes", "on"})
+# 设置项额外接受中文开关写法
+_SETTING_TRUE_VALUES = _TRUE_VALUES | {"开启", "开"}
+
+
 def parse_bool(value, default=True):
     if value is None:
         return default
     if isinstance(value, bool):
         return value
-    return str(value).strip().lower() in {"1", "true", "yes", "on"}
+    return str(value).strip().lower() in _TRUE_VALUES
 
 def load_config():
     if not os.path.exists(CONFIG_FILE):
         print(f"配置文件缺失: {CONFIG_FILE}")
         exit(1)
-    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    with open(CONFIG_FILE, 'rb') as f:
+        return _json_loads(f.read())
 
 config = load_config()
 
@@ -70,14 +97,84 @@ logging.getLogger("apscheduler").setLevel(logging.WARNING)
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-user_cooldowns = {}
+user_cooldowns: OrderedDict[int, float] = OrderedDict()
 COOLDOWN_SECONDS = 1.0
+MAX_COOLDOWN_ENTRIES = 16384
 uuid_map = {}
-order_payment_method_cache = {}
+uuid_short_ids = {}
+_short_id_counter = 0
+order_payment_method_cache: OrderedDict[str, str] = OrderedDict()
+MAX_ORDER_PAYMENT_CACHE_ENTRIES = 4096
 panel_capabilities_cache = {}
 panel_capabilities_runtime_success = {}
 dynamic_snippets_cache = {}
 SUPPORT_REPLY_TTL_SECONDS = 1800
+SUB_TRAFFIC_CACHE_TTL_SECONDS = 300
+EXPIRY_BULK_FETCH_MIN_SUBS = 20
+# 订单审核与到期巡检共用的面板/消息并发上限
+PANEL_WORK_SEMAPHORE = asyncio.Semaphore(20)
+# 单次菜单渲染内批量查询面板用户时的并发上限
+PANEL_USER_FANOUT_LIMIT = 16
+BROADCAST_CONCURRENCY = 25
+_settings_cache: dict[str, tuple[float, str | None]] = {}
+SETTINGS_CACHE_TTL_SECONDS = 60
+MAX_SETTINGS_CACHE_ENTRIES = 256
+# 时间线/快照等 JSON 列表设置解析一次后常驻内存，追加时只做序列化写回
+_json_list_cache: dict[str, list] = {}
+# 追加/弹出会在工作线程里执行，读取-修改-写回须整体串行，否则并发写入会互相覆盖
+_json_list_lock = threading.Lock()
+_history_stats_cache: tuple[float, dict] = (0.0, {})
+HISTORY_STATS_CACHE_TTL_SECONDS = 30
+# 分组菜单的组列表与容量摘要合并缓存，并发点击只回源一次
+_squads_overview_cache: tuple[float, tuple | None] = (0.0, None)
+_squads_overview_lock = asyncio.Lock()
+# 迁移完成时递增，迁移期间发起的汇总查询不写回缓存
+_squads_overview_generation = 0
+SQUADS_OVERVIEW_CACHE_TTL_SECONDS = 15
+_anomaly_whitelist: frozenset[str] | None = None
+# 无待支付订单的用户短时间内不再查库；只缓存“没有”，有订单时每次都读最新状态
+_no_pending_order_until: dict[int, float] = {}
+_pending_order_invalidations = 0
+NO_PENDING_ORDER_CACHE_TTL_SECONDS = 10
+MAX_NO_PENDING_ORDER_ENTRIES = 4096
+
+_SUB_CAPTION_TMPL = (
+    "📃 **订阅详情**\n\n"
+    "📊 流量：`{progress}`\n"
+    "🔋 剩余：`{remain} GB` / `{limit} GB ({strategy})`\n"
+    "⏳ 到期：`{expire}`\n"
+    "🔗 订阅链接：\n`{url}`"
+)
+_ORDER_CONFIRM_TMPL = (
+    "📝 **订单已创建**\n"
+    "🆔 订单号：`{order_id}`\n"
+    "📦 套餐：{plan_name}\n"
+    "💰 金额：**{price}**\n"
+    "📡 流量：**{gb} GB ({strategy})**\n"
+    "🧩 类型：**{type_str}**\n"
+    "🧾 路径：**{path_label}**\n\n"
+    "🆔 系统将自动使用当前 Telegram ID：`{user_id}`\n"
+    "{extra_tip}"
+)
+_PANEL_CONFIG_TMPL = (
+    "🔌 **面板对接配置**\n"
+    "面板地址: `{url}`\n"
+    "面板Token: `{token}`\n"
+    "订阅域名: `{sub_domain}`\n"
+    "默认组UUID: `{group}`\n"
+    "TLS校验: `{verify_tls}`\n"
+    "\n"
+    "首次安装只需机器人信息，面板参数可在这里随时修改。"
+)
+_BULK_MENU_TEXT = (
+    "📚 **批量用户操作**\n\n"
+    "请选择操作类型：\n"
+    "- 批量重置流量\n"
+    "- 批量禁用\n"
+    "- 批量删除\n"
+    "- 批量改到期日\n"
+    "- 批量改流量包"
+)
 
 
 def _get_support_session_store(application):
@@ -88,6 +185,28 @@ def _get_support_session_store(application):
     return store
 
 
+@contextlib.asynccontextmanager
+async def _user_order_lock(application, user_id: int):
+    # 值为 [锁, 持有+等待数]；计数归零即移除，避免每个下过单的用户都常驻一把锁
+    locks = application.bot_data.get('user_order_locks')
+    if not isinstance(locks, dict):
+        locks = {}
+        application.bot_data['user_order_locks'] = locks
+    key = int(user_id)
+    entry = locks.get(key)
+    if entry is None:
+        entry = [asyncio.Lock(), 0]
+        locks[key] = entry
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and locks.get(key) is entry:
+            del locks[key]
+
+
 def set_support_reply_session(context: ContextTypes.DEFAULT_TYPE, user_id: int, source: str, admin_id: int | None = None):
     store = _get_support_session_store(context.application)
     now_ts = int(time.time())
@@ -158,27 +277,60 @@ async def cleanup_admin_reply_prompt(context: ContextTypes.DEFAULT_TYPE, admin_i
         ok = await delete_message_if_possible(context, admin_id, prompt_id)
         logger.info("cleanup admin reply prompt: admin=%s prompt=%s reason=%s deleted=%s", admin_id, prompt_id, reason, ok)
 
+_BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _to_base36(n):
+    out = ""
+    while True:
+        n, rem = divmod(n, 36)
+        out = _BASE36_DIGITS[rem] + out
+        if n == 0:
+            return out
+
+
 def get_short_id(real_uuid):
-    for sid, uid in uuid_map.items():
-        if uid == real_uuid: return sid
-    short_id = str(len(uuid_map) + 1)
+    global _short_id_counter
+    short_id = uuid_short_ids.get(real_uuid)
+    if short_id: return short_id
+    _short_id_counter += 1
+    short_id = _to_base36(_short_id_counter)
     uuid_map[short_id] = real_uuid
+    uuid_short_ids[real_uuid] = short_id
     return short_id
 
 def get_real_uuid(short_id):
     return uuid_map.get(short_id)
 
+def forget_short_id(real_uuid):
+    short_id = uuid_short_ids.pop(real_uuid, None)
+    if short_id is not None:
+        uuid_map.pop(short_id, None)
+
+def remember_order_payment_method(order_id, path):
+    # 未提交凭证就放弃的订单不会被主动清理，按插入顺序淘汰最旧的记录
+    order_payment_method_cache[order_id] = path
+    order_payment_method_cache.move_to_end(order_id)
+    if len(order_payment_method_cache) > MAX_ORDER_PAYMENT_CACHE_ENTRIES:
+        order_payment_method_cache.popitem(last=False)
+
+
 def check_cooldown(user_id):
     if user_id == ADMIN_ID: return True
     now = time.time()
-    last_time = user_cooldowns.get(user_id, 0)
+    last_time = user_cooldowns.get(user_id, 0.0)
     if now - last_time < COOLDOWN_SECONDS: return False
     user_cooldowns[user_id] = now
+    user_cooldowns.move_to_end(user_id)
+    if len(user_cooldowns) > MAX_COOLDOWN_ENTRIES:
+        user_cooldowns.popitem(last=False)
     return True
 
+_STRATEGY_LABELS = {'NO_RESET': '总流量', 'DAY': '每日重置', 'WEEK': '每周重置', 'MONTH': '每月重置', 'MONTH_ROLLING': '按开通日每月重置'}
+
+
 def get_strategy_label(strategy):
-    mapping = {'NO_RESET': '总流量', 'DAY': '每日重置', 'WEEK': '每周重置', 'MONTH': '每月重置', 'MONTH_ROLLING': '按开通日每月重置'}
-    return mapping.get(strategy, '总流量')
+    return _STRATEGY_LABELS.get(strategy, '总流量')
 
 def draw_progress_bar(used, total, length=10):
     if total == 0: return "♾️ 无限制"
@@ -188,25 +340,72 @@ def draw_progress_bar(used, total, length=10):
     bar = "█" * filled_length + "░" * (length - filled_length)
     return f"{bar} {round(percent * 100)}%"
 
+@functools.lru_cache(maxsize=4096)
 def format_time(iso_str):
     if not iso_str: return "未知"
     try:
-        clean_str = iso_str.split('.')[0].replace('Z', '')
-        dt = datetime.datetime.strptime(clean_str, "%Y-%m-%dT%H:%M:%S")
-        return dt.strftime("%Y-%m-%d %H:%M")
+        return datetime.datetime.fromisoformat(iso_str).strftime("%Y-%m-%d %H:%M")
     except Exception as exc:
         logger.debug("failed to parse time %s: %s", iso_str, exc)
         return iso_str
 
-def generate_qr(text):
+_today_start: tuple[datetime.date | None, int] = (None, 0)
+
+
+def get_today_start_ts():
+    # 按 UTC 日期缓存当日零点时间戳，跨日后才重新计算
+    global _today_start
+    today = datetime.datetime.utcnow().date()
+    if _today_start[0] != today:
+        _today_start = (today, int(datetime.datetime.combine(today, datetime.time.min).timestamp()))
+    return _today_start[1]
+
+
+def format_iso_z(dt):
+    return f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}Z"
+
+@functools.lru_cache(maxsize=256)
+def _render_qr_png(text):
     qr = qrcode.QRCode(version=1, box_size=10, border=2)
     qr.add_data(text)
     qr.make(fit=True)
     img = qr.make_image(fill_color="black", back_color="white")
     bio = BytesIO()
     img.save(bio)
-    bio.seek(0)
-    return bio
+    return bio.getvalue()
+
+
+def generate_qr(text):
+    return BytesIO(_render_qr_png(text))
+
+
+MAX_QR_FILE_IDS = 500
+_qr_file_ids: dict[str, str] | None = None
+
+
+async def send_sub_qr_photo(bot, chat_id, sub_url, **kwargs):
+    # 同一订阅链接只上传一次二维码，之后复用 Telegram 返回的 file_id
+    global _qr_file_ids
+    if _qr_file_ids is None:
+        loaded = await asyncio.to_thread(get_json_setting, 'qr_file_ids', {})
+        # 等待期间可能已有并发调用完成加载，避免覆盖其新写入的条目
+        if _qr_file_ids is None:
+            _qr_file_ids = loaded if isinstance(loaded, dict) else {}
+    file_id = _qr_file_ids.get(sub_url)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as exc:
+            logger.info("cached qr file_id rejected, re-uploading: %s", exc)
+            _qr_file_ids.pop(sub_url, None)
+    qr_bio = await asyncio.to_thread(generate_qr, sub_url)
+    sent = await bot.send_photo(chat_id=chat_id, photo=qr_bio, **kwargs)
+    if sent and sent.photo:
+        _qr_file_ids[sub_url] = sent.photo[-1].file_id
+        while len(_qr_file_ids) > MAX_QR_FILE_IDS:
+            _qr_file_ids.pop(next(iter(_qr_file_ids)))
+        await asyncio.to_thread(set_json_setting, 'qr_file_ids', _qr_file_ids)
+    return sent
 
 def init_db():
     storage_init_db(DB_FILE)
@@ -220,6 +419,44 @@ def db_execute(query, args=()):
     return storage_db_execute(DB_FILE, query, args=args)
 
 
+def db_execute_batch(statements):
+    return storage_db_execute_batch(DB_FILE, statements)
+
+
+@functools.lru_cache(maxsize=1)
+def get_plan_rows():
+    # 缓存时一次性转成 dict，菜单渲染时无需逐行再转换；调用方只读不改
+    return tuple(dict(r) for r in db_query("SELECT * FROM plans"))
+
+
+@functools.lru_cache(maxsize=1)
+def _plan_index():
+    return {p['key']: p for p in get_plan_rows()}
+
+
+def get_plan_row(plan_key):
+    # 与套餐菜单共用同一份缓存，按 key 查找不再单独查库
+    return _plan_index().get(plan_key)
+
+
+def invalidate_plan_cache():
+    # 套餐只在本进程内增删，写入后清空缓存即可保持一致
+    get_plan_rows.cache_clear()
+    _plan_index.cache_clear()
+
+
+async def adb_query(query, args=(), one=False):
+    return await asyncio.to_thread(db_query, query, args, one)
+
+
+async def adb_execute(query, args=()):
+    return await asyncio.to_thread(db_execute, query, args)
+
+
+async def adb_execute_batch(statements):
+    return await asyncio.to_thread(db_execute_batch, statements)
+
+
 def ensure_local_subscription_sync(tg_id, panel_user):
     if not isinstance(panel_user, dict):
         return None
@@ -238,16 +475,97 @@ def ensure_local_subscription_sync(tg_id, panel_user):
 
 
 def get_setting_value(key, default=None):
-    row = db_query("SELECT value FROM settings WHERE key=?", (key,), one=True)
-    return row['value'] if row else default
+    now = time.monotonic()
+    cached = _settings_cache.get(key)
+    if cached is not None and cached[0] > now:
+        value = cached[1]
+    else:
+        row = db_query("SELECT value FROM settings WHERE key=?", (key,), one=True)
+        value = row['value'] if row else None
+        if len(_settings_cache) >= MAX_SETTINGS_CACHE_ENTRIES:
+            _settings_cache.clear()
+        _settings_cache[key] = (now + SETTINGS_CACHE_TTL_SECONDS, value)
+    return value if value is not None else default
+
+
+def get_setting_values(defaults):
+    # 一次取多个设置：缓存命中的直接返回，未命中的合并成一条 IN 查询
+    now = time.monotonic()
+    values, missing = {}, []
+    for key in defaults:
+        cached = _settings_cache.get(key)
+        if cached is not None and cached[0] > now:
+            values[key] = cached[1]
+        else:
+            missing.append(key)
+    if missing:
+        placeholders = ",".join("?" * len(missing))
+        fetched = {row['key']: row['value'] for row in db_query(f"SELECT key, value FROM settings WHERE key IN ({placeholders})", tuple(missing))}
+        if len(_settings_cache) + len(missing) > MAX_SETTINGS_CACHE_ENTRIES:
+            _settings_cache.clear()
+        for key in missing:
+            values[key] = fetched.get(key)
+            _settings_cache[key] = (now + SETTINGS_CACHE_TTL_SECONDS, values[key])
+    return {key: (values[key] if values[key] is not None else default) for key, default in defaults.items()}
+
+
+async def aget_setting_values(defaults):
+    # 全部命中缓存时直接返回，否则把那条 IN 查询放到线程里执行
+    now = time.monotonic()
+    if all((cached := _settings_cache.get(key)) is not None and cached[0] > now for key in defaults):
+        return get_setting_values(defaults)
+    return await asyncio.to_thread(get_setting_values, defaults)
 
 
 def set_setting_value(key, value):
+    _json_list_cache.pop(key, None)
     db_execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
+    _settings_cache[key] = (time.monotonic() + SETTINGS_CACHE_TTL_SECONDS, str(value))
+
+
+async def aset_setting_value(key, value):
+    _json_list_cache.pop(key, None)
+    await adb_execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
+    _settings_cache[key] = (time.monotonic() + SETTINGS_CACHE_TTL_SECONDS, str(value))
+
+
+def _settings_write_batch(values):
+    items = [(key, str(value)) for key, value in values.items()]
+    for key, _ in items:
+        _json_list_cache.pop(key, None)
+    return items, [("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", items)]
+
+
+def _settings_cache_store(items):
+    expires_at = time.monotonic() + SETTINGS_CACHE_TTL_SECONDS
+    for key, value in items:
+        _settings_cache[key] = (expires_at, value)
+
+
+def set_setting_values(values):
+    # 多个设置在同一事务内写入，只提交一次
+    items, statements = _settings_write_batch(values)
+    if items:
+        db_execute_batch(statements)
+        _settings_cache_store(items)
+
+
+async def aset_setting_values(values):
+    items, statements = _settings_write_batch(values)
+    if items:
+        await adb_execute_batch(statements)
+        _settings_cache_store(items)
+
+
+def preload_settings():
+    # 启动时一次性载入全部设置，后续读取直接命中缓存
+    expires_at = time.monotonic() + SETTINGS_CACHE_TTL_SECONDS
+    for row in db_query("SELECT key, value FROM settings LIMIT ?", (MAX_SETTINGS_CACHE_ENTRIES,)):
+        _settings_cache[row['key']] = (expires_at, row['value'])
 
 def get_setting_bool(key, default=True):
     raw = str(get_setting_value(key, "1" if default else "0")).strip().lower()
-    return raw in {"1", "true", "yes", "on", "开启", "开"}
+    return raw in _SETTING_TRUE_VALUES
 
 
 def mark_panel_capability_success(name: str):
@@ -260,7 +578,7 @@ def capability_enabled(name: str, default=False):
         return True
     explicit = get_setting_value(f"panel_capability_{key}", "")
     if explicit != "":
-        return str(explicit).strip().lower() in {"1", "true", "yes", "on", "开启", "开"}
+        return str(explicit).strip().lower() in _SETTING_TRUE_VALUES
     return bool(panel_capabilities_cache.get(key, default))
 
 def get_plan_price(plan_dict, payment_method='manual_review'):
@@ -298,60 +616,93 @@ def get_json_setting(key, default):
     if not raw:
         return default
     try:
-        return json.loads(raw)
+        return _json_loads(raw)
     except Exception:
         return default
 
 
 def set_json_setting(key, value):
-    set_setting_value(key, json.dumps(value, ensure_ascii=False))
+    set_setting_value(key, _json_dumps(value))
+
+
+def get_cached_json_list(key):
+    rows = _json_list_cache.get(key)
+    if rows is None:
+        rows = get_json_setting(key, [])
+        if not isinstance(rows, list):
+            rows = []
+        _json_list_cache[key] = rows
+    return rows
+
+
+def store_cached_json_list(key, rows):
+    set_json_setting(key, rows)
+    _json_list_cache[key] = rows
 
 
 def append_ops_timeline(event_type, title, detail, actor='系统', target='-'):
-    rows = get_json_setting('ops_timeline', [])
-    if not isinstance(rows, list):
-        rows = []
-    rows.append({
-        'ts': int(time.time()),
-        'type': event_type,
-        'title': title,
-        'detail': detail[:240],
-        'actor': str(actor),
-        'target': str(target),
-    })
-    set_json_setting('ops_timeline', rows[-120:])
+    with _json_list_lock:
+        rows = get_cached_json_list('ops_timeline')
+        rows.append({
+            'ts': int(time.time()),
+            'type': event_type,
+            'title': title,
+            'detail': detail[:240],
+            'actor': str(actor),
+            'target': str(target),
+        })
+        del rows[:-120]
+        store_cached_json_list('ops_timeline', rows)
 
 
 def push_subscription_settings_snapshot(payload, source='手动变更前快照'):
-    hist = get_json_setting('subscription_settings_history', [])
-    if not isinstance(hist, list):
-        hist = []
-    hist.append({
-        'ts': int(time.time()),
-        'source': source,
-        'payload': payload,
-    })
-    set_json_setting('subscription_settings_history', hist[-10:])
+    with _json_list_lock:
+        hist = get_cached_json_list('subscription_settings_history')
+        hist.append({
+            'ts': int(time.time()),
+            'source': source,
+            'payload': payload,
+        })
+        del hist[:-10]
+        store_cached_json_list('subscription_settings_history', hist)
 
 
 def pop_subscription_settings_snapshot():
-    hist = get_json_setting('subscription_settings_history', [])
-    if not isinstance(hist, list) or not hist:
-        return None
-    item = hist.pop()
-    set_json_setting('subscription_settings_history', hist)
+    with _json_list_lock:
+        hist = get_cached_json_list('subscription_settings_history')
+        if not hist:
+            return None
+        item = hist.pop()
+        store_cached_json_list('subscription_settings_history', hist)
     return item
 
 
-def get_risk_watchlist():
-    items = get_json_setting('risk_watchlist', [])
+@functools.lru_cache(maxsize=4)
+def _parse_risk_watchlist(raw):
+    # 以设置原文为键缓存解析结果；原文变化即自然失效，无需额外 TTL
+    try:
+        items = _json_loads(raw) if raw else []
+    except Exception:
+        items = []
     if not isinstance(items, list):
-        return set()
-    return {str(x) for x in items if x}
+        return ()
+    return tuple(sorted({str(x) for x in items if x}))
+
+
+def get_risk_watchlist_sorted():
+    return _parse_risk_watchlist(get_setting_value('risk_watchlist'))
+
+
+def get_risk_watchlist():
+    return set(get_risk_watchlist_sorted())
+
+
+def dump_risk_watchlist(items):
+    return _json_dumps(sorted({str(x) for x in items if x}))
 
 
 def set_risk_watchlist(items):
-    set_json_setting('risk_watchlist', sorted({str(x) for x in items if x}))
+    set_setting_value('risk_watchlist', dump_risk_watchlist(items))
 
 
 def enqueue_bulk_job(action, uuids, extra, created_by):
@@ -359,7 +710,7 @@ def enqueue_bulk_job(action, uuids, extra, created_by):
     payload = {'uuids': uuids, 'extra': extra or {}}
     db_execute(
         "INSERT INTO bulk_jobs (action, payload_json, status, created_by, created_at, updated_at) VALUES (?, ?, 'pending', ?, ?, ?)",
-        (action, json.dumps(payload, ensure_ascii=False), int(created_by or 0), now, now),
+        (action, _json_dumps(payload), int(created_by or 0), now, now),
     )
 
 
@@ -367,7 +718,7 @@ def save_ops_template(name, payload, created_by):
     now = int(time.time())
     db_execute(
         "INSERT INTO ops_templates (name, payload_json, created_by, created_at) VALUES (?, ?, ?, ?)",
-        (str(name)[:60], json.dumps(payload, ensure_ascii=False), int(created_by or 0), now),
+        (str(name)[:60], _json_dumps(payload), int(created_by or 0), now),
     )
 
 
@@ -381,9 +732,8 @@ def get_builtin_templates():
 
 def apply_template_payload(payload, actor='系统'):
     settings = payload.get('settings', {}) if isinstance(payload, dict) else {}
-    for k, v in settings.items():
-        set_setting_value(k, v)
-    append_ops_timeline('模板', '应用运营模板', json.dumps(settings, ensure_ascii=False)[:180], actor=actor)
+    set_setting_values(settings)
+    append_ops_timeline('模板', '应用运营模板', _json_dumps(settings)[:180], actor=actor)
 
 
 async def sync_user_metadata(user_uuid, tg_id, plan_key="", order_id="", risk_level=""):
@@ -409,7 +759,7 @@ def panel_config_ready():
 
 
 def save_runtime_config(**kwargs):
-    global PANEL_URL, PANEL_TOKEN, SUB_DOMAIN, TARGET_GROUP_UUID, PANEL_VERIFY_TLS, config
+    global PANEL_URL, SUB_DOMAIN, TARGET_GROUP_UUID, PANEL_VERIFY_TLS, config
     for k, v in kwargs.items():
         config[k] = v
     with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
@@ -417,7 +767,7 @@ def save_runtime_config(**kwargs):
     if 'panel_url' in kwargs:
         PANEL_URL = kwargs.get('panel_url', '').rstrip('/') + '/api' if kwargs.get('panel_url') else ''
     if 'panel_token' in kwargs:
-        PANEL_TOKEN = kwargs.get('panel_token', '')
+        set_panel_token(kwargs.get('panel_token', ''))
     if 'sub_domain' in kwargs:
         SUB_DOMAIN = kwargs.get('sub_domain', '').rstrip('/')
     if 'group_uuid' in kwargs:
@@ -427,10 +777,24 @@ def save_runtime_config(**kwargs):
 
 
 init_db()
+preload_settings()
+
+
+_PANEL_HEADERS: Mapping[str, str] = MappingProxyType({})
+
+
+def set_panel_token(token):
+    global PANEL_TOKEN, _PANEL_HEADERS
+    PANEL_TOKEN = token
+    # 只在令牌变化时重建；只读视图防止调用方意外修改共享的请求头
+    _PANEL_HEADERS = MappingProxyType({"Authorization": f"Bearer {PANEL_TOKEN}", "Content-Type": "application/json"})
+
+
+set_panel_token(PANEL_TOKEN)
 
 
 def get_headers():
-    return {"Authorization": f"Bearer {PANEL_TOKEN}", "Content-Type": "application/json"}
+    return _PANEL_HEADERS
 
 
 async def safe_api_request(method, endpoint, json_data=None):
@@ -445,8 +809,54 @@ async def safe_api_request(method, endpoint, json_data=None):
     return resp
 
 
+_panel_user_inflight: dict[str, asyncio.Task] = {}
+
+
 async def get_panel_user(uuid):
-    return await api_get_panel_user(uuid, PANEL_URL, get_headers(), PANEL_VERIFY_TLS)
+    # 同一 UUID 的并发查询共用一次 HTTP 请求；请求结束即移除，不缓存结果以免读到改动前的数据
+    task = _panel_user_inflight.get(uuid)
+    if task is None:
+        task = asyncio.ensure_future(api_get_panel_user(uuid, PANEL_URL, get_headers(), PANEL_VERIFY_TLS))
+        _panel_user_inflight[uuid] = task
+        task.add_done_callback(lambda _t, key=uuid: _panel_user_inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def get_panel_users(uuids, limit=PANEL_USER_FANOUT_LIMIT):
+    # 与 PANEL_WORK_SEMAPHORE 分开计数，避免持有全局许可的流程里再次等待同一信号量
+    sem = asyncio.Semaphore(limit)
+
+    async def _bounded(uuid):
+        async with sem:
+            return await get_panel_user(uuid)
+
+    return await asyncio.gather(*(_bounded(uuid) for uuid in uuids))
+
+
+def _subscription_traffic_row(uuid, info, now_ts):
+    limit = info.get('trafficLimitBytes', 0) or 0
+    used = (info.get('userTraffic') or {}).get('usedTrafficBytes', 0) or 0
+    return (int(limit), int(used), now_ts, uuid)
+
+
+_SUB_TRAFFIC_UPDATE_SQL = "UPDATE subscriptions SET cached_limit = ?, cached_used = ?, cached_at = ? WHERE uuid = ?"
+
+
+def cache_subscription_traffic(uuid, info):
+    if not info:
+        return
+    db_execute(_SUB_TRAFFIC_UPDATE_SQL, _subscription_traffic_row(uuid, info, int(time.time())))
+
+
+async def acache_subscription_traffic_many(pairs):
+    now_ts = int(time.time())
+    rows = [_subscription_traffic_row(uuid, info, now_ts) for uuid, info in pairs if info]
+    if rows:
+        await adb_execute_batch([(_SUB_TRAFFIC_UPDATE_SQL, rows)])
+
+
+async def get_all_panel_users():
+    return await api_get_all_panel_users(PANEL_URL, get_headers(), PANEL_VERIFY_TLS)
 
 
 async def get_user_by_telegram_id(telegram_id):
@@ -465,7 +875,15 @@ async def get_nodes_status():
     return await api_get_nodes_status(PANEL_URL, get_headers(), PANEL_VERIFY_TLS)
 
 async def get_subscription_history_stats():
-    return await api_get_subscription_history_stats(PANEL_URL, get_headers(), PANEL_VERIFY_TLS)
+    global _history_stats_cache
+    now = time.monotonic()
+    cached_at, cached = _history_stats_cache
+    if cached and now - cached_at < HISTORY_STATS_CACHE_TTL_SECONDS:
+        return cached
+    stats = await api_get_subscription_history_stats(PANEL_URL, get_headers(), PANEL_VERIFY_TLS)
+    if stats:
+        _history_stats_cache = (now, stats)
+    return stats
 
 
 async def get_user_subscription_history(uuid):
@@ -487,6 +905,36 @@ async def get_internal_squads():
 async def get_internal_squad_accessible_nodes(uuid):
     return await api_get_internal_squad_accessible_nodes(uuid, PANEL_URL, get_headers(), PANEL_VERIFY_TLS)
 
+async def get_user_accessible_nodes_verbose(uuid):
+    if not PANEL_URL or not PANEL_TOKEN:
+        return [], 'config_missing'
+    user_nodes, user_nodes_err = [], None
+    resp = await safe_api_request('GET', f"/users/{uuid}/accessible-nodes")
+    if not resp:
+        user_nodes_err = "network_error"
+    elif resp.status_code == 401:
+        user_nodes_err = "auth_unauthorized"
+    elif resp.status_code == 403:
+        user_nodes_err = "auth_forbidden"
+    elif resp.status_code == 404:
+        user_nodes_err = "endpoint_or_user_not_found"
+    elif resp.status_code == 200:
+        payload = extract_payload(resp)
+        if isinstance(payload, list):
+            user_nodes = payload
+        elif isinstance(payload, dict):
+            nodes = payload.get('accessibleNodes')
+            if isinstance(nodes, list):
+                user_nodes = nodes
+            else:
+                user_nodes_err = "empty_payload"
+        else:
+            user_nodes_err = "empty_payload"
+    else:
+        user_nodes_err = f"http_{resp.status_code}"
+    return user_nodes, user_nodes_err
+
+
 async def get_internal_squad_accessible_nodes_verbose(uuid):
     if not PANEL_URL or not PANEL_TOKEN:
         return [], 'config_missing'
@@ -519,7 +967,12 @@ async def get_bandwidth_nodes_realtime():
 
 
 async def bulk_move_users_to_squad(uuids, squad_uuid):
-    return await api_bulk_move_users_to_squad(uuids, squad_uuid, PANEL_URL, get_headers(), PANEL_VERIFY_TLS)
+    global _squads_overview_cache, _squads_overview_generation
+    try:
+        return await api_bulk_move_users_to_squad(uuids, squad_uuid, PANEL_URL, get_headers(), PANEL_VERIFY_TLS)
+    finally:
+        _squads_overview_generation += 1
+        _squads_overview_cache = (0.0, None)
 
 
 async def create_panel_user(payload):
@@ -669,12 +1122,12 @@ async def apply_user_status_bulk_with_fallback(uuids, status):
 
 
 async def build_squad_capacity_summary(max_users=60):
-    rows = db_query("SELECT DISTINCT uuid FROM subscriptions ORDER BY id DESC LIMIT ?", (max_users,))
-    uuids = [dict(r)['uuid'] for r in rows]
+    rows = await adb_query("SELECT DISTINCT uuid FROM subscriptions ORDER BY id DESC LIMIT ?", (max_users,))
+    uuids = [r['uuid'] for r in rows]
     if not uuids:
         return "暂无订阅样本", None
-    infos = await asyncio.gather(*[get_panel_user(u) for u in uuids])
-    counts = defaultdict(int)
+    infos = await get_panel_users(uuids)
+    counts = Counter()
     for info in infos:
         if not isinstance(info, dict):
             continue
@@ -688,7 +1141,7 @@ async def build_squad_capacity_summary(max_users=60):
                 else:
                     squad = str(first)
         counts[squad or '未分组'] += 1
-    top = sorted(counts.items(), key=lambda x: x[1], reverse=True)
+    top = counts.most_common()
     lines = [f"样本用户数: {len(uuids)}"]
     for sid, cnt in top[:5]:
         lines.append(f"- `{sid}`：{cnt}")
@@ -700,18 +1153,27 @@ async def build_squad_capacity_summary(max_users=60):
 
 
 async def build_top_users_traffic(max_users=50):
-    rows = db_query("SELECT tg_id, uuid FROM subscriptions ORDER BY id DESC LIMIT ?", (max_users,))
+    rows = await adb_query("SELECT tg_id, uuid FROM subscriptions ORDER BY id DESC LIMIT ?", (max_users,))
     if not rows:
         return []
-    pairs = [(dict(r)['tg_id'], dict(r)['uuid']) for r in rows]
-    infos = await asyncio.gather(*[get_panel_user(u) for _, u in pairs])
+    pairs = [(r['tg_id'], r['uuid']) for r in rows]
+    infos = await get_panel_users([u for _, u in pairs])
     data = []
     for (tg_id, uid), info in zip(pairs, infos):
         if not isinstance(info, dict):
             continue
         used = int((info.get('userTraffic') or {}).get('usedTrafficBytes', 0) or 0)
         data.append((tg_id, uid, used))
-    return sorted(data, key=lambda x: x[2], reverse=True)[:5]
+    return heapq.nlargest(5, data, key=itemgetter(2))
+
+
+VOLATILITY_MIN_DELTA_BYTES = 1 << 30
+
+
+def _node_traffic_pair(it):
+    name = it.get('name') or it.get('nodeName') or '未知节点'
+    val = it.get('totalTrafficBytes') or it.get('trafficBytes') or 0
+    return name, int(val) if isinstance(val, (int, float)) else 0
 
 
 def detect_bandwidth_volatility(nodes_rt):
@@ -725,15 +1187,31 @@ def detect_bandwidth_volatility(nodes_rt):
         val = int(it.get('totalTrafficBytes') or it.get('trafficBytes') or 0)
         curr[name] = val
         old = int(prev.get(name, 0) or 0)
-        if old > 0:
-            delta = val - old
-            ratio = abs(delta) / old
-            if abs(delta) >= 1024**3 and ratio >= 0.5:
-                alerts.append((name, delta, ratio))
-    set_json_setting('bandwidth_last_nodes', curr)
+        if old <= 0:
+            continue
+        delta = val - old
+        # 先用整数比较筛掉绝大多数节点（|Δ| ≥ 1GiB 且 |Δ|/old ≥ 0.5），命中时才计算比例
+        if abs(delta) >= VOLATILITY_MIN_DELTA_BYTES and 2 * abs(delta) >= old:
+            alerts.append((name, delta, abs(delta) / old))
+    if curr != prev:
+        set_json_setting('bandwidth_last_nodes', curr)
     return alerts
 
 
+MAX_MENU_RENDER_ENTRIES = 1024
+_last_menu_render: OrderedDict = OrderedDict()
+
+
+def _is_not_modified_error(exc):
+    return isinstance(exc, BadRequest) and 'message is not modified' in str(exc).lower()
+
+
+def forget_menu_render(message):
+    # 绕过 send_or_edit_menu 直接编辑消息时调用；回调里的 reply_markup 是编辑前的快照，无法反映中途改动
+    if message:
+        _last_menu_render.pop((message.chat_id, message.message_id), None)
+
+
 async def send_or_edit_menu(update, context, text, reply_markup, parse_mode='Markdown'):
     async def _safe_send(chat_id, body, markup, mode):
         try:
@@ -746,9 +1224,25 @@ async def send_or_edit_menu(update, context, text, reply_markup, parse_mode='Mar
                 raise
 
     if update.callback_query:
+        query = update.callback_query
+        message = query.message
+        render_key = (message.chat_id, message.message_id) if message else None
+        payload = (text, reply_markup, parse_mode)
+        # 同一条消息重复渲染相同内容时 Telegram 会拒绝编辑；回调里的当前按钮也一致才跳过，避免被其他路径改过的消息漏更新
+        if render_key and _last_menu_render.get(render_key) == payload and message.reply_markup == reply_markup:
+            return
         try:
-            await update.callback_query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+            await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+            if render_key:
+                _last_menu_render[render_key] = payload
+                _last_menu_render.move_to_end(render_key)
+                if len(_last_menu_render) > MAX_MENU_RENDER_ENTRIES:
+                    _last_menu_render.popitem(last=False)
         except Exception as exc:
+            if _is_not_modified_error(exc):
+                return
+            if render_key:
+                _last_menu_render.pop(render_key, None)
             if parse_mode is not None:
                 logger.warning("edit_message_text failed with parse_mode=%s, fallback plain text: %s", parse_mode, exc)
                 try:
@@ -763,6 +1257,65 @@ async def send_or_edit_menu(update, context, text, reply_markup, parse_mode='Mar
     else:
         await _safe_send(update.effective_chat.id, text, reply_markup, parse_mode)
 
+BACK_HOME_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]])
+RETURN_HOME_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")]])
+CANCEL_OP_KB = InlineKeyboardMarkup([[InlineKeyboardButton("❌ 取消", callback_data="cancel_op")]])
+PANEL_CONFIG_BACK_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_panel_config")]])
+SUBSCRIPTION_SETTINGS_BACK_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_subscription_settings")]])
+RISK_POLICY_BACK_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_risk_policy")]])
+ANOMALY_MENU_BACK_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_anomaly_menu")]])
+BULK_MENU_CANCEL_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_bulk_menu")]])
+PAY_SETTINGS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🟨 USDT 配置", callback_data="admin_pay_usdt_cfg")],
+    [InlineKeyboardButton("🧪 支付设置自检", callback_data="admin_pay_self_check")],
+    [InlineKeyboardButton("🔙 返回", callback_data="back_home")],
+])
+PANEL_CONFIG_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🌐 设置面板地址", callback_data="panelcfg_set_url")],
+    [InlineKeyboardButton("🔑 设置面板Token", callback_data="panelcfg_set_token")],
+    [InlineKeyboardButton("🔗 设置订阅域名", callback_data="panelcfg_set_subdomain")],
+    [InlineKeyboardButton("🧩 设置默认组UUID", callback_data="panelcfg_set_group")],
+    [InlineKeyboardButton("🔒 切换TLS校验", callback_data="panelcfg_toggle_tls")],
+    [InlineKeyboardButton("🔙 返回", callback_data="back_home")],
+])
+SUBSCRIPTION_SETTINGS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✍️ 修改订阅设置(JSON)", callback_data="admin_subscription_settings_edit")],
+    [InlineKeyboardButton("🧩 应用安全模板", callback_data="admin_subsettings_tpl_safe"), InlineKeyboardButton("🧩 应用兼容模板", callback_data="admin_subsettings_tpl_compat")],
+    [InlineKeyboardButton("💾 保存回滚点", callback_data="admin_subsettings_snapshot"), InlineKeyboardButton("↩️ 回滚最近一次", callback_data="admin_subsettings_rollback")],
+    [InlineKeyboardButton("🔙 返回", callback_data="back_home")],
+])
+BULK_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 批量重置流量", callback_data="bulk_reset")],
+    [InlineKeyboardButton("⛔ 批量禁用", callback_data="bulk_disable")],
+    [InlineKeyboardButton("🗑 批量删除", callback_data="bulk_delete")],
+    [InlineKeyboardButton("📅 批量改到期日", callback_data="bulk_expire")],
+    [InlineKeyboardButton("📡 批量改流量包", callback_data="bulk_traffic")],
+    [InlineKeyboardButton("🔙 返回", callback_data="back_home")],
+])
+
+_ADMIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📦 套餐管理", callback_data="admin_plans_list")],
+    [InlineKeyboardButton("👥 用户列表", callback_data="admin_users_list")],
+    [InlineKeyboardButton("🔔 提醒设置", callback_data="admin_notify"), InlineKeyboardButton("🗑 清理设置", callback_data="admin_cleanup")],
+    [InlineKeyboardButton("🛡️ 异常设置", callback_data="admin_anomaly_menu")],
+    [InlineKeyboardButton("📚 批量操作", callback_data="admin_bulk_menu")],
+    [InlineKeyboardButton("🧾 订单审计", callback_data="admin_orders_menu"), InlineKeyboardButton("🧾 风控回溯", callback_data="admin_risk_audit")],
+    [InlineKeyboardButton("⚙️ 订阅设置", callback_data="admin_subscription_settings"), InlineKeyboardButton("🧩 用户分组", callback_data="admin_squads_menu")],
+    [InlineKeyboardButton("📈 带宽看板", callback_data="admin_bandwidth_dashboard"), InlineKeyboardButton("🛡️ 风控策略", callback_data="admin_risk_policy")],
+    [InlineKeyboardButton("🕒 操作时间线", callback_data="admin_ops_timeline"), InlineKeyboardButton("📢 群发通知", callback_data="admin_broadcast_start")],
+    [InlineKeyboardButton("💳 收款设置", callback_data="admin_pay_settings"), InlineKeyboardButton("🔌 面板配置", callback_data="admin_panel_config")],
+    [InlineKeyboardButton("🧩 模板中心", callback_data="admin_template_center"), InlineKeyboardButton("🗂 批量任务", callback_data="admin_bulk_jobs")],
+    [InlineKeyboardButton("🔎 面板用户检索", callback_data="admin_panel_user_lookup"), InlineKeyboardButton("🖥 系统面板", callback_data="admin_system_dashboard")]
+])
+
+_CLIENT_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛒 购买新订阅", callback_data="client_buy_new")],
+    [InlineKeyboardButton("🔍 我的订阅 / 续费", callback_data="client_status")],
+    [InlineKeyboardButton("📄 我的订单", callback_data="client_orders")],
+    [InlineKeyboardButton("🌍 节点状态", callback_data="client_nodes"), InlineKeyboardButton("🆘 联系客服", callback_data="contact_support")]
+])
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     user_id = update.effective_user.id
@@ -787,19 +1340,24 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data['channel_code'] = channel_code[:32]
     if user_id == ADMIN_ID:
         try:
-            val_notify = db_query("SELECT value FROM settings WHERE key='notify_days'", one=True)
-            notify_days = int(val_notify['value']) if val_notify else 3
-            val_cleanup = db_query("SELECT value FROM settings WHERE key='cleanup_days'", one=True)
-            cleanup_days = int(val_cleanup['value']) if val_cleanup else 7
+            retention = await aget_setting_values({'notify_days': 3, 'cleanup_days': 7})
+            notify_days = int(retention['notify_days'])
+            cleanup_days = int(retention['cleanup_days'])
         except Exception as exc:
             logger.warning("failed to load admin settings, using defaults: %s", exc)
             notify_days = 3
             cleanup_days = 7
         try:
-            pending_cnt = db_query("SELECT COUNT(*) AS c FROM orders WHERE status='pending'", one=True)['c']
-            failed_cnt = db_query("SELECT COUNT(*) AS c FROM orders WHERE status='failed'", one=True)['c']
-            today_ts = int(datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
-            today_cnt = db_query("SELECT COUNT(*) AS c FROM orders WHERE created_at>=?", (today_ts,), one=True)['c']
+            today_ts = get_today_start_ts()
+            # 一次查询取回三项统计；标量子查询各自仍可命中 status/created_at 索引
+            stats = await adb_query(
+                "SELECT (SELECT COUNT(*) FROM orders WHERE status='pending') AS p, "
+                "(SELECT COUNT(*) FROM orders WHERE status='failed') AS f, "
+                "(SELECT COUNT(*) FROM orders WHERE created_at>=?) AS t",
+                (today_ts,),
+                one=True,
+            )
+            pending_cnt, failed_cnt, today_cnt = stats['p'], stats['f'], stats['t']
         except Exception:
             pending_cnt = failed_cnt = today_cnt = 0
         msg_text = (
@@ -808,322 +1366,362 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"🗑 清理设置：过期 {cleanup_days} 天\n"
             f"📊 今日订单：{today_cnt} | 待审核：{pending_cnt} | 失败：{failed_cnt}"
         )
-        keyboard = [
-            [InlineKeyboardButton("📦 套餐管理", callback_data="admin_plans_list")],
-            [InlineKeyboardButton("👥 用户列表", callback_data="admin_users_list")],
-            [InlineKeyboardButton("🔔 提醒设置", callback_data="admin_notify"), InlineKeyboardButton("🗑 清理设置", callback_data="admin_cleanup")],
-            [InlineKeyboardButton("🛡️ 异常设置", callback_data="admin_anomaly_menu")],
-            [InlineKeyboardButton("📚 批量操作", callback_data="admin_bulk_menu")],
-            [InlineKeyboardButton("🧾 订单审计", callback_data="admin_orders_menu"), InlineKeyboardButton("🧾 风控回溯", callback_data="admin_risk_audit")],
-            [InlineKeyboardButton("⚙️ 订阅设置", callback_data="admin_subscription_settings"), InlineKeyboardButton("🧩 用户分组", callback_data="admin_squads_menu")],
-            [InlineKeyboardButton("📈 带宽看板", callback_data="admin_bandwidth_dashboard"), InlineKeyboardButton("🛡️ 风控策略", callback_data="admin_risk_policy")],
-            [InlineKeyboardButton("🕒 操作时间线", callback_data="admin_ops_timeline"), InlineKeyboardButton("📢 群发通知", callback_data="admin_broadcast_start")],
-            [InlineKeyboardButton("💳 收款设置", callback_data="admin_pay_settings"), InlineKeyboardButton("🔌 面板配置", callback_data="admin_panel_config")],
-            [InlineKeyboardButton("🧩 模板中心", callback_data="admin_template_center"), InlineKeyboardButton("🗂 批量任务", callback_data="admin_bulk_jobs")],
-            [InlineKeyboardButton("🔎 面板用户检索", callback_data="admin_panel_user_lookup"), InlineKeyboardButton("🖥 系统面板", callback_data="admin_system_dashboard")]
-        ]
+        reply_markup = _ADMIN_MENU_KB
     else:
         msg_text = "👋 **欢迎使用自助服务！**\n请选择操作："
-        keyboard = [
-            [InlineKeyboardButton("🛒 购买新订阅", callback_data="client_buy_new")],
-            [InlineKeyboardButton("🔍 我的订阅 / 续费", callback_data="client_status")],
-            [InlineKeyboardButton("📄 我的订单", callback_data="client_orders")],
-            [InlineKeyboardButton("🌍 节点状态", callback_data="client_nodes"), InlineKeyboardButton("🆘 联系客服", callback_data="contact_support")]
-        ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _CLIENT_MENU_KB
     await send_or_edit_menu(update, context, msg_text, reply_markup)
 
-async def client_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _cb_back_home(update, context, data):
+    await start(update, context)
+
+
+async def _cb_client_nodes(update, context, data):
+    query = update.callback_query
+    forget_menu_render(query.message)
+    try: await query.edit_message_text("🔄 正在获取节点状态...")
+    except Exception as exc:
+        logger.debug("node status loading hint message failed: %s", exc)
+    nodes = await get_nodes_status()
+    kb = [[InlineKeyboardButton("🔄 刷新", callback_data="client_nodes")], [InlineKeyboardButton("🔙 返回", callback_data="back_home")]]
+    await send_or_edit_menu(update, context, build_nodes_status_message(nodes), InlineKeyboardMarkup(kb))
+
+
+async def _cb_contact_support(update, context, data):
     query = update.callback_query
-    if not check_cooldown(query.from_user.id):
-        await query.answer("⏳ 操作太快了...", show_alert=False)
-        return
-    await query.answer()
-    data = query.data
     user_id = query.from_user.id
+    context.user_data['chat_mode'] = 'support'
+    support_ctx = {'source': 'user_initiated', 'updated_at': int(time.time())}
+    context.user_data['support_reply_context'] = support_ctx
+    set_support_reply_session(context, user_id, source='user_initiated')
+    if query.message:
+        store = _get_support_session_store(context.application)
+        sess = store.get(int(user_id), {})
+        if isinstance(sess, dict):
+            sess['control_message_id'] = query.message.message_id
+            store[int(user_id)] = sess
+    logger.info("user entered support mode: user=%s source=user_initiated", user_id)
+    msg = dynamic_snippets_cache.get("support_contact_tip") or "📞 **客服模式已开启**\n请直接发送文字、图片或文件。\n🚪 结束咨询请点击下方按钮。"
+    keyboard = [[InlineKeyboardButton("🚪 结束咨询", callback_data="back_home")]]
+    await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(keyboard))
+
+
+async def _cb_client_pay_done_upload(update, context, data):
+    query = update.callback_query
+    await query.answer("✅ 已切换为“发送凭证即提交审核”，请直接发送支付凭证。", show_alert=True)
 
-    if data == "back_home":
-        await start(update, context)
+
+async def _cb_client_orders(update, context, data):
+    user_id = update.callback_query.from_user.id
+    rows = await adb_query("SELECT * FROM orders WHERE tg_id=? ORDER BY created_at DESC LIMIT 12", (user_id,))
+    if not rows:
+        await send_or_edit_menu(update, context, "📄 **我的订单**\n暂无订单记录。", BACK_HOME_KB)
         return
+    keyboard = []
+    for row in rows:
+        item = dict(row)
+        ts = format_minute(item['created_at'])
+        keyboard.append([InlineKeyboardButton(f"{order_status_label(item['status'])} | {item['order_id']} | {ts}", callback_data=f"client_order_{item['order_id']}")])
+    keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
+    await send_or_edit_menu(update, context, "📄 **我的订单（最近12条）**", InlineKeyboardMarkup(keyboard))
 
-    if data == "client_nodes":
-        try: await query.edit_message_text("🔄 正在获取节点状态...")
-        except Exception as exc:
-            logger.debug("node status loading hint message failed: %s", exc)
-        nodes = await get_nodes_status()
-        msg_list = ["🌍 **节点状态**\n"]
-        if not nodes:
-            msg_list.append("⚠️ 暂无节点信息")
+
+async def _cb_client_order_cancel(update, context, data):
+    query = update.callback_query
+    user_id = query.from_user.id
+    order_id = data.removeprefix("client_order_cancel_")
+    order = await asyncio.to_thread(get_order, db_query, order_id)
+    if not order or int(order.get('tg_id', 0)) != int(user_id):
+        await query.answer("订单不存在", show_alert=True)
+        return
+    ok = await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_PENDING], STATUS_REJECTED, error_message='cancelled_by_user')
+    if ok:
+        await asyncio.to_thread(append_order_audit_log, db_execute, order_id, 'cancel_by_user', user_id, 'user_cancel_pending_order')
+        await query.answer("✅ 已取消订单", show_alert=True)
+    else:
+        await query.answer("⚠️ 仅待审核订单可取消", show_alert=True)
+    rows = await adb_query("SELECT * FROM orders WHERE tg_id=? ORDER BY created_at DESC LIMIT 12", (user_id,))
+    keyboard = []
+    for row in rows:
+        item = dict(row)
+        ts = format_minute(item['created_at'])
+        keyboard.append([InlineKeyboardButton(f"{order_status_label(item['status'])} | {item['order_id']} | {ts}", callback_data=f"client_order_{item['order_id']}")])
+    keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
+    await send_or_edit_menu(update, context, "📄 **我的订单（最近12条）**", InlineKeyboardMarkup(keyboard))
+
+
+async def _cb_client_order(update, context, data):
+    user_id = update.callback_query.from_user.id
+    order_id = data.removeprefix("client_order_")
+    order = await asyncio.to_thread(get_order, db_query, order_id)
+    if not order or int(order.get('tg_id', 0)) != int(user_id):
+        await send_or_edit_menu(update, context, "⚠️ 订单不存在或无权限查看", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="client_orders")]]))
+        return
+    plan = get_plan_row(order['plan_key'])
+    plan_name = dict(plan)['name'] if plan else order['plan_key']
+    created = datetime.datetime.fromtimestamp(int(order['created_at'])).strftime('%Y-%m-%d %H:%M')
+    lines = [
+        "📄 **订单详情**",
+        f"订单号: `{order['order_id']}`",
+        f"状态: `{order_status_label(order['status'])}`",
+        f"类型: `{ '续费' if order['order_type'] == 'renew' else '新购' }`",
+        f"套餐: `{plan_name}`",
+        f"渠道: `{order.get('channel_code') or '-'}`",
+        f"创建时间: `{created}`",
+    ]
+    if order.get('delivered_uuid'):
+        lines.append(f"发货UUID: `{order['delivered_uuid']}`")
+    if order.get('error_message'):
+        lines.append(f"失败原因: `{order['error_message']}`")
+    kb = []
+    if order['status'] == STATUS_PENDING:
+        kb.append([InlineKeyboardButton("❌ 取消该订单", callback_data=f"client_order_cancel_{order['order_id']}")])
+    kb.append([InlineKeyboardButton("🔙 返回订单列表", callback_data="client_orders")])
+    await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup(kb))
+
+
+def format_plan_button_text(plan, with_strategy=True):
+    text = f"{plan['name']} | ¥{plan['price']} / {get_plan_price(plan, 'usdt')} | {plan['gb']}G"
+    if with_strategy:
+        text += f" ({get_strategy_label(plan.get('reset_strategy', 'NO_RESET'))})"
+    return text
+
+
+async def _cb_client_buy_new(update, context, data):
+    keyboard = [
+        [InlineKeyboardButton(format_plan_button_text(p), callback_data=f"order_{p['key']}_new_0")]
+        for p in get_plan_rows()
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")])
+    await send_or_edit_menu(update, context, "🛒 **请选择新购套餐：**", InlineKeyboardMarkup(keyboard))
+
+
+async def _cb_client_status(update, context, data):
+    query = update.callback_query
+    user_id = query.from_user.id
+    sub_sql = "SELECT uuid, cached_limit, cached_used, cached_at FROM subscriptions WHERE tg_id = ?"
+    subs = await adb_query(sub_sql, (user_id,))
+    if not subs:
+        panel_user = await get_user_by_telegram_id(user_id)
+        synced_uuid = await asyncio.to_thread(ensure_local_subscription_sync, user_id, panel_user)
+        if synced_uuid:
+            await asyncio.to_thread(append_ops_timeline, '数据修复', '按TG ID自动补齐订阅映射', f'tg_id={user_id},uuid={synced_uuid}', actor='system')
+            subs = await adb_query(sub_sql, (user_id,))
+    if not subs:
+        await send_or_edit_menu(update, context, "❌ 您名下没有订阅。\n请点击“购买新订阅”。", BACK_HOME_KB)
+        return
+    # 流量快照在 SUB_TRAFFIC_CACHE_TTL_SECONDS 内有效，只对过期的行回源面板
+    now_ts = int(time.time())
+    traffic = {}
+    stale_uuids = []
+    for sub in subs:
+        if sub['cached_at'] and now_ts - int(sub['cached_at']) < SUB_TRAFFIC_CACHE_TTL_SECONDS:
+            traffic[sub['uuid']] = (sub['cached_limit'] or 0, sub['cached_used'] or 0)
         else:
-            for node in nodes:
-                name = node.get('name', '未知节点')
-                status_raw = str(node.get('status', '')).lower()
-                is_online = status_raw in ['connected', 'healthy', 'online', 'active', 'true'] or node.get('isConnected') is True
-                icon = "🟢" if is_online else "🔴"
-                stat_text = "在线" if is_online else "离线"
-                msg_list.append(f"{icon} **{name}** | {stat_text}")
-        msg_list.append(f"\n_更新时间: {datetime.datetime.now().strftime('%H:%M:%S')}_")
-        kb = [[InlineKeyboardButton("🔄 刷新", callback_data="client_nodes")], [InlineKeyboardButton("🔙 返回", callback_data="back_home")]]
-        await send_or_edit_menu(update, context, "\n".join(msg_list), InlineKeyboardMarkup(kb))
+            stale_uuids.append(sub['uuid'])
+    if stale_uuids:
+        forget_menu_render(query.message)
+        try: await query.edit_message_text("🔄 正在加载订阅列表...")
+        except Exception as exc:
+            logger.debug("failed to delete view_sub message: %s", exc)
+        results = await get_panel_users(stale_uuids)
+        await acache_subscription_traffic_many(zip(stale_uuids, results))
+        for uuid, info in zip(stale_uuids, results):
+            if not info: continue
+            traffic[uuid] = (info.get('trafficLimitBytes', 0), info.get('userTraffic', {}).get('usedTrafficBytes', 0))
+    valid_uuids = [sub['uuid'] for sub in subs if sub['uuid'] in traffic]
+    keyboard = [
+        [InlineKeyboardButton(f"📦 订阅 #{idx} | 剩余 {round((traffic[uuid][0] - traffic[uuid][1]) / (1024**3), 1)} GB", callback_data=f"view_sub_{get_short_id(uuid)}")]
+        for idx, uuid in enumerate(valid_uuids, 1)
+    ]
+    if not valid_uuids:
+        panel_user = await get_user_by_telegram_id(user_id)
+        synced_uuid = await asyncio.to_thread(ensure_local_subscription_sync, user_id, panel_user)
+        if synced_uuid:
+            info = await get_panel_user(synced_uuid)
+            if info:
+                await asyncio.to_thread(cache_subscription_traffic, synced_uuid, info)
+                limit = info.get('trafficLimitBytes', 0)
+                used = info.get('userTraffic', {}).get('usedTrafficBytes', 0)
+                remain_gb = round((limit - used) / (1024**3), 1)
+                sid = get_short_id(synced_uuid)
+                keyboard = [[InlineKeyboardButton(f"📦 订阅 #1 | 剩余 {remain_gb} GB", callback_data=f"view_sub_{sid}")], [InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")]]
+                await asyncio.to_thread(append_ops_timeline, '数据修复', '按TG ID恢复订阅入口', f'tg_id={user_id},uuid={synced_uuid}', actor='system')
+                await send_or_edit_menu(update, context, "👤 **我的订阅列表**\n请点击下方按钮查看详情：", InlineKeyboardMarkup(keyboard))
+                return
+        await send_or_edit_menu(update, context, "⚠️ 您的所有订阅似乎都已失效。", BACK_HOME_KB)
         return
+    keyboard.append([InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")])
+    await send_or_edit_menu(update, context, "👤 **我的订阅列表**\n请点击下方按钮查看详情：", InlineKeyboardMarkup(keyboard))
 
-    if data == "contact_support":
-        context.user_data['chat_mode'] = 'support'
-        support_ctx = {'source': 'user_initiated', 'updated_at': int(time.time())}
-        context.user_data['support_reply_context'] = support_ctx
-        set_support_reply_session(context, user_id, source='user_initiated')
-        if query.message:
-            store = _get_support_session_store(context.application)
-            sess = store.get(int(user_id), {})
-            if isinstance(sess, dict):
-                sess['control_message_id'] = query.message.message_id
-                store[int(user_id)] = sess
-        logger.info("user entered support mode: user=%s source=user_initiated", user_id)
-        msg = dynamic_snippets_cache.get("support_contact_tip") or "📞 **客服模式已开启**\n请直接发送文字、图片或文件。\n🚪 结束咨询请点击下方按钮。"
-        keyboard = [[InlineKeyboardButton("🚪 结束咨询", callback_data="back_home")]]
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(keyboard))
-        return
 
-    if data == "client_pay_done_upload":
-        await query.answer("✅ 已切换为“发送凭证即提交审核”，请直接发送支付凭证。", show_alert=True)
+async def _cb_view_sub(update, context, data):
+    query = update.callback_query
+    user_id = query.from_user.id
+    short_id = data.removeprefix("view_sub_")
+    target_uuid = get_real_uuid(short_id)
+    if not target_uuid:
+        await query.answer("❌ 按钮已过期")
         return
+    await query.answer("🔄 加载详情中...")
+    try: await query.delete_message()
+    except Exception as exc:
+        logger.debug("delete stale sub detail message failed: %s", exc)
+    info = await get_panel_user(target_uuid)
+    if info:
+        await asyncio.to_thread(cache_subscription_traffic, target_uuid, info)
+    if not info:
+        await context.bot.send_message(user_id, "⚠️ 此订阅已被删除。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回列表", callback_data="client_status")]]))
+        return
+    expire_show = format_time(info.get('expireAt'))
+    limit = info.get('trafficLimitBytes', 0)
+    used = info.get('userTraffic', {}).get('usedTrafficBytes', 0)
+    limit_gb = round(limit / (1024**3), 2)
+    remain_gb = round((limit - used) / (1024**3), 2)
+    sub_url = info.get('subscriptionUrl', '无链接')
+    progress = draw_progress_bar(used, limit)
+    strategy = info.get('trafficLimitStrategy', 'NO_RESET')
+    strategy_label = get_strategy_label(strategy)
+    caption = _SUB_CAPTION_TMPL.format(progress=progress, remain=remain_gb, limit=limit_gb, strategy=strategy_label, expire=expire_show, url=sub_url)
+    sid = get_short_id(target_uuid)
+    keyboard = [[InlineKeyboardButton(f"💳 续费此订阅", callback_data=f"selrenew_{sid}")], [InlineKeyboardButton("🔙 返回列表", callback_data="client_status")]]
+    if sub_url and sub_url.startswith('http'):
+        await send_sub_qr_photo(context.bot, user_id, sub_url, caption=caption, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        await context.bot.send_message(chat_id=user_id, text=caption, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
 
-    if data == "client_orders":
-        rows = db_query("SELECT * FROM orders WHERE tg_id=? ORDER BY created_at DESC LIMIT 12", (user_id,))
-        if not rows:
-            await send_or_edit_menu(update, context, "📄 **我的订单**\n暂无订单记录。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
-            return
-        keyboard = []
-        for row in rows:
-            item = dict(row)
-            ts = datetime.datetime.fromtimestamp(int(item['created_at'])).strftime('%m-%d %H:%M')
-            keyboard.append([InlineKeyboardButton(f"{order_status_label(item['status'])} | {item['order_id']} | {ts}", callback_data=f"client_order_{item['order_id']}")])
-        keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
-        await send_or_edit_menu(update, context, "📄 **我的订单（最近12条）**", InlineKeyboardMarkup(keyboard))
+async def _cb_selrenew(update, context, data):
+    query = update.callback_query
+    short_id = data.removeprefix("selrenew_")
+    target_uuid = get_real_uuid(short_id)
+    if not target_uuid:
+        await query.answer("❌ 信息过期")
+        return
+    
+    # 套餐行已在进程内缓存，这里只需取回 plan_key，无需整行订阅记录
+    sub_record = await adb_query("SELECT plan_key FROM subscriptions WHERE uuid = ?", (target_uuid,), one=True)
+    original_plan_key = sub_record['plan_key'] if sub_record else None
+    if original_plan_key and get_plan_row(original_plan_key):
+        await show_payment_method_menu(update, context, original_plan_key, 'renew', short_id)
         return
 
-    if data.startswith("client_order_cancel_"):
-        order_id = data.replace("client_order_cancel_", "")
-        order = get_order(db_query, order_id)
-        if not order or int(order.get('tg_id', 0)) != int(user_id):
-            await query.answer("订单不存在", show_alert=True)
-            return
-        ok = update_order_status(db_execute, order_id, [STATUS_PENDING], STATUS_REJECTED, error_message='cancelled_by_user')
-        if ok:
-            append_order_audit_log(db_execute, order_id, 'cancel_by_user', user_id, 'user_cancel_pending_order')
-            await query.answer("✅ 已取消订单", show_alert=True)
-        else:
-            await query.answer("⚠️ 仅待审核订单可取消", show_alert=True)
-        rows = db_query("SELECT * FROM orders WHERE tg_id=? ORDER BY created_at DESC LIMIT 12", (user_id,))
-        keyboard = []
-        for row in rows:
-            item = dict(row)
-            ts = datetime.datetime.fromtimestamp(int(item['created_at'])).strftime('%m-%d %H:%M')
-            keyboard.append([InlineKeyboardButton(f"{order_status_label(item['status'])} | {item['order_id']} | {ts}", callback_data=f"client_order_{item['order_id']}")])
-        keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
-        await send_or_edit_menu(update, context, "📄 **我的订单（最近12条）**", InlineKeyboardMarkup(keyboard))
+    keyboard = [
+        [InlineKeyboardButton(format_plan_button_text(p), callback_data=f"order_{p['key']}_renew_{short_id}")]
+        for p in get_plan_rows()
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 返回列表", callback_data="client_status")])
+    await send_or_edit_menu(update, context, "🔄 **请选择要续费的时长：**\n(流量和时间将自动叠加)", InlineKeyboardMarkup(keyboard))
+
+
+async def _cb_order(update, context, data):
+    query = update.callback_query
+    parts = data.split("_", 3)
+    if len(parts) < 4:
+        logger.warning("Invalid order callback payload: %s", data)
+        await query.answer("参数错误，请重试", show_alert=True)
+        return
+    plan_key = parts[1]
+    order_type = parts[2]
+    if order_type == 'renew':
+        short_id = parts[3]
+    else:
+        short_id = "0"
+    
+    await show_payment_method_menu(update, context, plan_key, order_type, short_id)
+
+
+async def _cb_manualreview(update, context, data):
+    query = update.callback_query
+    parts = data.split("_", 3)
+    if len(parts) < 4:
+        logger.warning("Invalid manualreview callback payload: %s", data)
+        await query.answer("参数错误", show_alert=True)
         return
+    _, plan_key, order_type, short_id = parts
+    await handle_order_confirmation(update, context, plan_key, order_type, short_id, payment_method='manual_review')
 
-    if data.startswith("client_order_"):
-        order_id = data.replace("client_order_", "")
-        order = get_order(db_query, order_id)
-        if not order or int(order.get('tg_id', 0)) != int(user_id):
-            await send_or_edit_menu(update, context, "⚠️ 订单不存在或无权限查看", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="client_orders")]]))
-            return
-        plan = db_query("SELECT * FROM plans WHERE key = ?", (order['plan_key'],), one=True)
-        plan_name = dict(plan)['name'] if plan else order['plan_key']
-        created = datetime.datetime.fromtimestamp(int(order['created_at'])).strftime('%Y-%m-%d %H:%M')
-        lines = [
-            "📄 **订单详情**",
-            f"订单号: `{order['order_id']}`",
-            f"状态: `{order_status_label(order['status'])}`",
-            f"类型: `{ '续费' if order['order_type'] == 'renew' else '新购' }`",
-            f"套餐: `{plan_name}`",
-            f"渠道: `{order.get('channel_code') or '-'}`",
-            f"创建时间: `{created}`",
-        ]
-        if order.get('delivered_uuid'):
-            lines.append(f"发货UUID: `{order['delivered_uuid']}`")
-        if order.get('error_message'):
-            lines.append(f"失败原因: `{order['error_message']}`")
-        kb = []
-        if order['status'] == STATUS_PENDING:
-            kb.append([InlineKeyboardButton("❌ 取消该订单", callback_data=f"client_order_cancel_{order['order_id']}")])
-        kb.append([InlineKeyboardButton("🔙 返回订单列表", callback_data="client_orders")])
-        await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup(kb))
+
+async def _cb_paymethod(update, context, data):
+    query = update.callback_query
+    parts = data.split("_", 4)
+    if len(parts) < 5:
+        logger.warning("Invalid paymethod callback payload: %s", data)
+        await query.answer("参数错误", show_alert=True)
         return
+    _, pay_method, plan_key, order_type, short_id = parts
+    if pay_method != "usdt":
+        await query.answer("当前客户端仅支持 人工审核 / USDT。", show_alert=True)
+        return
+    await handle_order_confirmation(update, context, plan_key, order_type, short_id, payment_method='usdt')
 
-    if data == "client_buy_new":
-        keyboard = []
-        plans = db_query("SELECT * FROM plans")
-        for p in plans:
-            p_dict = dict(p) 
-            strategy = p_dict.get('reset_strategy', 'NO_RESET')
-            strategy_label = get_strategy_label(strategy)
-            btn_text = f"{p_dict['name']} | ¥{p_dict['price']} / {get_plan_price(p_dict, 'usdt')} | {p_dict['gb']}G ({strategy_label})"
-            action = f"order_{p_dict['key']}_new_0"
-            keyboard.append([InlineKeyboardButton(btn_text, callback_data=action)])
-        keyboard.append([InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")])
-        await send_or_edit_menu(update, context, "🛒 **请选择新购套餐：**", InlineKeyboardMarkup(keyboard))
-
-    elif data == "client_status":
-        subs = db_query("SELECT * FROM subscriptions WHERE tg_id = ?", (user_id,))
-        if not subs:
-            panel_user = await get_user_by_telegram_id(user_id)
-            synced_uuid = ensure_local_subscription_sync(user_id, panel_user)
-            if synced_uuid:
-                append_ops_timeline('数据修复', '按TG ID自动补齐订阅映射', f'tg_id={user_id},uuid={synced_uuid}', actor='system')
-                subs = db_query("SELECT * FROM subscriptions WHERE tg_id = ?", (user_id,))
-        if not subs:
-            await send_or_edit_menu(update, context, "❌ 您名下没有订阅。\n请点击“购买新订阅”。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
-            return
-        try: await query.edit_message_text("🔄 正在加载订阅列表...")
-        except Exception as exc:
-            logger.debug("failed to delete view_sub message: %s", exc)
-        tasks = [get_panel_user(sub['uuid']) for sub in subs]
-        results = await asyncio.gather(*tasks)
-        keyboard = []
-        valid_count = 0
-        for i, info in enumerate(results):
-            sub_db = subs[i]
-            if not info: continue
-            valid_count += 1
-            limit = info.get('trafficLimitBytes', 0)
-            used = info.get('userTraffic', {}).get('usedTrafficBytes', 0)
-            remain_gb = round((limit - used) / (1024**3), 1)
-            sid = get_short_id(sub_db['uuid'])
-            btn_text = f"📦 订阅 #{valid_count} | 剩余 {remain_gb} GB"
-            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_sub_{sid}")])
-        if valid_count == 0:
-            panel_user = await get_user_by_telegram_id(user_id)
-            synced_uuid = ensure_local_subscription_sync(user_id, panel_user)
-            if synced_uuid:
-                info = await get_panel_user(synced_uuid)
-                if info:
-                    limit = info.get('trafficLimitBytes', 0)
-                    used = info.get('userTraffic', {}).get('usedTrafficBytes', 0)
-                    remain_gb = round((limit - used) / (1024**3), 1)
-                    sid = get_short_id(synced_uuid)
-                    keyboard = [[InlineKeyboardButton(f"📦 订阅 #1 | 剩余 {remain_gb} GB", callback_data=f"view_sub_{sid}")], [InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")]]
-                    append_ops_timeline('数据修复', '按TG ID恢复订阅入口', f'tg_id={user_id},uuid={synced_uuid}', actor='system')
-                    await send_or_edit_menu(update, context, "👤 **我的订阅列表**\n请点击下方按钮查看详情：", InlineKeyboardMarkup(keyboard))
-                    return
-            await send_or_edit_menu(update, context, "⚠️ 您的所有订阅似乎都已失效。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
-            return
-        keyboard.append([InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")])
-        await send_or_edit_menu(update, context, "👤 **我的订阅列表**\n请点击下方按钮查看详情：", InlineKeyboardMarkup(keyboard))
-
-    elif data.startswith("view_sub_"):
-        short_id = data.split("_")[2]
-        target_uuid = get_real_uuid(short_id)
-        if not target_uuid:
-            await query.answer("❌ 按钮已过期")
-            return
-        await query.answer("🔄 加载详情中...")
-        try: await query.delete_message()
-        except Exception as exc:
-            logger.debug("delete stale sub detail message failed: %s", exc)
-        info = await get_panel_user(target_uuid)
-        if not info:
-            await context.bot.send_message(user_id, "⚠️ 此订阅已被删除。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回列表", callback_data="client_status")]]))
-            return
-        expire_show = format_time(info.get('expireAt'))
-        limit = info.get('trafficLimitBytes', 0)
-        used = info.get('userTraffic', {}).get('usedTrafficBytes', 0)
-        limit_gb = round(limit / (1024**3), 2)
-        remain_gb = round((limit - used) / (1024**3), 2)
-        sub_url = info.get('subscriptionUrl', '无链接')
-        progress = draw_progress_bar(used, limit)
-        strategy = info.get('trafficLimitStrategy', 'NO_RESET')
-        strategy_label = get_strategy_label(strategy)
-        caption = (f"📃 **订阅详情**\n\n📊 流量：`{progress}`\n🔋 剩余：`{remain_gb} GB` / `{limit_gb} GB ({strategy_label})`\n⏳ 到期：`{expire_show}`\n🔗 订阅链接：\n`{sub_url}`")
-        sid = get_short_id(target_uuid)
-        keyboard = [[InlineKeyboardButton(f"💳 续费此订阅", callback_data=f"selrenew_{sid}")], [InlineKeyboardButton("🔙 返回列表", callback_data="client_status")]]
-        if sub_url and sub_url.startswith('http'):
-            qr_bio = generate_qr(sub_url)
-            await context.bot.send_photo(chat_id=user_id, photo=qr_bio, caption=caption, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            await context.bot.send_message(chat_id=user_id, text=caption, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
-    elif data.startswith("selrenew_"):
-        short_id = data.split("_")[1]
-        target_uuid = get_real_uuid(short_id)
-        if not target_uuid:
-            await query.answer("❌ 信息过期")
-            return
-        
-        sub_record = db_query("SELECT * FROM subscriptions WHERE uuid = ?", (target_uuid,), one=True)
-        original_plan_key = None
-        if sub_record:
-            sub_dict = dict(sub_record)
-            original_plan_key = sub_dict.get('plan_key')
-        
-        if original_plan_key:
-            plan = db_query("SELECT * FROM plans WHERE key = ?", (original_plan_key,), one=True)
-            if plan:
-                await show_payment_method_menu(update, context, original_plan_key, 'renew', short_id)
-                return
+async def aget_pending_order_for_user(user_id):
+    now = time.monotonic()
+    if _no_pending_order_until.get(user_id, 0.0) > now:
+        return None
+    invalidations = _pending_order_invalidations
+    order = await asyncio.to_thread(get_pending_order_for_user, db_query, user_id)
+    # 查询期间若有新订单创建，本次“没有”的结果可能已过时，不写入缓存
+    if order is None and invalidations == _pending_order_invalidations:
+        if len(_no_pending_order_until) >= MAX_NO_PENDING_ORDER_ENTRIES:
+            _no_pending_order_until.clear()
+        _no_pending_order_until[user_id] = now + NO_PENDING_ORDER_CACHE_TTL_SECONDS
+    return order
+
+
+def invalidate_pending_order_cache(user_id):
+    global _pending_order_invalidations
+    _pending_order_invalidations += 1
+    _no_pending_order_until.pop(user_id, None)
+
+
+async def _cb_cancel_order(update, context, data):
+    user_id = update.callback_query.from_user.id
+    pending = await aget_pending_order_for_user(user_id)
+    if pending:
+        await asyncio.to_thread(update_order_status, db_execute, pending['order_id'], [STATUS_PENDING], STATUS_REJECTED, error_message='cancelled_by_user')
+    context.user_data.pop('pending_payment_proof', None)
+    await start(update, context)
+
+
+_CLIENT_EXACT_HANDLERS = {
+    "back_home": _cb_back_home,
+    "client_nodes": _cb_client_nodes,
+    "contact_support": _cb_contact_support,
+    "client_pay_done_upload": _cb_client_pay_done_upload,
+    "client_orders": _cb_client_orders,
+    "client_buy_new": _cb_client_buy_new,
+    "client_status": _cb_client_status,
+    "cancel_order": _cb_cancel_order,
+}
+_CLIENT_PREFIX_HANDLERS = build_prefix_table({
+    "client_order_cancel_": _cb_client_order_cancel,
+    "client_order_": _cb_client_order,
+    "view_sub_": _cb_view_sub,
+    "selrenew_": _cb_selrenew,
+    "order_": _cb_order,
+    "manualreview_": _cb_manualreview,
+    "paymethod_": _cb_paymethod,
+})
 
-        keyboard = []
-        plans = db_query("SELECT * FROM plans")
-        for p in plans:
-            p_dict = dict(p)
-            strategy = p_dict.get('reset_strategy', 'NO_RESET')
-            strategy_label = get_strategy_label(strategy)
-            btn_text = f"{p_dict['name']} | ¥{p_dict['price']} / {get_plan_price(p_dict, 'usdt')} | {p_dict['gb']}G ({strategy_label})"
-            action = f"order_{p_dict['key']}_renew_{short_id}"
-            keyboard.append([InlineKeyboardButton(btn_text, callback_data=action)])
-        keyboard.append([InlineKeyboardButton("🔙 返回列表", callback_data="client_status")])
-        await send_or_edit_menu(update, context, "🔄 **请选择要续费的时长：**\n(流量和时间将自动叠加)", InlineKeyboardMarkup(keyboard))
-
-    elif data.startswith("order_"):
-        parts = data.split("_")
-        if len(parts) < 4:
-            logger.warning("Invalid order callback payload: %s", data)
-            await query.answer("参数错误，请重试", show_alert=True)
-            return
-        plan_key = parts[1]
-        order_type = parts[2]
-        if order_type == 'renew':
-            short_id = parts[3]
-        else:
-            short_id = "0"
-        
-        await show_payment_method_menu(update, context, plan_key, order_type, short_id)
-
-    elif data.startswith("manualreview_"):
-        parts = data.split("_", 3)
-        if len(parts) < 4:
-            logger.warning("Invalid manualreview callback payload: %s", data)
-            await query.answer("参数错误", show_alert=True)
-            return
-        _, plan_key, order_type, short_id = parts
-        await handle_order_confirmation(update, context, plan_key, order_type, short_id, payment_method='manual_review')
-
-    elif data.startswith("paymethod_"):
-        parts = data.split("_", 4)
-        if len(parts) < 5:
-            logger.warning("Invalid paymethod callback payload: %s", data)
-            await query.answer("参数错误", show_alert=True)
-            return
-        _, pay_method, plan_key, order_type, short_id = parts
-        if pay_method != "usdt":
-            await query.answer("当前客户端仅支持 人工审核 / USDT。", show_alert=True)
-            return
-        await handle_order_confirmation(update, context, plan_key, order_type, short_id, payment_method='usdt')
 
-    elif data == "cancel_order":
-        pending = get_pending_order_for_user(db_query, user_id)
-        if pending:
-            update_order_status(db_execute, pending['order_id'], [STATUS_PENDING], STATUS_REJECTED, error_message='cancelled_by_user')
-        context.user_data.pop('pending_payment_proof', None)
-        await start(update, context)
+async def client_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not check_cooldown(query.from_user.id):
+        await query.answer("⏳ 操作太快了...", show_alert=False)
+        return
+    await query.answer()
+    data = query.data
+    handler = resolve_callback_handler(data, _CLIENT_EXACT_HANDLERS, _CLIENT_PREFIX_HANDLERS)
+    if handler is not None:
+        await handler(update, context, data)
+
 
 async def show_payment_method_menu(update, context, plan_key, order_type, short_id):
-    plan = db_query("SELECT * FROM plans WHERE key = ?", (plan_key,), one=True)
+    plan = get_plan_row(plan_key)
     if not plan:
-        await send_or_edit_menu(update, context, "⚠️ 套餐不存在或已下架，请返回重新选择。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
+        await send_or_edit_menu(update, context, "⚠️ 套餐不存在或已下架，请返回重新选择。", BACK_HOME_KB)
         return
     plan_dict = dict(plan)
 
@@ -1155,12 +1753,19 @@ async def telegram_error_handler(update: object, context: ContextTypes.DEFAULT_T
         return
     logger.exception("Unhandled telegram update exception: %s", err)
 
+def record_manual_review_submission(order_id, user_id, proof_type, admin_message_id, payment_text):
+    # 审计、管理员消息与支付说明在同一次线程切换内写完
+    append_order_audit_log(db_execute, order_id, 'submit_manual_review', user_id, f"proof_type={proof_type}")
+    attach_admin_message(db_execute, order_id, admin_message_id)
+    attach_payment_text(db_execute, order_id, payment_text)
+
+
 async def submit_manual_review_proof(update: Update, context: ContextTypes.DEFAULT_TYPE, pending_order: dict, proof: dict):
     user_id = int(pending_order['tg_id'])
     order_id = pending_order['order_id']
-    plan = db_query("SELECT * FROM plans WHERE key = ?", (pending_order['plan_key'],), one=True)
+    plan = get_plan_row(pending_order['plan_key'])
     if not plan:
-        update_order_status(db_execute, order_id, [STATUS_PENDING], STATUS_FAILED, error_message='plan_deleted')
+        await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_PENDING], STATUS_FAILED, error_message='plan_deleted')
         await update.message.reply_text("❌ 套餐已失效，订单已关闭，请重新下单。")
         return
 
@@ -1206,14 +1811,16 @@ async def submit_manual_review_proof(update: Update, context: ContextTypes.DEFAU
         await update.message.reply_text("⚠️ 未识别的凭证格式，请发送文字、图片或文件。")
         return
 
-    append_order_audit_log(db_execute, order_id, 'submit_manual_review', user_id, f"proof_type={proof_type}")
-    attach_admin_message(db_execute, order_id, admin_message.message_id)
-    attach_payment_text(db_execute, order_id, f"方式:{selected_path_label}|{proof_text}")
+    await asyncio.to_thread(
+        record_manual_review_submission, order_id, user_id, proof_type, admin_message.message_id, f"方式:{selected_path_label}|{proof_text}"
+    )
+    # 支付路径已写入 payment_text，凭证提交后不再需要内存中的记录
+    order_payment_method_cache.pop(order_id, None)
     context.user_data.pop('pending_payment_proof', None)
     context.user_data.pop('awaiting_manual_review_proof_order_id', None)
     await update.message.reply_text(
         "✅ 已提交人工审核，请等待管理员处理。",
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")]]),
+        reply_markup=RETURN_HOME_KB,
     )
 
 
@@ -1231,7 +1838,7 @@ async def handle_order_confirmation(update, context, plan_key, order_type, short
     user_id = update.effective_user.id
     target_uuid = get_real_uuid(short_id) if short_id != "0" else "0"
 
-    plan = db_query("SELECT * FROM plans WHERE key = ?", (plan_key,), one=True)
+    plan = get_plan_row(plan_key)
     if not plan:
         return
 
@@ -1244,16 +1851,19 @@ async def handle_order_confirmation(update, context, plan_key, order_type, short
     if update.callback_query and update.callback_query.message:
         msg_id = update.callback_query.message.message_id
 
-    order, created = create_order(db_query, db_execute, user_id, plan_key, order_type, target_uuid, menu_message_id=msg_id, channel_code=context.user_data.get('channel_code'))
+    # concurrent_updates 开启后，同一用户的下单需串行，避免重复创建订单
+    async with _user_order_lock(context.application, user_id):
+        order, created = await asyncio.to_thread(create_order, db_query, db_execute, user_id, plan_key, order_type, target_uuid, menu_message_id=msg_id, channel_code=context.user_data.get('channel_code'))
+        invalidate_pending_order_cache(user_id)
     if created:
-        append_order_audit_log(db_execute, order['order_id'], 'create', user_id, f"type={order_type};plan={plan_key};channel={context.user_data.get('channel_code') or '-'}")
+        await asyncio.to_thread(append_order_audit_log, db_execute, order['order_id'], 'create', user_id, f"type={order_type};plan={plan_key};channel={context.user_data.get('channel_code') or '-'}")
         selected_path = "usdt" if payment_method == "usdt" else "manual_review"
-        order_payment_method_cache[order["order_id"]] = selected_path
+        remember_order_payment_method(order["order_id"], selected_path)
         context.user_data['awaiting_manual_review_proof_order_id'] = order['order_id']
         context.user_data.pop('pending_payment_proof', None)
     else:
         msg = "⚠️ 你已有一个待审核订单，请先等待管理员处理，或取消后重新下单。"
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
+        await send_or_edit_menu(update, context, msg, BACK_HOME_KB)
         return
     path_label = "USDT" if payment_method == "usdt" else "人工审核"
     extra_tip = "👇 请直接在聊天中发送支付凭证（文字说明、截图、图片或文件），发送后会自动提交人工审核。"
@@ -1262,7 +1872,7 @@ async def handle_order_confirmation(update, context, plan_key, order_type, short
         usdt_info = resolve_payment_state('usdt')
         usdt_price = str(plan_dict.get('usdt_price') or '').strip()
         if not usdt_info['available'] or not usdt_price:
-            await send_or_edit_menu(update, context, "⚠️ 当前 USDT 未配置完整，请选择人工审核。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
+            await send_or_edit_menu(update, context, "⚠️ 当前 USDT 未配置完整，请选择人工审核。", BACK_HOME_KB)
             return
         usdt_network = (get_setting_value('usdt_network', 'TRC20') or 'TRC20').strip().upper()
         usdt_address = (get_setting_value('usdt_address', '') or '').strip()
@@ -1275,16 +1885,16 @@ async def handle_order_confirmation(update, context, plan_key, order_type, short
             f"{tip_body}\n\n"
             "👇 完成后请发送 TXID/截图/说明，发送后会自动提交人工审核。"
         )
-    msg = (
-        f"📝 **订单已创建**\n"
-        f"🆔 订单号：`{order['order_id']}`\n"
-        f"📦 套餐：{plan_dict['name']}\n"
-        f"💰 金额：**{plan_dict.get('price')}**\n"
-        f"📡 流量：**{plan_dict['gb']} GB ({strategy_label})**\n"
-        f"🧩 类型：**{type_str}**\n"
-        f"🧾 路径：**{path_label}**\n\n"
-        f"🆔 系统将自动使用当前 Telegram ID：`{user_id}`\n"
-        f"{extra_tip}"
+    msg = _ORDER_CONFIRM_TMPL.format(
+        order_id=order['order_id'],
+        plan_name=plan_dict['name'],
+        price=plan_dict.get('price'),
+        gb=plan_dict['gb'],
+        strategy=strategy_label,
+        type_str=type_str,
+        path_label=path_label,
+        user_id=user_id,
+        extra_tip=extra_tip,
     )
     kb = [[InlineKeyboardButton("❌ 取消订单", callback_data="cancel_order")], [InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")]]
     await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
@@ -1305,43 +1915,48 @@ async def handle_order_confirmation(update, context, plan_key, order_type, short
             logger.warning("failed to send usdt qr image: user=%s order=%s err=%s", user_id, order['order_id'], exc)
 
 async def show_plans_menu(update, context):
-    plans = db_query("SELECT * FROM plans")
-    keyboard = []
-    for p in plans:
-        p_dict = dict(p)
-        btn_text = f"{p_dict['name']} | ¥{p_dict['price']} / {get_plan_price(p_dict, 'usdt')} | {p_dict['gb']}G"
-        keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"plan_detail_{p_dict['key']}")])
+    keyboard = [
+        [InlineKeyboardButton(format_plan_button_text(p, with_strategy=False), callback_data=f"plan_detail_{p['key']}")]
+        for p in get_plan_rows()
+    ]
     keyboard.append([InlineKeyboardButton("➕ 添加新套餐", callback_data="add_plan_start")])
     keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
     await send_or_edit_menu(update, context, "📦 **套餐管理**\n点击套餐查看详情或删除。", InlineKeyboardMarkup(keyboard))
 
 async def reschedule_anomaly_job(application, interval_hours):
     try:
+        interval_seconds = float(interval_hours) * 3600
         current_jobs = application.job_queue.get_jobs_by_name('check_anomalies_job')
+        # 周期未变化时保留现有任务，避免同一检测被重复排期
+        if len(current_jobs) == 1 and (current_jobs[0].data or {}).get('interval') == interval_seconds:
+            return
         for job in current_jobs:
             job.schedule_removal()
-        interval_seconds = float(interval_hours) * 3600
-        application.job_queue.run_repeating(check_anomalies_job, interval=interval_seconds, first=10, name='check_anomalies_job')
+        application.job_queue.run_repeating(check_anomalies_job, interval=interval_seconds, first=10, name='check_anomalies_job', data={'interval': interval_seconds})
     except Exception as e:
         logger.error(f"Reschedule failed: {e}")
 
 
 
-async def show_orders_menu(update, context, status_filter=None, page=0):
+async def show_orders_menu(update, context, status_filter=None, page=0, cursor=None):
+    # cursor=(方向, created_at, id)：'n' 取锚点之后（更早）的一页，'p' 取锚点之前（更新）的一页
     page = max(int(page or 0), 0)
     page_size = 20
-    offset = page * page_size
 
-    if status_filter:
-        rows = db_query("SELECT * FROM orders WHERE status = ? ORDER BY created_at DESC LIMIT ? OFFSET ?", (status_filter, page_size, offset))
-        total_row = db_query("SELECT COUNT(*) AS c FROM orders WHERE status=?", (status_filter,), one=True)
-        total = int(total_row['c']) if total_row else 0
-        title = f"🧾 **订单审计 - {order_status_label(status_filter)}**"
+    where_sql, where_args = ("WHERE status = ?", (status_filter,)) if status_filter else ("", ())
+    if cursor:
+        direction, anchor_ts, anchor_id = cursor
+        keyset_sql = f"{where_sql} {'AND' if where_sql else 'WHERE'} (created_at, id) {'<' if direction == 'n' else '>'} (?, ?)"
+        order_sql = "created_at DESC, id DESC" if direction == 'n' else "created_at ASC, id ASC"
+        rows = await adb_query(f"SELECT * FROM orders {keyset_sql} ORDER BY {order_sql} LIMIT ?", (*where_args, anchor_ts, anchor_id, page_size))
+        if direction != 'n':
+            rows = rows[::-1]
     else:
-        rows = db_query("SELECT * FROM orders ORDER BY created_at DESC LIMIT ? OFFSET ?", (page_size, offset))
-        total_row = db_query("SELECT COUNT(*) AS c FROM orders", one=True)
-        total = int(total_row['c']) if total_row else 0
-        title = "🧾 **订单审计 - 最近订单**"
+        # 旧版按钮只带页码，仍按 OFFSET 兼容
+        rows = await adb_query(f"SELECT * FROM orders {where_sql} ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?", (*where_args, page_size, page * page_size))
+    total_row = await adb_query(f"SELECT COUNT(*) AS c FROM orders {where_sql}", where_args, one=True)
+    total = int(total_row['c']) if total_row else 0
+    title = f"🧾 **订单审计 - {order_status_label(status_filter)}**" if status_filter else "🧾 **订单审计 - 最近订单**"
 
     total_pages = max((total + page_size - 1) // page_size, 1)
     current_page = min(page + 1, total_pages)
@@ -1349,11 +1964,10 @@ async def show_orders_menu(update, context, status_filter=None, page=0):
 
     keyboard = []
     for row in rows:
-        item = dict(row)
         keyboard.append([
             InlineKeyboardButton(
-                format_order_row(item),
-                callback_data=f"admin_order_{item['order_id']}",
+                format_order_row(row),
+                callback_data=f"admin_order_{row['order_id']}",
             )
         ])
 
@@ -1371,10 +1985,13 @@ async def show_orders_menu(update, context, status_filter=None, page=0):
     ])
 
     nav = []
-    if page > 0:
-        nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"admin_orders_page_{status_filter or 'all'}_{page-1}"))
-    if page + 1 < total_pages:
-        nav.append(InlineKeyboardButton("➡️ 下一页", callback_data=f"admin_orders_page_{status_filter or 'all'}_{page+1}"))
+    status_key = status_filter or 'all'
+    if page > 0 and rows:
+        first = rows[0]
+        nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"admin_orders_page_{status_key}_{page-1}_p_{first['created_at']}_{first['id']}"))
+    if page + 1 < total_pages and rows:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton("➡️ 下一页", callback_data=f"admin_orders_page_{status_key}_{page+1}_n_{last['created_at']}_{last['id']}"))
     if nav:
         keyboard.append(nav)
 
@@ -1382,1111 +1999,1442 @@ async def show_orders_menu(update, context, status_filter=None, page=0):
     await send_or_edit_menu(update, context, title, InlineKeyboardMarkup(keyboard))
 
 
-async def show_anomaly_whitelist_menu(update, context):
-    rows = db_query("SELECT * FROM anomaly_whitelist ORDER BY created_at DESC LIMIT 20")
-    keyboard = [[InlineKeyboardButton("➕ 添加UUID", callback_data="anomaly_whitelist_add")]]
-    for row in rows:
+async def get_anomaly_whitelist():
+    global _anomaly_whitelist
+    if _anomaly_whitelist is None:
+        rows = await adb_query("SELECT user_uuid FROM anomaly_whitelist")
+        _anomaly_whitelist = frozenset(r['user_uuid'] for r in rows)
+    return _anomaly_whitelist
+
+
+async def add_anomaly_whitelist(user_uuid):
+    global _anomaly_whitelist
+    # 内存集合与表保持一致，重复点击直接返回，不再争用写锁
+    if user_uuid in await get_anomaly_whitelist():
+        return
+    await adb_execute("INSERT OR IGNORE INTO anomaly_whitelist (user_uuid, created_at) VALUES (?, ?)", (user_uuid, int(time.time())))
+    _anomaly_whitelist = _anomaly_whitelist | {user_uuid}
+
+
+async def remove_anomaly_whitelist(user_uuid):
+    global _anomaly_whitelist
+    if user_uuid not in await get_anomaly_whitelist():
+        return
+    await adb_execute("DELETE FROM anomaly_whitelist WHERE user_uuid = ?", (user_uuid,))
+    _anomaly_whitelist = _anomaly_whitelist - {user_uuid}
+
+
+async def show_anomaly_whitelist_menu(update, context):
+    rows = await adb_query("SELECT * FROM anomaly_whitelist ORDER BY created_at DESC LIMIT 20")
+    keyboard = [[InlineKeyboardButton("➕ 添加UUID", callback_data="anomaly_whitelist_add")]]
+    for row in rows:
         item = dict(row)
         short = item['user_uuid'][:10]
         keyboard.append([InlineKeyboardButton(f"❌ 删除 {short}...", callback_data=f"anomaly_whitelist_del_{item['user_uuid']}")])
     keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="admin_anomaly_menu")])
     await send_or_edit_menu(update, context, "📋 **异常检测白名单**", InlineKeyboardMarkup(keyboard))
 
-async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _cb_reply_user(update, context, data):
     query = update.callback_query
-    await query.answer()
-    data = query.data
+    raw = data.removeprefix("reply_user_")
+    if "_" in raw:
+        uid_part, back_cb = raw.split("_", 1)
+    else:
+        uid_part, back_cb = raw, "back_home"
+    target_uid = int(uid_part)
+    await cleanup_admin_reply_prompt(context, query.from_user.id, context.user_data, reason='enter_new_reply_mode')
+    context.user_data['reply_to_uid'] = target_uid
+    context.user_data['reply_back_cb'] = back_cb
+    logger.info("admin enter send-to-user mode: admin=%s target_user=%s back_cb=%s", query.from_user.id, target_uid, back_cb)
+    cancel_kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回上一页", callback_data=back_cb)]])
+    prompt_msg = await query.message.reply_text(f"✍️ 请输入回复给用户 `{target_uid}` 的内容 (文字/图片)：", parse_mode='Markdown', reply_markup=cancel_kb)
+    context.user_data['reply_prompt_message_id'] = prompt_msg.message_id
+
+
+async def _cb_cancel_op(update, context, data):
+    context.user_data.clear()
+    await start(update, context)
+
+
+async def _cb_admin_panel_config(update, context, data):
+    context.user_data.pop('panelcfg_prompt_message_id', None)
+    masked = PANEL_TOKEN[:6] + "***" if PANEL_TOKEN else "未配置"
+    msg = _PANEL_CONFIG_TMPL.format(
+        url=PANEL_URL or '未配置',
+        token=masked,
+        sub_domain=SUB_DOMAIN or '未配置',
+        group=TARGET_GROUP_UUID or '未配置',
+        verify_tls=PANEL_VERIFY_TLS,
+    )
+    await send_or_edit_menu(update, context, msg, PANEL_CONFIG_KB)
 
-    # 只要离开“回复输入模式”，就清理回复上下文，避免串场
-    if not data.startswith("reply_user_"):
-        if 'reply_to_uid' in context.user_data:
-            logger.info("admin reply mode cleared by callback: admin=%s callback=%s", query.from_user.id, data)
-        await cleanup_admin_reply_prompt(context, query.from_user.id, context.user_data, reason=f'callback:{data}')
-        context.user_data.pop('reply_to_uid', None)
-        context.user_data.pop('reply_back_cb', None)
-    
-    if data == "back_home":
-        await start(update, context)
-        return
 
-    if data.startswith("reply_user_"):
-        raw = data.replace("reply_user_", "", 1)
-        if "_" in raw:
-            uid_part, back_cb = raw.split("_", 1)
-        else:
-            uid_part, back_cb = raw, "back_home"
-        target_uid = int(uid_part)
-        await cleanup_admin_reply_prompt(context, query.from_user.id, context.user_data, reason='enter_new_reply_mode')
-        context.user_data['reply_to_uid'] = target_uid
-        context.user_data['reply_back_cb'] = back_cb
-        logger.info("admin enter send-to-user mode: admin=%s target_user=%s back_cb=%s", query.from_user.id, target_uid, back_cb)
-        cancel_kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回上一页", callback_data=back_cb)]])
-        prompt_msg = await query.message.reply_text(f"✍️ 请输入回复给用户 `{target_uid}` 的内容 (文字/图片)：", parse_mode='Markdown', reply_markup=cancel_kb)
-        context.user_data['reply_prompt_message_id'] = prompt_msg.message_id
-        return
-    if data == "cancel_op":
-        context.user_data.clear()
-        await start(update, context)
-        return
-    if data == "admin_panel_config":
-        context.user_data.pop('panelcfg_prompt_message_id', None)
-        masked = PANEL_TOKEN[:6] + "***" if PANEL_TOKEN else "未配置"
-        msg = (
-            "🔌 **面板对接配置**\n"
-            f"面板地址: `{PANEL_URL or '未配置'}`\n"
-            f"面板Token: `{masked}`\n"
-            f"订阅域名: `{SUB_DOMAIN or '未配置'}`\n"
-            f"默认组UUID: `{TARGET_GROUP_UUID or '未配置'}`\n"
-            f"TLS校验: `{PANEL_VERIFY_TLS}`\n"
-            "\n"
-            "首次安装只需机器人信息，面板参数可在这里随时修改。"
-        )
-        kb = [
-            [InlineKeyboardButton("🌐 设置面板地址", callback_data="panelcfg_set_url")],
-            [InlineKeyboardButton("🔑 设置面板Token", callback_data="panelcfg_set_token")],
-            [InlineKeyboardButton("🔗 设置订阅域名", callback_data="panelcfg_set_subdomain")],
-            [InlineKeyboardButton("🧩 设置默认组UUID", callback_data="panelcfg_set_group")],
-            [InlineKeyboardButton("🔒 切换TLS校验", callback_data="panelcfg_toggle_tls")],
-            [InlineKeyboardButton("🔙 返回", callback_data="back_home")],
-        ]
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
-        return
-    if data in {"panelcfg_set_url", "panelcfg_set_token", "panelcfg_set_subdomain", "panelcfg_set_group"}:
-        mode_map = {
-            "panelcfg_set_url": ("panelcfg_input_url", "请输入面板地址（例如 https://panel.com ）"),
-            "panelcfg_set_token": ("panelcfg_input_token", "请输入面板 API Token"),
-            "panelcfg_set_subdomain": ("panelcfg_input_subdomain", "请输入订阅域名（例如 https://sub.com ）"),
-            "panelcfg_set_group": ("panelcfg_input_group", "请输入默认用户组 UUID"),
-        }
-        key, tip = mode_map[data]
-        context.user_data[key] = True
-        if query.message:
-            context.user_data['panelcfg_prompt_message_id'] = query.message.message_id
-        await send_or_edit_menu(update, context, f"✍️ {tip}", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_panel_config")]]))
-        return
-    if data == "panelcfg_toggle_tls":
-        new_val = not PANEL_VERIFY_TLS
-        save_runtime_config(panel_verify_tls=new_val)
-        append_ops_timeline('配置', '切换TLS校验', f'panel_verify_tls={new_val}', actor=query.from_user.id)
-        await query.answer(f"已切换为 {new_val}", show_alert=True)
-        await send_or_edit_menu(update, context, "✅ TLS 配置已更新。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_panel_config")]]))
-        return
-    if data == "admin_template_center":
-        builtins = get_builtin_templates()
-        rows = db_query("SELECT * FROM ops_templates ORDER BY created_at DESC LIMIT 8")
-        kb = [
-            [InlineKeyboardButton("⚡ 严格风控模板", callback_data="tpl_apply_tpl_strict"), InlineKeyboardButton("⚖️ 稳定运营模板", callback_data="tpl_apply_tpl_stable")],
-            [InlineKeyboardButton("📈 增长推广模板", callback_data="tpl_apply_tpl_growth")],
-            [InlineKeyboardButton("💾 保存当前为自定义模板", callback_data="tpl_save_current")],
-        ]
-        for r in rows:
-            it = dict(r)
-            kb.append([InlineKeyboardButton(f"📌 应用自定义模板 #{it['id']} {it['name']}", callback_data=f"tpl_apply_saved_{it['id']}")])
-        kb.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
-        msg = "🧩 **模板中心**\n可将多个运营设置打包为流程模板，一键应用。"
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
-        return
-    if data == "tpl_save_current":
-        payload = {
-            'settings': {
-                'risk_enforce_mode': get_setting_value('risk_enforce_mode', 'enforce'),
-                'risk_low_score': get_setting_value('risk_low_score', '80'),
-                'risk_high_score': get_setting_value('risk_high_score', '130'),
-                'anomaly_interval': get_setting_value('anomaly_interval', '1'),
-            }
+async def _cb_panelcfg_set_input(update, context, data):
+    query = update.callback_query
+    mode_map = {
+        "panelcfg_set_url": ("panelcfg_input_url", "请输入面板地址（例如 https://panel.com ）"),
+        "panelcfg_set_token": ("panelcfg_input_token", "请输入面板 API Token"),
+        "panelcfg_set_subdomain": ("panelcfg_input_subdomain", "请输入订阅域名（例如 https://sub.com ）"),
+        "panelcfg_set_group": ("panelcfg_input_group", "请输入默认用户组 UUID"),
+    }
+    key, tip = mode_map[data]
+    context.user_data[key] = True
+    if query.message:
+        context.user_data['panelcfg_prompt_message_id'] = query.message.message_id
+    await send_or_edit_menu(update, context, f"✍️ {tip}", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_panel_config")]]))
+
+
+async def _cb_panelcfg_toggle_tls(update, context, data):
+    query = update.callback_query
+    new_val = not PANEL_VERIFY_TLS
+    save_runtime_config(panel_verify_tls=new_val)
+    await asyncio.to_thread(append_ops_timeline, '配置', '切换TLS校验', f'panel_verify_tls={new_val}', actor=query.from_user.id)
+    await query.answer(f"已切换为 {new_val}", show_alert=True)
+    await send_or_edit_menu(update, context, "✅ TLS 配置已更新。", PANEL_CONFIG_BACK_KB)
+
+
+async def _cb_admin_template_center(update, context, data):
+    rows = await adb_query("SELECT * FROM ops_templates ORDER BY created_at DESC LIMIT 8")
+    kb = [
+        [InlineKeyboardButton("⚡ 严格风控模板", callback_data="tpl_apply_tpl_strict"), InlineKeyboardButton("⚖️ 稳定运营模板", callback_data="tpl_apply_tpl_stable")],
+        [InlineKeyboardButton("📈 增长推广模板", callback_data="tpl_apply_tpl_growth")],
+        [InlineKeyboardButton("💾 保存当前为自定义模板", callback_data="tpl_save_current")],
+    ]
+    for r in rows:
+        it = dict(r)
+        kb.append([InlineKeyboardButton(f"📌 应用自定义模板 #{it['id']} {it['name']}", callback_data=f"tpl_apply_saved_{it['id']}")])
+    kb.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
+    msg = "🧩 **模板中心**\n可将多个运营设置打包为流程模板，一键应用。"
+    await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
+
+
+async def _cb_tpl_save_current(update, context, data):
+    query = update.callback_query
+    payload = {
+        'settings': {
+            'risk_enforce_mode': get_setting_value('risk_enforce_mode', 'enforce'),
+            'risk_low_score': get_setting_value('risk_low_score', '80'),
+            'risk_high_score': get_setting_value('risk_high_score', '130'),
+            'anomaly_interval': get_setting_value('anomaly_interval', '1'),
         }
-        save_ops_template('当前运营配置', payload, query.from_user.id)
-        await query.answer("✅ 已保存模板", show_alert=True)
-        return
-    if data.startswith("tpl_apply_"):
-        key = data.replace("tpl_apply_", "")
-        if key.startswith('saved_'):
-            sid = key.replace('saved_', '')
-            row = db_query("SELECT * FROM ops_templates WHERE id=?", (sid,), one=True)
-            if not row:
-                await query.answer("模板不存在", show_alert=True)
-                return
-            payload = json.loads(dict(row).get('payload_json') or '{}')
-            apply_template_payload(payload, actor=query.from_user.id)
-            await send_or_edit_menu(
-                update,
-                context,
-                f"✅ 已应用自定义模板：{dict(row).get('name', f'#{sid}')}\n相关参数已写入设置。",
-                InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回模板中心", callback_data="admin_template_center")], [InlineKeyboardButton("🏠 返回主页", callback_data="back_home")]]),
-            )
-            return
-        builtins = get_builtin_templates()
-        tpl = builtins.get(key)
-        if not tpl:
+    }
+    await asyncio.to_thread(save_ops_template, '当前运营配置', payload, query.from_user.id)
+    await query.answer("✅ 已保存模板", show_alert=True)
+
+
+async def _cb_tpl_apply(update, context, data):
+    query = update.callback_query
+    key = data.removeprefix("tpl_apply_")
+    if key.startswith('saved_'):
+        sid = key.removeprefix('saved_')
+        row = await adb_query("SELECT * FROM ops_templates WHERE id=?", (sid,), one=True)
+        if not row:
             await query.answer("模板不存在", show_alert=True)
             return
-        apply_template_payload(tpl, actor=query.from_user.id)
+        payload = _json_loads(dict(row).get('payload_json') or '{}')
+        await asyncio.to_thread(apply_template_payload, payload, actor=query.from_user.id)
         await send_or_edit_menu(
             update,
             context,
-            f"✅ 已应用模板：{tpl.get('name', key)}\n相关参数已写入设置。",
+            f"✅ 已应用自定义模板：{dict(row).get('name', f'#{sid}')}\n相关参数已写入设置。",
             InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回模板中心", callback_data="admin_template_center")], [InlineKeyboardButton("🏠 返回主页", callback_data="back_home")]]),
         )
         return
-    if data == "admin_panel_user_lookup":
-        context.user_data['panel_user_lookup_mode'] = True
-        tip = (
-            "🔎 **面板用户检索/绑定**\n"
-            "请输入以下任一格式：\n"
-            "- `tg:123456789`（按 Telegram ID）\n"
-            "- `username:alice`（按用户名）\n"
-            "- `uuid:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx`\n"
-            "- `short:abcd1234`（短 UUID）\n"
-            "- 或直接输入纯数字（自动按 Telegram ID）。"
-        )
-        kb = [[InlineKeyboardButton("🔙 取消", callback_data="back_home")]]
-        await send_or_edit_menu(update, context, tip, InlineKeyboardMarkup(kb))
-        return
-    if data.startswith("bind_panel_user_"):
-        parts = data.split("_", 4)
-        if len(parts) < 5:
-            await query.answer("参数错误", show_alert=True)
-            return
-        _, _, _, tg_text, panel_uuid = parts
-        try:
-            target_tg_id = int(tg_text)
-        except ValueError:
-            await query.answer("TG ID 格式错误", show_alert=True)
-            return
-        exists = db_query("SELECT 1 FROM subscriptions WHERE tg_id=? AND uuid=? LIMIT 1", (target_tg_id, panel_uuid), one=True)
-        if not exists:
-            db_execute("INSERT INTO subscriptions (tg_id, uuid, created_at) VALUES (?, ?, ?)", (target_tg_id, panel_uuid, int(time.time())))
-        await send_or_edit_menu(
-            update,
-            context,
-            f"✅ 绑定完成\nTG ID: `{target_tg_id}`\nUUID: `{panel_uuid}`",
-            InlineKeyboardMarkup([[InlineKeyboardButton("🔎 继续检索", callback_data="admin_panel_user_lookup")], [InlineKeyboardButton("🏠 返回主页", callback_data="back_home")]]),
-        )
-        return
-    if data == "admin_system_dashboard":
-        health = await get_panel_system_health()
-        stats = await get_panel_system_stats()
-        recap = await get_panel_system_stats_recap()
-        lines = ["🖥 **系统面板（基础）**"]
-        if health:
-            lines.append(f"健康信息字段: `{len(health.keys())}` 项")
-            for k in list(health.keys())[:6]:
-                lines.append(f"- {k}: {str(health.get(k))[:60]}")
-        else:
-            lines.append("- ⚠️ 系统健康信息不可用（可能是配置/权限/连通性问题）")
-        if stats:
-            lines.append(f"\n统计字段: `{len(stats.keys())}` 项")
-            for k in list(stats.keys())[:8]:
-                lines.append(f"- {k}: {str(stats.get(k))[:60]}")
-        else:
-            lines.append("\n- ⚠️ /system/stats 不可用")
-        if recap:
-            lines.append(f"\nRecap字段: `{len(recap.keys())}` 项")
-            for k in list(recap.keys())[:6]:
-                lines.append(f"- {k}: {str(recap.get(k))[:60]}")
-        else:
-            lines.append("- ⚠️ /system/stats/recap 不可用")
-        await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
+    builtins = get_builtin_templates()
+    tpl = builtins.get(key)
+    if not tpl:
+        await query.answer("模板不存在", show_alert=True)
+        return
+    await asyncio.to_thread(apply_template_payload, tpl, actor=query.from_user.id)
+    await send_or_edit_menu(
+        update,
+        context,
+        f"✅ 已应用模板：{tpl.get('name', key)}\n相关参数已写入设置。",
+        InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回模板中心", callback_data="admin_template_center")], [InlineKeyboardButton("🏠 返回主页", callback_data="back_home")]]),
+    )
+
+
+async def _cb_admin_panel_user_lookup(update, context, data):
+    context.user_data['panel_user_lookup_mode'] = True
+    tip = (
+        "🔎 **面板用户检索/绑定**\n"
+        "请输入以下任一格式：\n"
+        "- `tg:123456789`（按 Telegram ID）\n"
+        "- `username:alice`（按用户名）\n"
+        "- `uuid:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx`\n"
+        "- `short:abcd1234`（短 UUID）\n"
+        "- 或直接输入纯数字（自动按 Telegram ID）。"
+    )
+    kb = [[InlineKeyboardButton("🔙 取消", callback_data="back_home")]]
+    await send_or_edit_menu(update, context, tip, InlineKeyboardMarkup(kb))
+
+
+async def _cb_bind_panel_user(update, context, data):
+    query = update.callback_query
+    parts = data.split("_", 4)
+    if len(parts) < 5:
+        await query.answer("参数错误", show_alert=True)
         return
-    if data == "admin_bulk_jobs":
-        rows = db_query("SELECT * FROM bulk_jobs ORDER BY created_at DESC LIMIT 20")
-        lines = ["🗂 **批量任务队列（最近20条）**"]
-        if not rows:
-            lines.append("暂无任务")
-        for r in rows:
-            it = dict(r)
-            ts = datetime.datetime.fromtimestamp(int(it['created_at'])).strftime('%m-%d %H:%M')
-            lines.append(f"- #{it['id']} | {it['action']} | {it['status']} | {ts}")
-        await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
+    _, _, _, tg_text, panel_uuid = parts
+    try:
+        target_tg_id = int(tg_text)
+    except ValueError:
+        await query.answer("TG ID 格式错误", show_alert=True)
+        return
+    exists = await adb_query("SELECT 1 FROM subscriptions WHERE tg_id=? AND uuid=? LIMIT 1", (target_tg_id, panel_uuid), one=True)
+    if not exists:
+        await adb_execute("INSERT INTO subscriptions (tg_id, uuid, created_at) VALUES (?, ?, ?)", (target_tg_id, panel_uuid, int(time.time())))
+    await send_or_edit_menu(
+        update,
+        context,
+        f"✅ 绑定完成\nTG ID: `{target_tg_id}`\nUUID: `{panel_uuid}`",
+        InlineKeyboardMarkup([[InlineKeyboardButton("🔎 继续检索", callback_data="admin_panel_user_lookup")], [InlineKeyboardButton("🏠 返回主页", callback_data="back_home")]]),
+    )
+
+
+async def _cb_admin_system_dashboard(update, context, data):
+    health = await get_panel_system_health()
+    stats = await get_panel_system_stats()
+    recap = await get_panel_system_stats_recap()
+    lines = ["🖥 **系统面板（基础）**"]
+    if health:
+        lines.append(f"健康信息字段: `{len(health.keys())}` 项")
+        for k in list(health.keys())[:6]:
+            lines.append(f"- {k}: {str(health.get(k))[:60]}")
+    else:
+        lines.append("- ⚠️ 系统健康信息不可用（可能是配置/权限/连通性问题）")
+    if stats:
+        lines.append(f"\n统计字段: `{len(stats.keys())}` 项")
+        for k in list(stats.keys())[:8]:
+            lines.append(f"- {k}: {str(stats.get(k))[:60]}")
+    else:
+        lines.append("\n- ⚠️ /system/stats 不可用")
+    if recap:
+        lines.append(f"\nRecap字段: `{len(recap.keys())}` 项")
+        for k in list(recap.keys())[:6]:
+            lines.append(f"- {k}: {str(recap.get(k))[:60]}")
+    else:
+        lines.append("- ⚠️ /system/stats/recap 不可用")
+    await send_or_edit_menu(update, context, "\n".join(lines), BACK_HOME_KB)
+
+
+async def _cb_admin_bulk_jobs(update, context, data):
+    rows = await adb_query("SELECT * FROM bulk_jobs ORDER BY created_at DESC LIMIT 20")
+    lines = ["🗂 **批量任务队列（最近20条）**"]
+    if not rows:
+        lines.append("暂无任务")
+    for r in rows:
+        it = dict(r)
+        ts = format_minute(it['created_at'])
+        lines.append(f"- #{it['id']} | {it['action']} | {it['status']} | {ts}")
+    await send_or_edit_menu(update, context, "\n".join(lines), BACK_HOME_KB)
+
+
+async def _cb_admin_pay_settings(update, context, data):
+    usdt_enabled = get_setting_bool("usdt_enabled", False)
+    msg = (
+        "💳 **收款设置**\n"
+        "🧾 人工审核：始终可用（用户提交凭证后人工审核）\n"
+        f"🟨 USDT：{'已开启' if usdt_enabled else '已关闭'}\n\n"
+        "请选择下方配置项。"
+    )
+    await send_or_edit_menu(update, context, msg, PAY_SETTINGS_KB)
+
+
+async def _cb_admin_pay_usdt_cfg(update, context, data):
+    usdt_enabled = get_setting_bool("usdt_enabled", False)
+    usdt_network = (get_setting_value("usdt_network", "TRC20") or "TRC20").strip().upper()
+    usdt_address = (get_setting_value("usdt_address", "") or "").strip()
+    usdt_qr = "已上传" if get_setting_value("usdt_qr_file_id") else "未上传"
+    msg = (
+        "🟨 **USDT 配置**\n"
+        f"开关：{'开启' if usdt_enabled else '关闭'}\n"
+        f"网络：`{usdt_network}`\n"
+        f"地址：`{usdt_address or '未设置'}`\n"
+        f"收款码图片：{usdt_qr}"
+    )
+    kb = [
+        [InlineKeyboardButton("🔘 切换USDT开关", callback_data="toggle_pay_usdt")],
+        [InlineKeyboardButton("🌐 设置USDT网络", callback_data="set_pay_usdt_network")],
+        [InlineKeyboardButton("🏦 设置USDT地址", callback_data="set_pay_usdt_address")],
+        [InlineKeyboardButton("⬆️ 上传USDT收款码", callback_data="set_payimg_usdt")],
+        [InlineKeyboardButton("🔙 返回收款设置", callback_data="admin_pay_settings")],
+    ]
+    await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
+
+
+async def _cb_toggle_pay_usdt(update, context, data):
+    query = update.callback_query
+    next_val = not get_setting_bool("usdt_enabled", False)
+    await aset_setting_value("usdt_enabled", "1" if next_val else "0")
+    await query.answer(f"✅ USDT已{'开启' if next_val else '关闭'}", show_alert=True)
+    await send_or_edit_menu(update, context, "✅ 已更新USDT开关。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回USDT配置", callback_data="admin_pay_usdt_cfg")]]))
+
+
+async def _cb_set_pay_usdt_network(update, context, data):
+    context.user_data['paycfg_input_usdt_network'] = True
+    await send_or_edit_menu(update, context, "✍️ 请输入 USDT 网络（例如 TRC20 / ERC20 / BEP20）", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_pay_usdt_cfg")]]))
+
+
+async def _cb_set_pay_usdt_address(update, context, data):
+    context.user_data['paycfg_input_usdt_address'] = True
+    await send_or_edit_menu(update, context, "✍️ 请输入 USDT 收款地址", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_pay_usdt_cfg")]]))
+
+
+async def _cb_admin_pay_self_check(update, context, data):
+    usdt_enabled = get_setting_bool("usdt_enabled", False)
+    usdt_address_ready = bool((get_setting_value("usdt_address", "") or '').strip())
+
+    checks = [
+        ("人工审核路径", "✅ 可用（无需额外配置）"),
+        ("USDT 开关", "✅ 开启" if usdt_enabled else "⚠️ 关闭"),
+        ("USDT 地址", "✅ 已设置" if usdt_address_ready else "⚠️ 未设置"),
+    ]
+
+    lines = ["🧪 **支付设置自检报告**", ""]
+    for name, result in checks:
+        lines.append(f"• {name}：{result}")
+
+    suggestions = []
+    if usdt_enabled and not usdt_address_ready:
+        suggestions.append("USDT 已开启，但未设置收款地址。")
+    if not usdt_enabled:
+        suggestions.append("USDT 未开启；客户端将仅显示人工审核路径。")
+
+    if suggestions:
+        lines.extend(["", "🔧 建议修复："])
+        lines.extend([f"- {x}" for x in suggestions])
+    else:
+        lines.extend(["", "🎉 配置检查通过，支付流程可正常使用。"])
+
+    kb = [
+        [InlineKeyboardButton("🔙 返回收款设置", callback_data="admin_pay_settings")],
+        [InlineKeyboardButton("🏠 返回主页", callback_data="back_home")],
+    ]
+    await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup(kb))
+
+
+async def _cb_set_payimg_usdt(update, context, data):
+    context.user_data['set_payimg'] = 'usdt'
+    back_cb = "admin_pay_usdt_cfg"
+    await send_or_edit_menu(update, context, "📷 请发送收款二维码图片（可发送照片或图片文件）", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data=back_cb)]]))
+
+
+async def broadcast_copy_message(bot, targets, from_chat_id, message_id):
+    # 并发受信号量限制，全局发送速率由 AIORateLimiter 控制（含 RetryAfter 重试）
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def _copy_one(uid):
+        async with semaphore:
+            await bot.copy_message(chat_id=uid, from_chat_id=from_chat_id, message_id=message_id)
+
+    results = await asyncio.gather(*(_copy_one(uid) for uid in targets), return_exceptions=True)
+    fail = sum(1 for r in results if isinstance(r, Exception))
+    return len(results) - fail, fail
+
+
+async def _cb_admin_broadcast_start(update, context, data):
+    context.user_data['broadcast_mode'] = True
+    await send_or_edit_menu(update, context, "📢 **群发通知模式**\n请发送要广播的内容（文字/图片/文件）。\n发送后将自动群发给所有用户。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="cancel_op")]]))
+
+
+async def _cb_admin_subscription_settings(update, context, data):
+    settings_payload = await get_subscription_settings()
+    preview = _json_dumps(settings_payload, indent=True)[:1200] if settings_payload else '{}'
+    history = get_cached_json_list('subscription_settings_history')
+    latest_ts = history[-1]['ts'] if isinstance(history, list) and history else None
+    latest_text = format_minute(latest_ts) if latest_ts else '暂无'
+    msg = (
+        "⚙️ **订阅设置（可视化）**\n"
+        "当前配置（截断显示）：\n"
+        "```json\n"
+        f"{preview}\n"
+        "```\n\n"
+        f"最近回滚点：`{latest_text}`\n"
+        "可使用模板快速应用，或直接发送 JSON 更新。"
+    )
+    await send_or_edit_menu(update, context, msg, SUBSCRIPTION_SETTINGS_KB)
+
+
+async def _cb_admin_subsettings_snapshot(update, context, data):
+    query = update.callback_query
+    payload = await get_subscription_settings()
+    await asyncio.to_thread(push_subscription_settings_snapshot, payload, source='手动保存')
+    await asyncio.to_thread(append_ops_timeline, '配置', '订阅设置保存回滚点', '管理员保存当前订阅设置快照', actor=query.from_user.id)
+    await query.answer("✅ 已保存回滚点", show_alert=True)
+    await send_or_edit_menu(update, context, "✅ 已保存当前订阅设置为回滚点。", SUBSCRIPTION_SETTINGS_BACK_KB)
+
+
+async def _cb_admin_subsettings_tpl(update, context, data):
+    query = update.callback_query
+    current = await get_subscription_settings()
+    await asyncio.to_thread(push_subscription_settings_snapshot, current, source='模板应用前自动备份')
+    payload = {'allowInsecure': False} if data.endswith('safe') else {'allowInsecure': True}
+    resp = await patch_subscription_settings(payload)
+    if resp and resp.status_code in (200, 204):
+        tpl = '安全模板' if data.endswith('safe') else '兼容模板'
+        await asyncio.to_thread(append_ops_timeline, '配置', f'应用{tpl}', f'payload={_json_dumps(payload)}', actor=query.from_user.id)
+        await query.answer("✅ 模板应用成功", show_alert=True)
+        await send_or_edit_menu(update, context, f"✅ 已应用{tpl}。", SUBSCRIPTION_SETTINGS_BACK_KB)
+    else:
+        await query.answer("❌ 模板应用失败", show_alert=True)
+
+
+async def _cb_admin_subsettings_rollback(update, context, data):
+    query = update.callback_query
+    snap = await asyncio.to_thread(pop_subscription_settings_snapshot)
+    if not snap:
+        await query.answer("⚠️ 暂无可回滚快照", show_alert=True)
+        return
+    payload = snap.get('payload') or {}
+    resp = await patch_subscription_settings(payload)
+    if resp and resp.status_code in (200, 204):
+        await asyncio.to_thread(append_ops_timeline, '配置', '订阅设置回滚', f"来源={snap.get('source', '-')}", actor=query.from_user.id)
+        await query.answer("✅ 回滚成功", show_alert=True)
+        await send_or_edit_menu(update, context, "✅ 已按最近回滚点恢复设置。", SUBSCRIPTION_SETTINGS_BACK_KB)
+    else:
+        await query.answer("❌ 回滚失败", show_alert=True)
+
+
+async def _cb_admin_subscription_settings_edit(update, context, data):
+    context.user_data['edit_subscription_settings'] = True
+    await send_or_edit_menu(update, context, "✍️ 请发送要 PATCH 的 JSON 内容（例如 {\"allowInsecure\":false}）", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="cancel_op")]]))
+
+
+async def get_squads_overview():
+    global _squads_overview_cache
+    cached_at, cached = _squads_overview_cache
+    if cached and time.monotonic() - cached_at < SQUADS_OVERVIEW_CACHE_TTL_SECONDS:
+        return cached
+    async with _squads_overview_lock:
+        cached_at, cached = _squads_overview_cache
+        if cached and time.monotonic() - cached_at < SQUADS_OVERVIEW_CACHE_TTL_SECONDS:
+            return cached
+        generation = _squads_overview_generation
+        squads, (summary, suggestion) = await asyncio.gather(get_internal_squads(), build_squad_capacity_summary())
+        overview = (squads, summary, suggestion)
+        if squads and generation == _squads_overview_generation:
+            _squads_overview_cache = (time.monotonic(), overview)
+        return overview
+
+
+async def _cb_admin_squads_menu(update, context, data):
+    squads, summary, suggestion = await get_squads_overview()
+    kb = []
+    for s in squads[:20]:
+        suuid = s.get('uuid') or ''
+        sname = s.get('name') or suuid[:8]
+        kb.append([InlineKeyboardButton(f"🧩 {sname}", callback_data=f"admin_squad_{suuid}")])
+    if suggestion and suggestion['from'] != '未分组' and suggestion['to'] != '未分组':
+        kb.append([InlineKeyboardButton("🚚 一键迁移建议", callback_data=f"admin_squad_suggest_{suggestion['from']}__{suggestion['to']}__{suggestion['count']}")])
+    kb.append([InlineKeyboardButton("🚚 批量迁移到分组", callback_data="admin_squad_bulk_move")])
+    kb.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
+    await send_or_edit_menu(update, context, f"🧩 **用户分组（内部组）**\n{summary}", InlineKeyboardMarkup(kb))
+
+
+async def _cb_admin_squad_suggest(update, context, data):
+    query = update.callback_query
+    parts = data.removeprefix("admin_squad_suggest_").split("__")
+    if len(parts) != 3:
+        await query.answer("建议参数错误", show_alert=True)
         return
-    if data == "admin_pay_settings":
-        usdt_enabled = get_setting_bool("usdt_enabled", False)
-        msg = (
-            "💳 **收款设置**\n"
-            "🧾 人工审核：始终可用（用户提交凭证后人工审核）\n"
-            f"🟨 USDT：{'已开启' if usdt_enabled else '已关闭'}\n\n"
-            "请选择下方配置项。"
+    from_squad, to_squad, cnt_text = parts
+    try:
+        move_n = max(1, min(int(cnt_text), 20))
+    except ValueError:
+        move_n = 5
+    rows = await adb_query("SELECT uuid FROM subscriptions ORDER BY id DESC LIMIT 120")
+    pool = [r['uuid'] for r in rows]
+    candidates = []
+    # 按并发上限分批查询，凑够迁移人数即停止，不再请求剩余用户
+    for start in range(0, len(pool), PANEL_USER_FANOUT_LIMIT):
+        batch = pool[start:start + PANEL_USER_FANOUT_LIMIT]
+        infos = await get_panel_users(batch)
+        candidates.extend(
+            uid for uid, info in zip(batch, infos)
+            if isinstance(info, dict) and info.get('externalSquadUuid') == from_squad
         )
-        kb = [
-            [InlineKeyboardButton("🟨 USDT 配置", callback_data="admin_pay_usdt_cfg")],
-            [InlineKeyboardButton("🧪 支付设置自检", callback_data="admin_pay_self_check")],
-            [InlineKeyboardButton("🔙 返回", callback_data="back_home")],
-        ]
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
+        if len(candidates) >= move_n:
+            break
+    candidates = candidates[:move_n]
+    if not candidates:
+        await query.answer("暂无可迁移候选用户", show_alert=True)
+        return
+    resp = await bulk_move_users_to_squad(candidates, to_squad)
+    if resp and resp.status_code in (200, 201, 204):
+        await asyncio.to_thread(append_ops_timeline, '分组', '执行迁移建议', f'from={from_squad},to={to_squad},count={len(candidates)}', actor=query.from_user.id)
+        await query.answer(f"✅ 已迁移 {len(candidates)} 人", show_alert=True)
+    else:
+        await query.answer("❌ 迁移失败", show_alert=True)
+
+
+async def _cb_admin_squad_bulk_move(update, context, data):
+    context.user_data['squad_bulk_move'] = True
+    await send_or_edit_menu(update, context, "✍️ 请按以下格式发送：\n第一行：目标分组UUID\n后续行：用户UUID列表", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_squads_menu")]]))
+
+
+async def _cb_admin_squad(update, context, data):
+    squad_uuid = data.removeprefix("admin_squad_")
+    nodes, node_err = await get_internal_squad_accessible_nodes_verbose(squad_uuid)
+    lines = ["🧩 **分组详情**", f"UUID: `{squad_uuid}`", "", "可访问节点："]
+    if not nodes and node_err:
+        reason_map = {
+            'config_missing': "面板地址或 Token 未配置。",
+            'auth_unauthorized': "面板鉴权失败（401），请检查 Token。",
+            'auth_forbidden': "当前 Token 无权限访问该接口（403）。",
+            'endpoint_or_squad_not_found': "接口或分组不存在（404）。",
+            'network_error': "请求失败，请检查面板连通性。",
+            'empty_payload': "接口返回为空。",
+        }
+        lines.append(f"- ⚠️ 无法加载节点：{reason_map.get(node_err, node_err)}")
+    elif not nodes:
+        lines.append("- 暂无可访问节点")
+    else:
+        for n in nodes[:20]:
+            node_name = (
+                n.get('name')
+                or n.get('nodeName')
+                or n.get('remark')
+                or n.get('uuid')
+                or '未知节点'
+            )
+            lines.append(f"- {node_name}")
+    kb = [[InlineKeyboardButton("🔙 返回分组", callback_data="admin_squads_menu")]]
+    await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup(kb))
+
+
+async def _cb_admin_bandwidth_dashboard(update, context, data):
+    nodes_rt = await get_bandwidth_nodes_realtime()
+    # 在全部节点中取流量最大的 5 个，无需整体排序
+    top = heapq.nlargest(5, (_node_traffic_pair(it) for it in nodes_rt), key=itemgetter(1))
+    lines = ["📈 **带宽看板（实时）**", "TOP节点："]
+    if not top:
+        lines.append("- 暂无数据")
+    for name, val in top:
+        lines.append(f"- {name}: {round(val / 1024**3, 2)} GB")
+    top_users = await build_top_users_traffic()
+    lines.append("\nTOP用户流量：")
+    if not top_users:
+        lines.append("- 暂无")
+    for tg_id, uid, used in top_users:
+        lines.append(f"- 用户`{tg_id}` / `{uid[:8]}`: {round(used / 1024**3, 2)} GB")
+    alerts = await asyncio.to_thread(detect_bandwidth_volatility, nodes_rt)
+    lines.append("\n节点波动提醒：")
+    if not alerts:
+        lines.append("- 暂无明显波动")
+    else:
+        for name, delta, ratio in heapq.nlargest(5, alerts, key=lambda a: abs(a[1])):
+            symbol = '⬆️' if delta > 0 else '⬇️'
+            lines.append(f"- {symbol} {name}: {round(delta / 1024**3, 2)} GB ({round(ratio*100, 1)}%)")
+    stats = await get_subscription_history_stats()
+    hourly = stats.get('hourlyRequestStats') if isinstance(stats, dict) else []
+    recent = int(hourly[-1].get('requestCount', 0)) if hourly else 0
+    lines.append(f"\n最近1小时请求数：`{recent}`")
+    await send_or_edit_menu(update, context, "\n".join(lines), BACK_HOME_KB)
+
+
+async def _cb_admin_risk_policy(update, context, data):
+    policy = await aget_setting_values({
+        'risk_low_score': '80',
+        'risk_high_score': '130',
+        'risk_auto_unfreeze_hours': '12',
+        'risk_enforce_mode': 'enforce',
+    })
+    watchlist = get_risk_watchlist_sorted()[:8]
+    watch_preview = '、'.join(x[:8] for x in watchlist) if watchlist else '暂无'
+    msg = (
+        "🛡️ **风控策略（多级）**\n"
+        f"低风险阈值: {policy['risk_low_score']}\n"
+        f"高风险阈值: {policy['risk_high_score']}\n"
+        f"自动解封时长(小时): {policy['risk_auto_unfreeze_hours']}\n"
+        f"执行模式: {policy['risk_enforce_mode']}\n"
+        f"观察名单(预览): {watch_preview}\n\n"
+        "请通过下方按钮进入修改流程。"
+    )
+    kb = [
+        [InlineKeyboardButton("✍️ 修改阈值", callback_data="admin_risk_policy_edit")],
+        [InlineKeyboardButton("⏱ 设置自动解封时长", callback_data="admin_risk_unfreeze_edit")],
+        [InlineKeyboardButton("👀 查看观察名单", callback_data="admin_risk_watchlist")],
+        [InlineKeyboardButton("🧪 切换灰度模式", callback_data="admin_risk_mode_cycle")],
+        [InlineKeyboardButton("🔙 返回", callback_data="back_home")],
+    ]
+    await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
+
+
+async def _cb_admin_risk_policy_edit(update, context, data):
+    context.user_data['edit_risk_policy'] = True
+    await send_or_edit_menu(update, context, "✍️ 请发送：低阈值,高阈值（例如 80,130）", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_risk_policy")]]))
+
+
+async def _cb_admin_risk_unfreeze_edit(update, context, data):
+    context.user_data['edit_risk_unfreeze_hours'] = True
+    await send_or_edit_menu(update, context, "⏱ 请输入自动解封时长（小时，整数，例如 12）", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_risk_policy")]]))
+
+
+async def _cb_admin_risk_watchlist(update, context, data):
+    watchlist = get_risk_watchlist_sorted()
+    lines = ["👀 **观察名单**"]
+    if not watchlist:
+        lines.append("暂无记录")
+    else:
+        for uid in watchlist[:30]:
+            lines.append(f"- `{uid}`")
+    kb = [[InlineKeyboardButton("🧹 清空观察名单", callback_data="admin_risk_watchlist_clear")], [InlineKeyboardButton("🔙 返回", callback_data="admin_risk_policy")]]
+    await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup(kb))
+
+
+async def _cb_admin_risk_watchlist_clear(update, context, data):
+    query = update.callback_query
+    await asyncio.to_thread(set_risk_watchlist, set())
+    await asyncio.to_thread(append_ops_timeline, '风控', '清空观察名单', '管理员手动清空', actor=query.from_user.id)
+    await query.answer("✅ 已清空", show_alert=True)
+    await send_or_edit_menu(update, context, "✅ 观察名单已清空。", RISK_POLICY_BACK_KB)
+
+
+async def _cb_admin_risk_mode_cycle(update, context, data):
+    query = update.callback_query
+    curr = get_setting_value('risk_enforce_mode', 'enforce')
+    nxt = {'enforce': 'gray', 'gray': 'observe', 'observe': 'enforce'}.get(curr, 'enforce')
+    await aset_setting_value('risk_enforce_mode', nxt)
+    await asyncio.to_thread(append_ops_timeline, '风控', '切换执行模式', f'{curr}->{nxt}', actor=query.from_user.id)
+    await query.answer(f"已切换: {nxt}", show_alert=True)
+    await send_or_edit_menu(update, context, f"✅ 风控执行模式已切换为 {nxt}", RISK_POLICY_BACK_KB)
+
+
+async def _cb_admin_risk_audit(update, context, data):
+    rows = await adb_query("SELECT * FROM anomaly_events ORDER BY created_at DESC LIMIT 20")
+    lines = ["🧾 **风控回溯（最近20条）**"]
+    if not rows:
+        lines.append("暂无记录")
+    for r in rows:
+        it = dict(r)
+        ts = format_minute(it['created_at'])
+        lines.append(f"- {ts} | {it['risk_level']} | {it['user_uuid'][:8]} | 分数{it['risk_score']} | 动作:{it['action_taken']}")
+    await send_or_edit_menu(update, context, "\n".join(lines), BACK_HOME_KB)
+
+
+_OPS_TIMELINE_EVENTS_SQL = (
+    "SELECT ts, text FROM ("
+    "SELECT created_at AS ts, '订单 | ' || action || ' | ' || order_id || ' | ' || COALESCE(NULLIF(detail, ''), '-') AS text "
+    "FROM order_audit_logs ORDER BY created_at DESC LIMIT 15) "
+    "UNION ALL "
+    "SELECT ts, text FROM ("
+    "SELECT created_at AS ts, '风控 | ' || risk_level || ' | ' || substr(user_uuid, 1, 8) || ' | ' || action_taken AS text "
+    "FROM anomaly_events ORDER BY created_at DESC LIMIT 15) "
+    "ORDER BY ts DESC"
+)
+
+
+async def _cb_admin_ops_timeline(update, context, data):
+    lines = ["🕒 **操作时间线（订单+风控+配置）**"]
+    # 订单与风控记录各取最近 15 条，在 SQLite 内拼好文本并排序，一次往返返回
+    db_events = await adb_query(_OPS_TIMELINE_EVENTS_SQL)
+    events = [(int(r['ts']), r['text']) for r in db_events]
+    events.extend(
+        (int(item.get('ts', 0)), f"{item.get('type','系统')} | {item.get('title','-')} | {item.get('detail','-')}")
+        for item in get_cached_json_list('ops_timeline')[-20:]
+    )
+    events = heapq.nlargest(25, events, key=lambda x: x[0])
+    if not events:
+        lines.append('暂无记录')
+    for ts, text_line in events:
+        ts_text = format_minute(ts) if ts else '--'
+        lines.append(f"- {ts_text} | {text_line[:120]}")
+    await send_or_edit_menu(update, context, "\n".join(lines), BACK_HOME_KB)
+
+
+async def _cb_admin_bulk_menu(update, context, data):
+    await send_or_edit_menu(update, context, _BULK_MENU_TEXT, BULK_MENU_KB)
+
+
+async def _cb_bulk_uuid_action(update, context, data):
+    context.user_data['bulk_action'] = data.removeprefix("bulk_")
+    tip = "每行一个UUID，或使用空格/逗号分隔。"
+    await send_or_edit_menu(update, context, f"✍️ 请输入用户UUID列表\n{tip}", BULK_MENU_CANCEL_KB)
+
+
+async def _cb_bulk_expire(update, context, data):
+    context.user_data['bulk_action'] = 'expire'
+    tip = "第一行输入天数（例如 30），从第二行开始输入UUID列表。"
+    await send_or_edit_menu(update, context, f"✍️ 批量改到期日\n{tip}", BULK_MENU_CANCEL_KB)
+
+
+async def _cb_bulk_traffic(update, context, data):
+    context.user_data['bulk_action'] = 'traffic'
+    tip = "第一行输入流量GB（例如 200），从第二行开始输入UUID列表。"
+    await send_or_edit_menu(update, context, f"✍️ 批量改流量包\n{tip}", BULK_MENU_CANCEL_KB)
+
+
+async def _cb_admin_orders_menu(update, context, data):
+    await show_orders_menu(update, context)
+
+
+async def _cb_admin_orders_status(update, context, data):
+    status_filter = data.removeprefix("admin_orders_status_")
+    await show_orders_menu(update, context, status_filter=status_filter)
+
+
+async def _cb_admin_orders_page(update, context, data):
+    status_filter, page, cursor = parse_orders_page_callback(data)
+    await show_orders_menu(update, context, status_filter=status_filter, page=page, cursor=cursor)
+
+
+def load_order_with_logs(order_id, log_limit=5):
+    # 订单与最近审计记录在同一次线程切换内读完
+    order = db_query("SELECT * FROM orders WHERE order_id = ?", (order_id,), one=True)
+    if not order:
+        return None, []
+    logs = db_query("SELECT * FROM order_audit_logs WHERE order_id=? ORDER BY created_at DESC LIMIT ?", (order_id, log_limit))
+    return dict(order), [dict(x) for x in logs]
+
+
+async def _cb_admin_order(update, context, data):
+    order_id = data.removeprefix("admin_order_")
+    item, logs = await asyncio.to_thread(load_order_with_logs, order_id)
+    if not item:
+        await send_or_edit_menu(update, context, "⚠️ 订单不存在", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_orders_menu")]]))
         return
+    txt = format_order_detail(item, logs)
+    kb = [[InlineKeyboardButton("🔙 返回", callback_data="admin_orders_menu")]]
+    if item.get('status') == STATUS_FAILED:
+        kb.insert(0, [InlineKeyboardButton("♻️ 重试发货", callback_data=f"rt_{item['order_id']}")])
+    await send_or_edit_menu(update, context, txt, InlineKeyboardMarkup(kb))
+
+
+async def _cb_anomaly_whitelist_menu(update, context, data):
+    await show_anomaly_whitelist_menu(update, context)
+
+
+async def _cb_anomaly_whitelist_add(update, context, data):
+    context.user_data['add_anomaly_whitelist'] = True
+    await send_or_edit_menu(update, context, "✍️ 请输入要加入白名单的用户 UUID", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="anomaly_whitelist_menu")]]))
+
+
+async def _cb_anomaly_whitelist_del(update, context, data):
+    uuid_val = data.removeprefix("anomaly_whitelist_del_")
+    await remove_anomaly_whitelist(uuid_val)
+    await show_anomaly_whitelist_menu(update, context)
+
+
+async def _cb_anomaly_quick_whitelist(update, context, data):
+    query = update.callback_query
+    uid = data.removeprefix("anomaly_quick_whitelist_")
+    await add_anomaly_whitelist(uid)
+    await query.answer("✅ 已加入白名单", show_alert=False)
+
+
+async def _cb_anomaly_quick_enable(update, context, data):
+    query = update.callback_query
+    uid = data.removeprefix("anomaly_quick_enable_")
+    await enable_panel_user(uid)
+    await query.answer("✅ 已尝试解封该用户", show_alert=False)
+
+
+async def _cb_admin_plans_list(update, context, data):
+    await show_plans_menu(update, context)
+
+
+async def _cb_plan_detail(update, context, data):
+    key = data.removeprefix("plan_detail_")
+    p = get_plan_row(key)
+    if not p: return
+    try:
+        p_dict = dict(p)
+        strategy = p_dict.get('reset_strategy', 'NO_RESET')
+        s_text = get_strategy_label(strategy)
+    except Exception as exc:
+        logger.warning("failed to read plan strategy for %s: %s", key, exc)
+        s_text = '总流量'
+    msg = f"📦 **套餐详情**\n\n🏷 名称：`{p_dict['name']}`\n💰 人民币：`{p_dict['price']}`\n🪙 USDT：`{(p_dict.get('usdt_price') or '未设置')} USDT`\n⏳ 时长：`{p_dict['days']} 天`\n📡 流量：`{p_dict['gb']} GB`\n🔄 策略：`{s_text}`"
+    keyboard = [[InlineKeyboardButton("🗑 删除此套餐", callback_data=f"del_plan_{key}")], [InlineKeyboardButton("🔙 返回列表", callback_data="admin_plans_list")]]
+    await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(keyboard))
+
+
+async def _cb_del_plan(update, context, data):
+    query = update.callback_query
+    key = data.removeprefix("del_plan_")
+    await adb_execute("DELETE FROM plans WHERE key = ?", (key,))
+    invalidate_plan_cache()
+    await query.answer("✅ 套餐已删除", show_alert=True)
+    await show_plans_menu(update, context)
+
+
+async def _cb_admin_users_list(update, context, data):
+    await show_users_list(update, context)
+
+
+async def _cb_list_user_subs(update, context, data):
+    target_uid = int(data.removeprefix("list_user_subs_"))
+    subs = await adb_query("SELECT * FROM subscriptions WHERE tg_id = ?", (target_uid,))
+    keyboard = []
+    for s in subs:
+        s_dict = dict(s)
+        short_uuid = s_dict['uuid'][:8]
+        keyboard.append([InlineKeyboardButton(f"UUID: {short_uuid}...", callback_data=f"manage_user_{s_dict['uuid']}")])
+    keyboard.append([InlineKeyboardButton("🔙 返回列表", callback_data="admin_users_list")])
+    await send_or_edit_menu(update, context, f"👤 用户 `{target_uid}` 的订阅列表：", InlineKeyboardMarkup(keyboard))
+
+
+async def _cb_manage_user(update, context, data):
+    target_uuid = data.removeprefix("manage_user_")
+    # 本地记录、面板用户与可访问节点互不依赖，并发查询
+    sub, panel_info, (user_nodes, user_nodes_err) = await asyncio.gather(
+        adb_query("SELECT tg_id FROM subscriptions WHERE uuid = ?", (target_uuid,), one=True),
+        get_panel_user(target_uuid),
+        get_user_accessible_nodes_verbose(target_uuid),
+    )
+    if not sub:
+        await send_or_edit_menu(update, context, "⚠️ 记录不存在", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_users_list")]]))
+        return
+    status = "🟢 面板正常" if panel_info else "🔴 面板已删"
+    node_lines = ["可访问节点："]
+    if user_nodes:
+        for n in user_nodes[:10]:
+            node_name = n.get('name') or n.get('nodeName') or n.get('remark') or n.get('uuid') or '未知节点'
+            node_lines.append(f"- {node_name}")
+    else:
+        reason_map = {
+            "config_missing": "面板地址或 Token 未配置",
+            "network_error": "面板网络不可达",
+            "auth_unauthorized": "Token 鉴权失败(401)",
+            "auth_forbidden": "Token 权限不足(403)",
+            "endpoint_or_user_not_found": "接口或用户不存在(404)",
+            "empty_payload": "接口返回为空",
+        }
+        node_lines.append(f"- ⚠️ {reason_map.get(user_nodes_err, user_nodes_err or '暂无')}")
+    msg = (f"👤 **用户详情**\nTG ID: `{sub['tg_id']}`\n状态: {status}\nUUID: `{target_uuid}`\n\n" + "\n".join(node_lines))
+    keyboard = [
+        [InlineKeyboardButton("🔄 重置流量", callback_data=f"reset_traffic_{target_uuid}")],
+        [InlineKeyboardButton("📜 最近请求记录", callback_data=f"user_reqhist_{target_uuid}")],
+        [InlineKeyboardButton("🗑 确认删除用户", callback_data=f"confirm_del_user_{target_uuid}")],
+        [InlineKeyboardButton("🔙 返回列表", callback_data=f"list_user_subs_{sub['tg_id']}")],
+    ]
+    await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(keyboard))
+
+
+async def _cb_user_reqhist(update, context, data):
+    target_uuid = data.removeprefix("user_reqhist_")
+    sub, history = await asyncio.gather(
+        adb_query("SELECT tg_id FROM subscriptions WHERE uuid = ?", (target_uuid,), one=True),
+        get_user_subscription_history(target_uuid),
+    )
+    records = history.get('records') if isinstance(history, dict) else None
+    total = history.get('total') if isinstance(history, dict) else None
+    if not isinstance(records, list):
+        records = []
+    lines = [f"📜 **请求记录（最近{len(records)}条）**", f"UUID: `{target_uuid}`"]
+    if isinstance(total, int):
+        lines.append(f"总记录数: `{total}`")
+    lines.append("")
+    if not records:
+        lines.append("暂无请求记录")
+    else:
+        for rec in records[:10]:
+            req_at = format_time(rec.get('requestAt'))
+            req_ip = rec.get('requestIp') or '未知IP'
+            ua = (rec.get('userAgent') or '未知UA')[:40]
+            lines.append(f"• `{req_at}` | `{req_ip}` | `{ua}`")
+    back_tg = sub['tg_id'] if sub else ADMIN_ID
+    kb = [[InlineKeyboardButton("🔙 返回用户", callback_data=f"manage_user_{target_uuid}")], [InlineKeyboardButton("🔙 返回列表", callback_data=f"list_user_subs_{back_tg}")]]
+    await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup(kb))
+
+
+async def _cb_reset_traffic(update, context, data):
+    query = update.callback_query
+    target_uuid = data.removeprefix("reset_traffic_")
+    resp = await reset_panel_user_traffic(target_uuid)
+    if resp and resp.status_code == 204: await query.answer("✅ 流量已重置", show_alert=True)
+    else: await query.answer("❌ 操作失败", show_alert=True)
+
+
+async def _cb_confirm_del_user(update, context, data):
+    query = update.callback_query
+    target_uuid = data.removeprefix("confirm_del_user_")
+    await delete_panel_user(target_uuid)
+    await adb_execute("DELETE FROM subscriptions WHERE uuid = ?", (target_uuid,))
+    forget_short_id(target_uuid)
+    await query.answer("✅ 用户已删除", show_alert=True)
+    await show_users_list(update, context)
+
+
+async def _cb_admin_notify(update, context, data):
+    try:
+        day = (await aget_setting_values({'notify_days': 3}))['notify_days']
+    except Exception as exc:
+        logger.warning("failed to load notify_days setting: %s", exc)
+        day = 3
+    kb = [[InlineKeyboardButton("🔙 取消", callback_data="cancel_op")]]
+    await send_or_edit_menu(update, context, f"🔔 **提醒设置**\n当前：到期前 {day} 天发送提醒\n\n**⬇️ 请回复新的天数（纯数字）：**", InlineKeyboardMarkup(kb))
+    context.user_data['setting_notify'] = True
+
+
+async def _cb_admin_cleanup(update, context, data):
+    try:
+        day = (await aget_setting_values({'cleanup_days': 7}))['cleanup_days']
+    except Exception as exc:
+        logger.warning("failed to load cleanup_days setting: %s", exc)
+        day = 7
+    kb = [[InlineKeyboardButton("🔙 取消", callback_data="cancel_op")]]
+    await send_or_edit_menu(update, context, f"🗑 **清理设置**\n当前：过期后 {day} 天自动删除\n(过期1天将只禁用)\n\n**⬇️ 请回复新的天数（纯数字）：**", InlineKeyboardMarkup(kb))
+    context.user_data['setting_cleanup'] = True
+
+
+async def _cb_admin_anomaly_menu(update, context, data):
+    try:
+        values = await aget_setting_values({'anomaly_interval': 1, 'anomaly_threshold': 50})
+        interval, threshold = values['anomaly_interval'], values['anomaly_threshold']
+    except Exception as exc:
+        logger.warning("failed to load anomaly settings: %s", exc)
+        interval=1; threshold=50
+    stats = await get_subscription_history_stats()
+    by_app = stats.get('byParsedApp') if isinstance(stats, dict) else None
+    app_top = "暂无"
+    if isinstance(by_app, list) and by_app:
+        top = heapq.nlargest(3, by_app, key=lambda x: x.get('count', 0))
+        app_top = ", ".join(f"{(x.get('app') or 'unknown')}:{int(x.get('count', 0))}" for x in top)
+    hourly = stats.get('hourlyRequestStats') if isinstance(stats, dict) else None
+    hourly_last = int(hourly[-1].get('requestCount', 0)) if isinstance(hourly, list) and hourly else 0
+    msg = (
+        f"🛡️ **异常检测设置**\n\n"
+        f"⏱️ 检测周期：每 {interval} 小时\n"
+        f"🔢 封禁阈值：单周期 > {threshold} 个IP\n"
+        f"📊 最近1小时请求量：`{hourly_last}`\n"
+        f"📱 TOP客户端：`{app_top}`\n\n"
+        "检测支持多级处置：低风险告警入观察名单，中风险限速，高风险禁用。"
+    )
+    kb = [[InlineKeyboardButton("⏱️ 设置周期", callback_data="set_anomaly_interval"), InlineKeyboardButton("🔢 设置阈值", callback_data="set_anomaly_threshold")],[InlineKeyboardButton("📋 白名单", callback_data="anomaly_whitelist_menu"), InlineKeyboardButton("🛡️ 风控策略", callback_data="admin_risk_policy")],[InlineKeyboardButton("🧾 风控回溯", callback_data="admin_risk_audit")],[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]
+    await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
+
+
+async def _cb_set_anomaly_interval(update, context, data):
+    kb = [[InlineKeyboardButton("🔙 取消", callback_data="admin_anomaly_menu")]]
+    await send_or_edit_menu(update, context, "⏱️ **请输入检测周期 (小时)**\n例如：0.5 (半小时) 或 1 (一小时)", InlineKeyboardMarkup(kb))
+    context.user_data['setting_anomaly_interval'] = True
+
+
+async def _cb_set_anomaly_threshold(update, context, data):
+    kb = [[InlineKeyboardButton("🔙 取消", callback_data="admin_anomaly_menu")]]
+    await send_or_edit_menu(update, context, "🔢 **请输入封禁阈值 (IP数量)**\n例如：50", InlineKeyboardMarkup(kb))
+    context.user_data['setting_anomaly_threshold'] = True
+
+
+async def _cb_set_strategy(update, context, data):
+    strategy = data.removeprefix("set_strategy_")
+    new_plan = context.user_data['new_plan']
+    key = f"p{int(time.time())}"
+    await adb_execute("INSERT INTO plans (key, name, price, usdt_price, days, gb, reset_strategy) VALUES (?, ?, ?, ?, ?, ?, ?)", (key, new_plan['name'], new_plan['price'], new_plan['usdt_price'], new_plan['days'], new_plan['gb'], strategy))
+    invalidate_plan_cache()
+    del context.user_data['add_plan_step']
+    strategy_label = get_strategy_label(strategy)
+    msg = (
+        "✅ 套餐添加成功！\n"
+        f"套餐名称：{new_plan['name']}\n"
+        f"重置策略：{strategy_label} ({strategy})"
+    )
+    kb = [
+        [InlineKeyboardButton("📦 返回套餐管理", callback_data="admin_plans_list")],
+        [InlineKeyboardButton("🏠 返回主菜单", callback_data="back_home")],
+    ]
+    await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb), parse_mode=None)
+
+
+_ADMIN_EXACT_HANDLERS = {
+    "back_home": _cb_back_home,
+    "cancel_op": _cb_cancel_op,
+    "admin_panel_config": _cb_admin_panel_config,
+    "panelcfg_set_url": _cb_panelcfg_set_input,
+    "panelcfg_set_token": _cb_panelcfg_set_input,
+    "panelcfg_set_subdomain": _cb_panelcfg_set_input,
+    "panelcfg_set_group": _cb_panelcfg_set_input,
+    "panelcfg_toggle_tls": _cb_panelcfg_toggle_tls,
+    "admin_template_center": _cb_admin_template_center,
+    "tpl_save_current": _cb_tpl_save_current,
+    "admin_panel_user_lookup": _cb_admin_panel_user_lookup,
+    "admin_system_dashboard": _cb_admin_system_dashboard,
+    "admin_bulk_jobs": _cb_admin_bulk_jobs,
+    "admin_pay_settings": _cb_admin_pay_settings,
+    "admin_pay_usdt_cfg": _cb_admin_pay_usdt_cfg,
+    "toggle_pay_usdt": _cb_toggle_pay_usdt,
+    "set_pay_usdt_network": _cb_set_pay_usdt_network,
+    "set_pay_usdt_address": _cb_set_pay_usdt_address,
+    "admin_pay_self_check": _cb_admin_pay_self_check,
+    "set_payimg_usdt": _cb_set_payimg_usdt,
+    "admin_broadcast_start": _cb_admin_broadcast_start,
+    "admin_subscription_settings": _cb_admin_subscription_settings,
+    "admin_subsettings_snapshot": _cb_admin_subsettings_snapshot,
+    "admin_subsettings_tpl_safe": _cb_admin_subsettings_tpl,
+    "admin_subsettings_tpl_compat": _cb_admin_subsettings_tpl,
+    "admin_subsettings_rollback": _cb_admin_subsettings_rollback,
+    "admin_subscription_settings_edit": _cb_admin_subscription_settings_edit,
+    "admin_squads_menu": _cb_admin_squads_menu,
+    "admin_squad_bulk_move": _cb_admin_squad_bulk_move,
+    "admin_bandwidth_dashboard": _cb_admin_bandwidth_dashboard,
+    "admin_risk_policy": _cb_admin_risk_policy,
+    "admin_risk_policy_edit": _cb_admin_risk_policy_edit,
+    "admin_risk_unfreeze_edit": _cb_admin_risk_unfreeze_edit,
+    "admin_risk_watchlist": _cb_admin_risk_watchlist,
+    "admin_risk_watchlist_clear": _cb_admin_risk_watchlist_clear,
+    "admin_risk_mode_cycle": _cb_admin_risk_mode_cycle,
+    "admin_risk_audit": _cb_admin_risk_audit,
+    "admin_ops_timeline": _cb_admin_ops_timeline,
+    "admin_bulk_menu": _cb_admin_bulk_menu,
+    "bulk_reset": _cb_bulk_uuid_action,
+    "bulk_disable": _cb_bulk_uuid_action,
+    "bulk_delete": _cb_bulk_uuid_action,
+    "bulk_expire": _cb_bulk_expire,
+    "bulk_traffic": _cb_bulk_traffic,
+    "admin_orders_menu": _cb_admin_orders_menu,
+    "anomaly_whitelist_menu": _cb_anomaly_whitelist_menu,
+    "anomaly_whitelist_add": _cb_anomaly_whitelist_add,
+    "admin_plans_list": _cb_admin_plans_list,
+    "admin_users_list": _cb_admin_users_list,
+    "admin_notify": _cb_admin_notify,
+    "admin_cleanup": _cb_admin_cleanup,
+    "admin_anomaly_menu": _cb_admin_anomaly_menu,
+    "set_anomaly_interval": _cb_set_anomaly_interval,
+    "set_anomaly_threshold": _cb_set_anomaly_threshold,
+}
+_ADMIN_PREFIX_HANDLERS = build_prefix_table({
+    "reply_user_": _cb_reply_user,
+    "tpl_apply_": _cb_tpl_apply,
+    "bind_panel_user_": _cb_bind_panel_user,
+    "admin_squad_suggest_": _cb_admin_squad_suggest,
+    "admin_squad_": _cb_admin_squad,
+    "admin_orders_status_": _cb_admin_orders_status,
+    "admin_orders_page_": _cb_admin_orders_page,
+    "admin_order_": _cb_admin_order,
+    "anomaly_whitelist_del_": _cb_anomaly_whitelist_del,
+    "anomaly_quick_whitelist_": _cb_anomaly_quick_whitelist,
+    "anomaly_quick_enable_": _cb_anomaly_quick_enable,
+    "plan_detail_": _cb_plan_detail,
+    "del_plan_": _cb_del_plan,
+    "list_user_subs_": _cb_list_user_subs,
+    "manage_user_": _cb_manage_user,
+    "user_reqhist_": _cb_user_reqhist,
+    "reset_traffic_": _cb_reset_traffic,
+    "confirm_del_user_": _cb_confirm_del_user,
+    "set_strategy_": _cb_set_strategy,
+})
+
+
+async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    data = query.data
+
+    # 只要离开“回复输入模式”，就清理回复上下文，避免串场
+    if not data.startswith("reply_user_"):
+        if 'reply_to_uid' in context.user_data:
+            logger.info("admin reply mode cleared by callback: admin=%s callback=%s", query.from_user.id, data)
+        await cleanup_admin_reply_prompt(context, query.from_user.id, context.user_data, reason=f'callback:{data}')
+        context.user_data.pop('reply_to_uid', None)
+        context.user_data.pop('reply_back_cb', None)
+
+    handler = resolve_callback_handler(data, _ADMIN_EXACT_HANDLERS, _ADMIN_PREFIX_HANDLERS)
+    if handler is not None:
+        await handler(update, context, data)
+
+
+async def show_users_list(update, context):
+    users = await adb_query("SELECT tg_id, created_at FROM user_last_seen ORDER BY created_at DESC LIMIT 20")
+    keyboard = []
+    for u in users:
+        date_str = datetime.datetime.fromtimestamp(int(u['created_at'])).strftime('%m-%d')
+        btn_text = f"🆔 {u['tg_id']} | {date_str}"
+        keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"list_user_subs_{u['tg_id']}")])
+    keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
+    await send_or_edit_menu(update, context, "👥 **用户管理 (最近20名)**\n点击ID查看其名下订阅：", InlineKeyboardMarkup(keyboard))
 
-    if data == "admin_pay_usdt_cfg":
-        usdt_enabled = get_setting_bool("usdt_enabled", False)
-        usdt_network = (get_setting_value("usdt_network", "TRC20") or "TRC20").strip().upper()
-        usdt_address = (get_setting_value("usdt_address", "") or "").strip()
-        usdt_qr = "已上传" if get_setting_value("usdt_qr_file_id") else "未上传"
-        msg = (
-            "🟨 **USDT 配置**\n"
-            f"开关：{'开启' if usdt_enabled else '关闭'}\n"
-            f"网络：`{usdt_network}`\n"
-            f"地址：`{usdt_address or '未设置'}`\n"
-            f"收款码图片：{usdt_qr}"
+async def _msg_set_payimg(update, context, text):
+    pay_type = context.user_data.get('set_payimg')
+    file_id = None
+    if update.message.photo:
+        file_id = update.message.photo[-1].file_id
+    elif update.message.document and (update.message.document.mime_type or '').startswith('image/'):
+        file_id = update.message.document.file_id
+    if not file_id:
+        await update.message.reply_text("❌ 请发送图片文件", reply_markup=CANCEL_OP_KB)
+        return
+    key_map = {'usdt': 'usdt_qr_file_id'}
+    key = key_map.get(pay_type, 'usdt_qr_file_id')
+    await aset_setting_value(key, file_id)
+    context.user_data.pop('set_payimg', None)
+    label_map = {'usdt': 'USDT'}
+    back_map = {'usdt': 'admin_pay_usdt_cfg'}
+    label = label_map.get(pay_type, 'USDT')
+    await update.message.reply_text(f"✅ 已更新{label}收款码。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data=back_map.get(pay_type, 'admin_pay_settings'))]]))
+
+
+async def _msg_paycfg_input_usdt_network(update, context, text):
+    await aset_setting_value('usdt_network', text.strip().upper()[:12])
+    context.user_data.pop('paycfg_input_usdt_network', None)
+    await update.message.reply_text("✅ USDT 网络已更新。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_pay_usdt_cfg")]]))
+
+
+async def _msg_paycfg_input_usdt_address(update, context, text):
+    await aset_setting_value('usdt_address', text.strip())
+    context.user_data.pop('paycfg_input_usdt_address', None)
+    await update.message.reply_text("✅ USDT 地址已更新。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_pay_usdt_cfg")]]))
+
+
+async def _msg_panel_user_lookup_mode(update, context, text):
+    raw = text.strip()
+    lookup_type = "auto"
+    lookup_value = raw
+    if ":" in raw:
+        lookup_type, lookup_value = [x.strip() for x in raw.split(":", 1)]
+        lookup_type = lookup_type.lower()
+    panel_user = None
+    if lookup_type in {"tg", "telegram", "telegram_id", "auto"} and lookup_value.isdigit():
+        panel_user = await get_user_by_telegram_id(int(lookup_value))
+        lookup_type = "telegramId"
+    elif lookup_type in {"username", "user"}:
+        panel_user = await get_user_by_username(lookup_value)
+        lookup_type = "username"
+    elif lookup_type in {"uuid"}:
+        panel_user = await get_panel_user(lookup_value)
+        lookup_type = "uuid"
+    elif lookup_type in {"short", "short_uuid"}:
+        panel_user = await get_user_by_short_uuid(lookup_value)
+        lookup_type = "shortUuid"
+    elif lookup_value.isdigit():
+        panel_user = await get_user_by_telegram_id(int(lookup_value))
+        lookup_type = "telegramId"
+    else:
+        panel_user = await get_user_by_username(lookup_value)
+        lookup_type = "username"
+
+    if not isinstance(panel_user, dict):
+        await update.message.reply_text(
+            "❌ 未找到面板用户，或当前 Token 无权限访问该检索接口。",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔎 继续检索", callback_data="admin_panel_user_lookup")], [InlineKeyboardButton("🏠 返回主页", callback_data="back_home")]]),
         )
-        kb = [
-            [InlineKeyboardButton("🔘 切换USDT开关", callback_data="toggle_pay_usdt")],
-            [InlineKeyboardButton("🌐 设置USDT网络", callback_data="set_pay_usdt_network")],
-            [InlineKeyboardButton("🏦 设置USDT地址", callback_data="set_pay_usdt_address")],
-            [InlineKeyboardButton("⬆️ 上传USDT收款码", callback_data="set_payimg_usdt")],
-            [InlineKeyboardButton("🔙 返回收款设置", callback_data="admin_pay_settings")],
-        ]
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
         return
 
-    if data == "toggle_pay_usdt":
-        next_val = not get_setting_bool("usdt_enabled", False)
-        set_setting_value("usdt_enabled", "1" if next_val else "0")
-        await query.answer(f"✅ USDT已{'开启' if next_val else '关闭'}", show_alert=True)
-        await send_or_edit_menu(update, context, "✅ 已更新USDT开关。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回USDT配置", callback_data="admin_pay_usdt_cfg")]]))
-        return
+    puuid = panel_user.get('uuid') or '-'
+    puser = panel_user.get('username') or '-'
+    ptg = panel_user.get('telegramId')
+    pstatus = panel_user.get('status') or '-'
+    pstrategy = panel_user.get('trafficLimitStrategy') or '-'
+    lines = [
+        "✅ 检索到面板用户",
+        f"检索方式: {lookup_type}",
+        f"UUID: {puuid}",
+        f"用户名: {puser}",
+        f"Telegram ID: {ptg if ptg is not None else '-'}",
+        f"状态: {pstatus}",
+        f"重置策略: {pstrategy}",
+    ]
+    kb = [[InlineKeyboardButton("🔎 继续检索", callback_data="admin_panel_user_lookup")], [InlineKeyboardButton("🏠 返回主页", callback_data="back_home")]]
+    if puuid != '-' and isinstance(ptg, int):
+        kb.insert(0, [InlineKeyboardButton("🔗 绑定到本地订阅", callback_data=f"bind_panel_user_{ptg}_{puuid}")])
+    await update.message.reply_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(kb))
 
-    if data == "set_pay_usdt_network":
-        context.user_data['paycfg_input_usdt_network'] = True
-        await send_or_edit_menu(update, context, "✍️ 请输入 USDT 网络（例如 TRC20 / ERC20 / BEP20）", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_pay_usdt_cfg")]]))
-        return
 
-    if data == "set_pay_usdt_address":
-        context.user_data['paycfg_input_usdt_address'] = True
-        await send_or_edit_menu(update, context, "✍️ 请输入 USDT 收款地址", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_pay_usdt_cfg")]]))
-        return
+async def _msg_broadcast_mode(update, context, text):
+    user_id = update.effective_user.id
+    # UNION 在 SQLite 内去重，两张表的 tg_id 索引可直接覆盖扫描
+    rows = await adb_query("SELECT tg_id FROM subscriptions WHERE tg_id IS NOT NULL UNION SELECT tg_id FROM orders")
+    targets = [int(r['tg_id']) for r in rows]
+    # 先退出群发模式，避免长时间群发期间管理员的下一条消息被再次广播
+    context.user_data.pop('broadcast_mode', None)
+    ok, fail = await broadcast_copy_message(context.bot, targets, user_id, update.message.message_id)
+    await update.message.reply_text(f"📢 群发完成\n成功: {ok}\n失败: {fail}", reply_markup=RETURN_HOME_KB)
 
-    if data == "admin_pay_self_check":
-        usdt_enabled = get_setting_bool("usdt_enabled", False)
-        usdt_address_ready = bool((get_setting_value("usdt_address", "") or '').strip())
 
-        checks = [
-            ("人工审核路径", "✅ 可用（无需额外配置）"),
-            ("USDT 开关", "✅ 开启" if usdt_enabled else "⚠️ 关闭"),
-            ("USDT 地址", "✅ 已设置" if usdt_address_ready else "⚠️ 未设置"),
-        ]
+async def _msg_panelcfg_input_url(update, context, text):
+    user_id = update.effective_user.id
+    save_runtime_config(panel_url=text.strip())
+    context.user_data.pop('panelcfg_input_url', None)
+    await cleanup_panelcfg_prompt_message(context, user_id)
+    await update.message.reply_text("✅ 面板地址已更新", reply_markup=PANEL_CONFIG_BACK_KB)
 
-        lines = ["🧪 **支付设置自检报告**", ""]
-        for name, result in checks:
-            lines.append(f"• {name}：{result}")
 
-        suggestions = []
-        if usdt_enabled and not usdt_address_ready:
-            suggestions.append("USDT 已开启，但未设置收款地址。")
-        if not usdt_enabled:
-            suggestions.append("USDT 未开启；客户端将仅显示人工审核路径。")
+async def _msg_panelcfg_input_token(update, context, text):
+    user_id = update.effective_user.id
+    save_runtime_config(panel_token=text.strip())
+    context.user_data.pop('panelcfg_input_token', None)
+    await cleanup_panelcfg_prompt_message(context, user_id)
+    await update.message.reply_text("✅ 面板 Token 已更新", reply_markup=PANEL_CONFIG_BACK_KB)
 
-        if suggestions:
-            lines.extend(["", "🔧 建议修复："])
-            lines.extend([f"- {x}" for x in suggestions])
-        else:
-            lines.extend(["", "🎉 配置检查通过，支付流程可正常使用。"])
 
-        kb = [
-            [InlineKeyboardButton("🔙 返回收款设置", callback_data="admin_pay_settings")],
-            [InlineKeyboardButton("🏠 返回主页", callback_data="back_home")],
-        ]
-        await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup(kb))
-        return
+async def _msg_panelcfg_input_subdomain(update, context, text):
+    user_id = update.effective_user.id
+    save_runtime_config(sub_domain=text.strip())
+    context.user_data.pop('panelcfg_input_subdomain', None)
+    await cleanup_panelcfg_prompt_message(context, user_id)
+    await update.message.reply_text("✅ 订阅域名已更新", reply_markup=PANEL_CONFIG_BACK_KB)
 
-    if data == "set_payimg_usdt":
-        context.user_data['set_payimg'] = 'usdt'
-        back_cb = "admin_pay_usdt_cfg"
-        await send_or_edit_menu(update, context, "📷 请发送收款二维码图片（可发送照片或图片文件）", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data=back_cb)]]))
-        return
 
-    if data == "admin_broadcast_start":
-        context.user_data['broadcast_mode'] = True
-        await send_or_edit_menu(update, context, "📢 **群发通知模式**\n请发送要广播的内容（文字/图片/文件）。\n发送后将自动群发给所有用户。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="cancel_op")]]))
-        return
-    if data == "admin_subscription_settings":
-        settings_payload = await get_subscription_settings()
-        preview = json.dumps(settings_payload, ensure_ascii=False, indent=2)[:1200] if settings_payload else '{}'
-        history = get_json_setting('subscription_settings_history', [])
-        latest_ts = history[-1]['ts'] if isinstance(history, list) and history else None
-        latest_text = datetime.datetime.fromtimestamp(latest_ts).strftime('%m-%d %H:%M') if latest_ts else '暂无'
-        msg = (
-            "⚙️ **订阅设置（可视化）**\n"
-            "当前配置（截断显示）：\n"
-            "```json\n"
-            f"{preview}\n"
-            "```\n\n"
-            f"最近回滚点：`{latest_text}`\n"
-            "可使用模板快速应用，或直接发送 JSON 更新。"
-        )
-        kb = [
-            [InlineKeyboardButton("✍️ 修改订阅设置(JSON)", callback_data="admin_subscription_settings_edit")],
-            [InlineKeyboardButton("🧩 应用安全模板", callback_data="admin_subsettings_tpl_safe"), InlineKeyboardButton("🧩 应用兼容模板", callback_data="admin_subsettings_tpl_compat")],
-            [InlineKeyboardButton("💾 保存回滚点", callback_data="admin_subsettings_snapshot"), InlineKeyboardButton("↩️ 回滚最近一次", callback_data="admin_subsettings_rollback")],
-            [InlineKeyboardButton("🔙 返回", callback_data="back_home")],
-        ]
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
-        return
-    if data == "admin_subsettings_snapshot":
-        payload = await get_subscription_settings()
-        push_subscription_settings_snapshot(payload, source='手动保存')
-        append_ops_timeline('配置', '订阅设置保存回滚点', '管理员保存当前订阅设置快照', actor=query.from_user.id)
-        await query.answer("✅ 已保存回滚点", show_alert=True)
-        await send_or_edit_menu(update, context, "✅ 已保存当前订阅设置为回滚点。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_subscription_settings")]]))
-        return
-    if data in {"admin_subsettings_tpl_safe", "admin_subsettings_tpl_compat"}:
+async def _msg_panelcfg_input_group(update, context, text):
+    user_id = update.effective_user.id
+    save_runtime_config(group_uuid=text.strip())
+    context.user_data.pop('panelcfg_input_group', None)
+    await cleanup_panelcfg_prompt_message(context, user_id)
+    await update.message.reply_text("✅ 默认组 UUID 已更新", reply_markup=PANEL_CONFIG_BACK_KB)
+
+
+async def _msg_edit_subscription_settings(update, context, text):
+    user_id = update.effective_user.id
+    try:
+        payload = _json_loads(text)
+        if not isinstance(payload, dict):
+            raise ValueError('必须是JSON对象')
         current = await get_subscription_settings()
-        push_subscription_settings_snapshot(current, source='模板应用前自动备份')
-        payload = {'allowInsecure': False} if data.endswith('safe') else {'allowInsecure': True}
-        resp = await patch_subscription_settings(payload)
-        if resp and resp.status_code in (200, 204):
-            tpl = '安全模板' if data.endswith('safe') else '兼容模板'
-            append_ops_timeline('配置', f'应用{tpl}', f'payload={json.dumps(payload, ensure_ascii=False)}', actor=query.from_user.id)
-            await query.answer("✅ 模板应用成功", show_alert=True)
-            await send_or_edit_menu(update, context, f"✅ 已应用{tpl}。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_subscription_settings")]]))
-        else:
-            await query.answer("❌ 模板应用失败", show_alert=True)
-        return
-    if data == "admin_subsettings_rollback":
-        snap = pop_subscription_settings_snapshot()
-        if not snap:
-            await query.answer("⚠️ 暂无可回滚快照", show_alert=True)
-            return
-        payload = snap.get('payload') or {}
+        await asyncio.to_thread(push_subscription_settings_snapshot, current, source='手工JSON变更前自动备份')
         resp = await patch_subscription_settings(payload)
+        context.user_data.pop('edit_subscription_settings', None)
         if resp and resp.status_code in (200, 204):
-            append_ops_timeline('配置', '订阅设置回滚', f"来源={snap.get('source', '-')}", actor=query.from_user.id)
-            await query.answer("✅ 回滚成功", show_alert=True)
-            await send_or_edit_menu(update, context, "✅ 已按最近回滚点恢复设置。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_subscription_settings")]]))
+            await asyncio.to_thread(append_ops_timeline, '配置', '手动更新订阅设置', _json_dumps(payload)[:180], actor=user_id)
+            await update.message.reply_text("✅ 订阅设置已更新", reply_markup=SUBSCRIPTION_SETTINGS_BACK_KB)
         else:
-            await query.answer("❌ 回滚失败", show_alert=True)
-        return
-    if data == "admin_subscription_settings_edit":
-        context.user_data['edit_subscription_settings'] = True
-        await send_or_edit_menu(update, context, "✍️ 请发送要 PATCH 的 JSON 内容（例如 {\"allowInsecure\":false}）", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="cancel_op")]]))
-        return
-    if data == "admin_squads_menu":
-        squads = await get_internal_squads()
-        summary, suggestion = await build_squad_capacity_summary()
-        kb = []
-        for s in squads[:20]:
-            suuid = s.get('uuid') or ''
-            sname = s.get('name') or suuid[:8]
-            kb.append([InlineKeyboardButton(f"🧩 {sname}", callback_data=f"admin_squad_{suuid}")])
-        if suggestion and suggestion['from'] != '未分组' and suggestion['to'] != '未分组':
-            kb.append([InlineKeyboardButton("🚚 一键迁移建议", callback_data=f"admin_squad_suggest_{suggestion['from']}__{suggestion['to']}__{suggestion['count']}")])
-        kb.append([InlineKeyboardButton("🚚 批量迁移到分组", callback_data="admin_squad_bulk_move")])
-        kb.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
-        await send_or_edit_menu(update, context, f"🧩 **用户分组（内部组）**\n{summary}", InlineKeyboardMarkup(kb))
-        return
-    if data.startswith("admin_squad_suggest_"):
-        parts = data.replace("admin_squad_suggest_", "").split("__")
-        if len(parts) != 3:
-            await query.answer("建议参数错误", show_alert=True)
-            return
-        from_squad, to_squad, cnt_text = parts
-        try:
-            move_n = max(1, min(int(cnt_text), 20))
-        except ValueError:
-            move_n = 5
-        rows = db_query("SELECT uuid FROM subscriptions ORDER BY id DESC LIMIT 120")
-        pool = [dict(r)['uuid'] for r in rows]
-        infos = await asyncio.gather(*[get_panel_user(u) for u in pool])
-        candidates = []
-        for uid, info in zip(pool, infos):
-            if not isinstance(info, dict):
-                continue
-            squad = info.get('externalSquadUuid')
-            if squad == from_squad:
-                candidates.append(uid)
-            if len(candidates) >= move_n:
-                break
-        if not candidates:
-            await query.answer("暂无可迁移候选用户", show_alert=True)
-            return
-        resp = await bulk_move_users_to_squad(candidates, to_squad)
+            await update.message.reply_text("❌ 更新失败，请检查字段", reply_markup=CANCEL_OP_KB)
+    except Exception as exc:
+        await update.message.reply_text(f"❌ JSON解析或更新失败: {exc}", reply_markup=CANCEL_OP_KB)
+
+
+async def _msg_squad_bulk_move(update, context, text):
+    try:
+        lines = [x.strip() for x in text.splitlines() if x.strip()]
+        if len(lines) < 2:
+            raise ValueError('格式不正确，至少需要分组UUID和1个用户UUID')
+        squad_uuid = lines[0]
+        uuids = parse_uuids("\n".join(lines[1:]))
+        if not uuids:
+            raise ValueError('未解析到有效用户UUID')
+        resp = await bulk_move_users_to_squad(uuids, squad_uuid)
+        context.user_data.pop('squad_bulk_move', None)
         if resp and resp.status_code in (200, 201, 204):
-            append_ops_timeline('分组', '执行迁移建议', f'from={from_squad},to={to_squad},count={len(candidates)}', actor=query.from_user.id)
-            await query.answer(f"✅ 已迁移 {len(candidates)} 人", show_alert=True)
-        else:
-            await query.answer("❌ 迁移失败", show_alert=True)
-        return
-    if data == "admin_squad_bulk_move":
-        context.user_data['squad_bulk_move'] = True
-        await send_or_edit_menu(update, context, "✍️ 请按以下格式发送：\n第一行：目标分组UUID\n后续行：用户UUID列表", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_squads_menu")]]))
-        return
-    if data.startswith("admin_squad_"):
-        squad_uuid = data.replace("admin_squad_", "")
-        nodes, node_err = await get_internal_squad_accessible_nodes_verbose(squad_uuid)
-        lines = ["🧩 **分组详情**", f"UUID: `{squad_uuid}`", "", "可访问节点："]
-        if not nodes and node_err:
-            reason_map = {
-                'config_missing': "面板地址或 Token 未配置。",
-                'auth_unauthorized': "面板鉴权失败（401），请检查 Token。",
-                'auth_forbidden': "当前 Token 无权限访问该接口（403）。",
-                'endpoint_or_squad_not_found': "接口或分组不存在（404）。",
-                'network_error': "请求失败，请检查面板连通性。",
-                'empty_payload': "接口返回为空。",
-            }
-            lines.append(f"- ⚠️ 无法加载节点：{reason_map.get(node_err, node_err)}")
-        elif not nodes:
-            lines.append("- 暂无可访问节点")
-        else:
-            for n in nodes[:20]:
-                node_name = (
-                    n.get('name')
-                    or n.get('nodeName')
-                    or n.get('remark')
-                    or n.get('uuid')
-                    or '未知节点'
-                )
-                lines.append(f"- {node_name}")
-        kb = [[InlineKeyboardButton("🔙 返回分组", callback_data="admin_squads_menu")]]
-        await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup(kb))
-        return
-    if data == "admin_bandwidth_dashboard":
-        nodes_rt = await get_bandwidth_nodes_realtime()
-        top = []
-        for it in nodes_rt[:5]:
-            name = it.get('name') or it.get('nodeName') or '未知节点'
-            val = it.get('totalTrafficBytes') or it.get('trafficBytes') or 0
-            top.append((name, int(val) if isinstance(val, (int, float)) else 0))
-        top.sort(key=lambda x: x[1], reverse=True)
-        lines = ["📈 **带宽看板（实时）**", "TOP节点："]
-        if not top:
-            lines.append("- 暂无数据")
-        for name, val in top:
-            lines.append(f"- {name}: {round(val / 1024**3, 2)} GB")
-        top_users = await build_top_users_traffic()
-        lines.append("\nTOP用户流量：")
-        if not top_users:
-            lines.append("- 暂无")
-        for tg_id, uid, used in top_users:
-            lines.append(f"- 用户`{tg_id}` / `{uid[:8]}`: {round(used / 1024**3, 2)} GB")
-        alerts = detect_bandwidth_volatility(nodes_rt)
-        lines.append("\n节点波动提醒：")
-        if not alerts:
-            lines.append("- 暂无明显波动")
-        else:
-            for name, delta, ratio in alerts[:5]:
-                symbol = '⬆️' if delta > 0 else '⬇️'
-                lines.append(f"- {symbol} {name}: {round(delta / 1024**3, 2)} GB ({round(ratio*100, 1)}%)")
-        stats = await get_subscription_history_stats()
-        hourly = stats.get('hourlyRequestStats') if isinstance(stats, dict) else []
-        recent = int(hourly[-1].get('requestCount', 0)) if hourly else 0
-        lines.append(f"\n最近1小时请求数：`{recent}`")
-        await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
-        return
-    if data == "admin_risk_policy":
-        low = get_setting_value('risk_low_score', '80')
-        high = get_setting_value('risk_high_score', '130')
-        unfreeze_hours = get_setting_value('risk_auto_unfreeze_hours', '12')
-        watchlist = sorted(list(get_risk_watchlist()))[:8]
-        watch_preview = '、'.join(x[:8] for x in watchlist) if watchlist else '暂无'
-        msg = (
-            "🛡️ **风控策略（多级）**\n"
-            f"低风险阈值: {low}\n"
-            f"高风险阈值: {high}\n"
-            f"自动解封时长(小时): {unfreeze_hours}\n"
-            f"执行模式: {get_setting_value('risk_enforce_mode', 'enforce')}\n"
-            f"观察名单(预览): {watch_preview}\n\n"
-            "请通过下方按钮进入修改流程。"
-        )
-        kb = [
-            [InlineKeyboardButton("✍️ 修改阈值", callback_data="admin_risk_policy_edit")],
-            [InlineKeyboardButton("⏱ 设置自动解封时长", callback_data="admin_risk_unfreeze_edit")],
-            [InlineKeyboardButton("👀 查看观察名单", callback_data="admin_risk_watchlist")],
-            [InlineKeyboardButton("🧪 切换灰度模式", callback_data="admin_risk_mode_cycle")],
-            [InlineKeyboardButton("🔙 返回", callback_data="back_home")],
-        ]
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
-        return
-    if data == "admin_risk_policy_edit":
-        context.user_data['edit_risk_policy'] = True
-        await send_or_edit_menu(update, context, "✍️ 请发送：低阈值,高阈值（例如 80,130）", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_risk_policy")]]))
-        return
-    if data == "admin_risk_unfreeze_edit":
-        context.user_data['edit_risk_unfreeze_hours'] = True
-        await send_or_edit_menu(update, context, "⏱ 请输入自动解封时长（小时，整数，例如 12）", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_risk_policy")]]))
-        return
-    if data == "admin_risk_watchlist":
-        watchlist = sorted(list(get_risk_watchlist()))
-        lines = ["👀 **观察名单**"]
-        if not watchlist:
-            lines.append("暂无记录")
-        else:
-            for uid in watchlist[:30]:
-                lines.append(f"- `{uid}`")
-        kb = [[InlineKeyboardButton("🧹 清空观察名单", callback_data="admin_risk_watchlist_clear")], [InlineKeyboardButton("🔙 返回", callback_data="admin_risk_policy")]]
-        await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup(kb))
-        return
-    if data == "admin_risk_watchlist_clear":
-        set_risk_watchlist(set())
-        append_ops_timeline('风控', '清空观察名单', '管理员手动清空', actor=query.from_user.id)
-        await query.answer("✅ 已清空", show_alert=True)
-        await send_or_edit_menu(update, context, "✅ 观察名单已清空。", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_risk_policy")]]))
-        return
-    if data == "admin_risk_mode_cycle":
-        curr = get_setting_value('risk_enforce_mode', 'enforce')
-        nxt = {'enforce': 'gray', 'gray': 'observe', 'observe': 'enforce'}.get(curr, 'enforce')
-        set_setting_value('risk_enforce_mode', nxt)
-        append_ops_timeline('风控', '切换执行模式', f'{curr}->{nxt}', actor=query.from_user.id)
-        await query.answer(f"已切换: {nxt}", show_alert=True)
-        await send_or_edit_menu(update, context, f"✅ 风控执行模式已切换为 {nxt}", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_risk_policy")]]))
-        return
-    if data == "admin_risk_audit":
-        rows = db_query("SELECT * FROM anomaly_events ORDER BY created_at DESC LIMIT 20")
-        lines = ["🧾 **风控回溯（最近20条）**"]
-        if not rows:
-            lines.append("暂无记录")
-        for r in rows:
-            it = dict(r)
-            ts = datetime.datetime.fromtimestamp(int(it['created_at'])).strftime('%m-%d %H:%M')
-            lines.append(f"- {ts} | {it['risk_level']} | {it['user_uuid'][:8]} | 分数{it['risk_score']} | 动作:{it['action_taken']}")
-        await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
-        return
-    if data == "admin_ops_timeline":
-        lines = ["🕒 **操作时间线（订单+风控+配置）**"]
-        events = []
-        order_logs = db_query("SELECT order_id, action, actor_id, detail, created_at FROM order_audit_logs ORDER BY created_at DESC LIMIT 15")
-        for r in order_logs:
-            it = dict(r)
-            events.append((int(it['created_at']), f"订单 | {it['action']} | {it['order_id']} | {it.get('detail') or '-'}"))
-        risk_logs = db_query("SELECT user_uuid, risk_level, risk_score, action_taken, created_at FROM anomaly_events ORDER BY created_at DESC LIMIT 15")
-        for r in risk_logs:
-            it = dict(r)
-            events.append((int(it['created_at']), f"风控 | {it['risk_level']} | {it['user_uuid'][:8]} | {it['action_taken']}"))
-        for item in get_json_setting('ops_timeline', [])[-20:]:
-            events.append((int(item.get('ts', 0)), f"{item.get('type','系统')} | {item.get('title','-')} | {item.get('detail','-')}"))
-        events.sort(key=lambda x: x[0], reverse=True)
-        if not events:
-            lines.append('暂无记录')
-        for ts, text_line in events[:25]:
-            ts_text = datetime.datetime.fromtimestamp(ts).strftime('%m-%d %H:%M') if ts else '--'
-            lines.append(f"- {ts_text} | {text_line[:120]}")
-        await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
-        return
-    if data == "admin_bulk_menu":
-        msg = """📚 **批量用户操作**
-
-请选择操作类型：
-- 批量重置流量
-- 批量禁用
-- 批量删除
-- 批量改到期日
-- 批量改流量包"""
-        kb = [
-            [InlineKeyboardButton("🔄 批量重置流量", callback_data="bulk_reset")],
-            [InlineKeyboardButton("⛔ 批量禁用", callback_data="bulk_disable")],
-            [InlineKeyboardButton("🗑 批量删除", callback_data="bulk_delete")],
-            [InlineKeyboardButton("📅 批量改到期日", callback_data="bulk_expire")],
-            [InlineKeyboardButton("📡 批量改流量包", callback_data="bulk_traffic")],
-            [InlineKeyboardButton("🔙 返回", callback_data="back_home")],
-        ]
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
-        return
-    if data in {"bulk_reset", "bulk_disable", "bulk_delete"}:
-        context.user_data['bulk_action'] = data.replace('bulk_', '')
-        tip = "每行一个UUID，或使用空格/逗号分隔。"
-        await send_or_edit_menu(update, context, f"✍️ 请输入用户UUID列表\n{tip}", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_bulk_menu")]]))
-        return
-    if data == "bulk_expire":
-        context.user_data['bulk_action'] = 'expire'
-        tip = "第一行输入天数（例如 30），从第二行开始输入UUID列表。"
-        await send_or_edit_menu(update, context, f"✍️ 批量改到期日\n{tip}", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_bulk_menu")]]))
-        return
-    if data == "bulk_traffic":
-        context.user_data['bulk_action'] = 'traffic'
-        tip = "第一行输入流量GB（例如 200），从第二行开始输入UUID列表。"
-        await send_or_edit_menu(update, context, f"✍️ 批量改流量包\n{tip}", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="admin_bulk_menu")]]))
-        return
-    if data == "admin_orders_menu":
-        await show_orders_menu(update, context)
-        return
-    if data.startswith("admin_orders_status_"):
-        status_filter = data.replace("admin_orders_status_", "")
-        await show_orders_menu(update, context, status_filter=status_filter)
-        return
-    if data.startswith("admin_orders_page_"):
-        _, _, _, status_raw, page_raw = data.split("_", 4)
-        status_filter = None if status_raw == 'all' else status_raw
-        try:
-            page = int(page_raw)
-        except ValueError:
-            page = 0
-        await show_orders_menu(update, context, status_filter=status_filter, page=page)
-        return
-    if data.startswith("admin_order_"):
-        order_id = data.replace("admin_order_", "")
-        order = db_query("SELECT * FROM orders WHERE order_id = ?", (order_id,), one=True)
-        if not order:
-            await send_or_edit_menu(update, context, "⚠️ 订单不存在", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_orders_menu")]]))
-            return
-        item = dict(order)
-        logs = db_query("SELECT * FROM order_audit_logs WHERE order_id=? ORDER BY created_at DESC LIMIT 5", (item['order_id'],))
-        txt = format_order_detail(item, [dict(x) for x in logs])
-        kb = [[InlineKeyboardButton("🔙 返回", callback_data="admin_orders_menu")]]
-        if item.get('status') == STATUS_FAILED:
-            kb.insert(0, [InlineKeyboardButton("♻️ 重试发货", callback_data=f"rt_{item['order_id']}")])
-        await send_or_edit_menu(update, context, txt, InlineKeyboardMarkup(kb))
-        return
-    if data == "anomaly_whitelist_menu":
-        await show_anomaly_whitelist_menu(update, context)
-        return
-    if data == "anomaly_whitelist_add":
-        context.user_data['add_anomaly_whitelist'] = True
-        await send_or_edit_menu(update, context, "✍️ 请输入要加入白名单的用户 UUID", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 取消", callback_data="anomaly_whitelist_menu")]]))
-        return
-    if data.startswith("anomaly_whitelist_del_"):
-        uuid_val = data.replace("anomaly_whitelist_del_", "")
-        db_execute("DELETE FROM anomaly_whitelist WHERE user_uuid = ?", (uuid_val,))
-        await show_anomaly_whitelist_menu(update, context)
-        return
-    if data.startswith("anomaly_quick_whitelist_"):
-        uid = data.replace("anomaly_quick_whitelist_", "")
-        db_execute("INSERT OR IGNORE INTO anomaly_whitelist (user_uuid, created_at) VALUES (?, ?)", (uid, int(time.time())))
-        await query.answer("✅ 已加入白名单", show_alert=False)
-        return
-    if data.startswith("anomaly_quick_enable_"):
-        uid = data.replace("anomaly_quick_enable_", "")
-        await enable_panel_user(uid)
-        await query.answer("✅ 已尝试解封该用户", show_alert=False)
-        return
-    if data == "admin_plans_list":
-        await show_plans_menu(update, context)
-    elif data.startswith("plan_detail_"):
-        key = data.split("_")[2]
-        p = db_query("SELECT * FROM plans WHERE key = ?", (key,), one=True)
-        if not p: return
-        try:
-            p_dict = dict(p)
-            strategy = p_dict.get('reset_strategy', 'NO_RESET')
-            s_text = get_strategy_label(strategy)
-        except Exception as exc:
-            logger.warning("failed to read plan strategy for %s: %s", key, exc)
-            s_text = '总流量'
-        msg = f"📦 **套餐详情**\n\n🏷 名称：`{p_dict['name']}`\n💰 人民币：`{p_dict['price']}`\n🪙 USDT：`{(p_dict.get('usdt_price') or '未设置')} USDT`\n⏳ 时长：`{p_dict['days']} 天`\n📡 流量：`{p_dict['gb']} GB`\n🔄 策略：`{s_text}`"
-        keyboard = [[InlineKeyboardButton("🗑 删除此套餐", callback_data=f"del_plan_{key}")], [InlineKeyboardButton("🔙 返回列表", callback_data="admin_plans_list")]]
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(keyboard))
-    elif data.startswith("del_plan_"):
-        key = data.split("_")[2]
-        db_execute("DELETE FROM plans WHERE key = ?", (key,))
-        await query.answer("✅ 套餐已删除", show_alert=True)
-        await show_plans_menu(update, context)
-    elif data == "admin_users_list":
-        users = db_query("SELECT DISTINCT tg_id, MAX(created_at) as created_at FROM subscriptions GROUP BY tg_id ORDER BY created_at DESC LIMIT 20")
-        keyboard = []
-        for u in users:
-            u_dict = dict(u)
-            ts = u_dict['created_at']
-            date_str = datetime.datetime.fromtimestamp(int(ts)).strftime('%m-%d')
-            btn_text = f"🆔 {u_dict['tg_id']} | {date_str}"
-            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"list_user_subs_{u_dict['tg_id']}")])
-        keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
-        await send_or_edit_menu(update, context, "👥 **用户管理 (最近20名)**\n点击ID查看其名下订阅：", InlineKeyboardMarkup(keyboard))
-        
-    elif data.startswith("list_user_subs_"):
-        target_uid = int(data.split("_")[3])
-        subs = db_query("SELECT * FROM subscriptions WHERE tg_id = ?", (target_uid,))
-        keyboard = []
-        for s in subs:
-            s_dict = dict(s)
-            short_uuid = s_dict['uuid'][:8]
-            keyboard.append([InlineKeyboardButton(f"UUID: {short_uuid}...", callback_data=f"manage_user_{s_dict['uuid']}")])
-        keyboard.append([InlineKeyboardButton("🔙 返回列表", callback_data="admin_users_list")])
-        await send_or_edit_menu(update, context, f"👤 用户 `{target_uid}` 的订阅列表：", InlineKeyboardMarkup(keyboard))
-
-    elif data.startswith("manage_user_"):
-        target_uuid = data.replace("manage_user_", "")
-        sub = db_query("SELECT * FROM subscriptions WHERE uuid = ?", (target_uuid,), one=True)
-        if not sub:
-            await send_or_edit_menu(update, context, "⚠️ 记录不存在", InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_users_list")]]))
-            return
-        panel_info = await get_panel_user(target_uuid)
-        status = "🟢 面板正常" if panel_info else "🔴 面板已删"
-        user_nodes, user_nodes_err = [], None
-        if PANEL_URL and PANEL_TOKEN:
-            resp = await safe_api_request('GET', f"/users/{target_uuid}/accessible-nodes")
-            if not resp:
-                user_nodes_err = "network_error"
-            elif resp.status_code == 401:
-                user_nodes_err = "auth_unauthorized"
-            elif resp.status_code == 403:
-                user_nodes_err = "auth_forbidden"
-            elif resp.status_code == 404:
-                user_nodes_err = "endpoint_or_user_not_found"
-            elif resp.status_code == 200:
-                payload = extract_payload(resp)
-                if isinstance(payload, list):
-                    user_nodes = payload
-                elif isinstance(payload, dict):
-                    nodes = payload.get('accessibleNodes')
-                    if isinstance(nodes, list):
-                        user_nodes = nodes
-                    else:
-                        user_nodes_err = "empty_payload"
-                else:
-                    user_nodes_err = "empty_payload"
-            else:
-                user_nodes_err = f"http_{resp.status_code}"
-        else:
-            user_nodes_err = "config_missing"
-        node_lines = ["可访问节点："]
-        if user_nodes:
-            for n in user_nodes[:10]:
-                node_name = n.get('name') or n.get('nodeName') or n.get('remark') or n.get('uuid') or '未知节点'
-                node_lines.append(f"- {node_name}")
-        else:
-            reason_map = {
-                "config_missing": "面板地址或 Token 未配置",
-                "network_error": "面板网络不可达",
-                "auth_unauthorized": "Token 鉴权失败(401)",
-                "auth_forbidden": "Token 权限不足(403)",
-                "endpoint_or_user_not_found": "接口或用户不存在(404)",
-                "empty_payload": "接口返回为空",
-            }
-            node_lines.append(f"- ⚠️ {reason_map.get(user_nodes_err, user_nodes_err or '暂无')}")
-        msg = (f"👤 **用户详情**\nTG ID: `{dict(sub)['tg_id']}`\n状态: {status}\nUUID: `{target_uuid}`\n\n" + "\n".join(node_lines))
-        keyboard = [
-            [InlineKeyboardButton("🔄 重置流量", callback_data=f"reset_traffic_{target_uuid}")],
-            [InlineKeyboardButton("📜 最近请求记录", callback_data=f"user_reqhist_{target_uuid}")],
-            [InlineKeyboardButton("🗑 确认删除用户", callback_data=f"confirm_del_user_{target_uuid}")],
-            [InlineKeyboardButton("🔙 返回列表", callback_data=f"list_user_subs_{dict(sub)['tg_id']}")],
-        ]
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(keyboard))
-    elif data.startswith("user_reqhist_"):
-        target_uuid = data.replace("user_reqhist_", "")
-        sub = db_query("SELECT * FROM subscriptions WHERE uuid = ?", (target_uuid,), one=True)
-        history = await get_user_subscription_history(target_uuid)
-        records = history.get('records') if isinstance(history, dict) else None
-        total = history.get('total') if isinstance(history, dict) else None
-        if not isinstance(records, list):
-            records = []
-        lines = [f"📜 **请求记录（最近{len(records)}条）**", f"UUID: `{target_uuid}`"]
-        if isinstance(total, int):
-            lines.append(f"总记录数: `{total}`")
-        lines.append("")
-        if not records:
-            lines.append("暂无请求记录")
+            await update.message.reply_text(f"✅ 已提交批量迁移，目标{len(uuids)}个用户", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_squads_menu")]]))
         else:
-            for rec in records[:10]:
-                req_at = format_time(rec.get('requestAt'))
-                req_ip = rec.get('requestIp') or '未知IP'
-                ua = (rec.get('userAgent') or '未知UA')[:40]
-                lines.append(f"• `{req_at}` | `{req_ip}` | `{ua}`")
-        back_tg = dict(sub)['tg_id'] if sub else ADMIN_ID
-        kb = [[InlineKeyboardButton("🔙 返回用户", callback_data=f"manage_user_{target_uuid}")], [InlineKeyboardButton("🔙 返回列表", callback_data=f"list_user_subs_{back_tg}")]]
-        await send_or_edit_menu(update, context, "\n".join(lines), InlineKeyboardMarkup(kb))
-    elif data.startswith("reset_traffic_"):
-        target_uuid = data.replace("reset_traffic_", "")
-        resp = await reset_panel_user_traffic(target_uuid)
-        if resp and resp.status_code == 204: await query.answer("✅ 流量已重置", show_alert=True)
-        else: await query.answer("❌ 操作失败", show_alert=True)
-    elif data.startswith("confirm_del_user_"):
-        target_uuid = data.replace("confirm_del_user_", "")
-        await delete_panel_user(target_uuid)
-        db_execute("DELETE FROM subscriptions WHERE uuid = ?", (target_uuid,))
-        await query.answer("✅ 用户已删除", show_alert=True)
-        await show_users_list(update, context)
-    elif data == "admin_notify":
-        try:
-            val = db_query("SELECT value FROM settings WHERE key='notify_days'", one=True)
-            day = val['value'] if val else 3
-        except Exception as exc:
-            logger.warning("failed to load notify_days setting: %s", exc)
-            day = 3
-        kb = [[InlineKeyboardButton("🔙 取消", callback_data="cancel_op")]]
-        await send_or_edit_menu(update, context, f"🔔 **提醒设置**\n当前：到期前 {day} 天发送提醒\n\n**⬇️ 请回复新的天数（纯数字）：**", InlineKeyboardMarkup(kb))
-        context.user_data['setting_notify'] = True
-    elif data == "admin_cleanup":
-        try:
-            val = db_query("SELECT value FROM settings WHERE key='cleanup_days'", one=True)
-            day = val['value'] if val else 7
-        except Exception as exc:
-            logger.warning("failed to load cleanup_days setting: %s", exc)
-            day = 7
-        kb = [[InlineKeyboardButton("🔙 取消", callback_data="cancel_op")]]
-        await send_or_edit_menu(update, context, f"🗑 **清理设置**\n当前：过期后 {day} 天自动删除\n(过期1天将只禁用)\n\n**⬇️ 请回复新的天数（纯数字）：**", InlineKeyboardMarkup(kb))
-        context.user_data['setting_cleanup'] = True
-    elif data == "admin_anomaly_menu":
-        try:
-            val_int = db_query("SELECT value FROM settings WHERE key='anomaly_interval'", one=True)
-            interval = val_int['value'] if val_int else 1
-            val_thr = db_query("SELECT value FROM settings WHERE key='anomaly_threshold'", one=True)
-            threshold = val_thr['value'] if val_thr else 50
-        except Exception as exc:
-            logger.warning("failed to load anomaly settings: %s", exc)
-            interval=1; threshold=50
-        stats = await get_subscription_history_stats()
-        by_app = stats.get('byParsedApp') if isinstance(stats, dict) else None
-        app_top = "暂无"
-        if isinstance(by_app, list) and by_app:
-            top = sorted(by_app, key=lambda x: x.get('count', 0), reverse=True)[:3]
-            app_top = ", ".join(f"{(x.get('app') or 'unknown')}:{int(x.get('count', 0))}" for x in top)
-        hourly = stats.get('hourlyRequestStats') if isinstance(stats, dict) else None
-        hourly_last = int(hourly[-1].get('requestCount', 0)) if isinstance(hourly, list) and hourly else 0
-        msg = (
-            f"🛡️ **异常检测设置**\n\n"
-            f"⏱️ 检测周期：每 {interval} 小时\n"
-            f"🔢 封禁阈值：单周期 > {threshold} 个IP\n"
-            f"📊 最近1小时请求量：`{hourly_last}`\n"
-            f"📱 TOP客户端：`{app_top}`\n\n"
-            "检测支持多级处置：低风险告警入观察名单，中风险限速，高风险禁用。"
-        )
-        kb = [[InlineKeyboardButton("⏱️ 设置周期", callback_data="set_anomaly_interval"), InlineKeyboardButton("🔢 设置阈值", callback_data="set_anomaly_threshold")],[InlineKeyboardButton("📋 白名单", callback_data="anomaly_whitelist_menu"), InlineKeyboardButton("🛡️ 风控策略", callback_data="admin_risk_policy")],[InlineKeyboardButton("🧾 风控回溯", callback_data="admin_risk_audit")],[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb))
-    elif data == "set_anomaly_interval":
-        kb = [[InlineKeyboardButton("🔙 取消", callback_data="admin_anomaly_menu")]]
-        await send_or_edit_menu(update, context, "⏱️ **请输入检测周期 (小时)**\n例如：0.5 (半小时) 或 1 (一小时)", InlineKeyboardMarkup(kb))
-        context.user_data['setting_anomaly_interval'] = True
-    elif data == "set_anomaly_threshold":
-        kb = [[InlineKeyboardButton("🔙 取消", callback_data="admin_anomaly_menu")]]
-        await send_or_edit_menu(update, context, "🔢 **请输入封禁阈值 (IP数量)**\n例如：50", InlineKeyboardMarkup(kb))
-        context.user_data['setting_anomaly_threshold'] = True
-    elif data.startswith("set_strategy_"):
-        strategy = data.replace("set_strategy_", "")
-        new_plan = context.user_data['new_plan']
-        key = f"p{int(time.time())}"
-        db_execute("INSERT INTO plans (key, name, price, usdt_price, days, gb, reset_strategy) VALUES (?, ?, ?, ?, ?, ?, ?)", (key, new_plan['name'], new_plan['price'], new_plan['usdt_price'], new_plan['days'], new_plan['gb'], strategy))
-        del context.user_data['add_plan_step']
-        strategy_label = get_strategy_label(strategy)
-        msg = (
-            "✅ 套餐添加成功！\n"
-            f"套餐名称：{new_plan['name']}\n"
-            f"重置策略：{strategy_label} ({strategy})"
-        )
-        kb = [
-            [InlineKeyboardButton("📦 返回套餐管理", callback_data="admin_plans_list")],
-            [InlineKeyboardButton("🏠 返回主菜单", callback_data="back_home")],
-        ]
-        await send_or_edit_menu(update, context, msg, InlineKeyboardMarkup(kb), parse_mode=None)
+            await update.message.reply_text("❌ 迁移失败，请检查分组UUID与用户UUID", reply_markup=CANCEL_OP_KB)
+    except Exception as exc:
+        await update.message.reply_text(f"❌ 迁移失败: {exc}", reply_markup=CANCEL_OP_KB)
 
-async def show_users_list(update, context):
-    users = db_query("SELECT DISTINCT tg_id, MAX(created_at) as created_at FROM subscriptions GROUP BY tg_id ORDER BY created_at DESC LIMIT 20")
-    keyboard = []
-    for u in users:
-        u_dict = dict(u)
-        ts = u_dict['created_at']
-        date_str = datetime.datetime.fromtimestamp(int(ts)).strftime('%m-%d')
-        btn_text = f"🆔 {u_dict['tg_id']} | {date_str}"
-        keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"list_user_subs_{u_dict['tg_id']}")])
-    keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="back_home")])
-    await send_or_edit_menu(update, context, "👥 **用户管理 (最近20名)**\n点击ID查看其名下订阅：", InlineKeyboardMarkup(keyboard))
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message or not update.effective_user:
-        logger.debug("skip message update without effective_user or message")
-        return
+async def _msg_edit_risk_policy(update, context, text):
+    try:
+        low_text, high_text = [x.strip() for x in text.split(',', 1)]
+        low = int(low_text)
+        high = int(high_text)
+        if low <= 0 or high <= low:
+            raise ValueError('要求 低阈值>0 且 高阈值>低阈值')
+        await aset_setting_values({'risk_low_score': low, 'risk_high_score': high})
+        context.user_data.pop('edit_risk_policy', None)
+        await update.message.reply_text(f"✅ 风控策略已更新：低={low} 高={high}", reply_markup=ANOMALY_MENU_BACK_KB)
+    except Exception as exc:
+        await update.message.reply_text(f"❌ 参数错误: {exc}", reply_markup=CANCEL_OP_KB)
+
+
+async def _msg_edit_risk_unfreeze_hours(update, context, text):
     user_id = update.effective_user.id
-    text = update.message.text
-    cancel_kb = InlineKeyboardMarkup([[InlineKeyboardButton("❌ 取消", callback_data="cancel_op")]])
-
-    if user_id == ADMIN_ID and context.user_data.get('set_payimg'):
-        pay_type = context.user_data.get('set_payimg')
-        file_id = None
-        if update.message.photo:
-            file_id = update.message.photo[-1].file_id
-        elif update.message.document and (update.message.document.mime_type or '').startswith('image/'):
-            file_id = update.message.document.file_id
-        if not file_id:
-            await update.message.reply_text("❌ 请发送图片文件", reply_markup=cancel_kb)
-            return
-        key_map = {'usdt': 'usdt_qr_file_id'}
-        key = key_map.get(pay_type, 'usdt_qr_file_id')
-        set_setting_value(key, file_id)
-        context.user_data.pop('set_payimg', None)
-        label_map = {'usdt': 'USDT'}
-        back_map = {'usdt': 'admin_pay_usdt_cfg'}
-        label = label_map.get(pay_type, 'USDT')
-        await update.message.reply_text(f"✅ 已更新{label}收款码。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data=back_map.get(pay_type, 'admin_pay_settings'))]]))
-        return
+    try:
+        val = int(text.strip())
+        if val <= 0:
+            raise ValueError('必须大于0')
+        await aset_setting_value('risk_auto_unfreeze_hours', val)
+        context.user_data.pop('edit_risk_unfreeze_hours', None)
+        await asyncio.to_thread(append_ops_timeline, '风控', '修改自动解封时长', f'hours={val}', actor=user_id)
+        await update.message.reply_text(f"✅ 自动解封时长已更新为 {val} 小时", reply_markup=RISK_POLICY_BACK_KB)
+    except Exception as exc:
+        await update.message.reply_text(f"❌ 参数错误: {exc}", reply_markup=CANCEL_OP_KB)
 
-    if user_id == ADMIN_ID and context.user_data.get('paycfg_input_usdt_network') and text:
-        set_setting_value('usdt_network', text.strip().upper()[:12])
-        context.user_data.pop('paycfg_input_usdt_network', None)
-        await update.message.reply_text("✅ USDT 网络已更新。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_pay_usdt_cfg")]]))
-        return
 
-    if user_id == ADMIN_ID and context.user_data.get('paycfg_input_usdt_address') and text:
-        set_setting_value('usdt_address', text.strip())
-        context.user_data.pop('paycfg_input_usdt_address', None)
-        await update.message.reply_text("✅ USDT 地址已更新。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_pay_usdt_cfg")]]))
+async def _msg_reply_to_uid(update, context, text):
+    user_id = update.effective_user.id
+    target_uid = context.user_data['reply_to_uid']
+    back_cb = context.user_data.get('reply_back_cb', 'back_home')
+    try:
+        await context.bot.copy_message(chat_id=target_uid, from_chat_id=user_id, message_id=update.message.message_id)
+        set_support_reply_session(context, target_uid, source='admin_direct_reply', admin_id=user_id)
+        logger.info("admin message delivered and support context activated: admin=%s target_user=%s", user_id, target_uid)
+        await upsert_support_control_message(
+            context,
+            target_uid,
+            "👆 **来自客服/管理员的回复**\n你现在处于客服会话模式，下一条消息将直接发送给客服。",
+            InlineKeyboardMarkup([
+                [InlineKeyboardButton("✉️ 继续回复客服", callback_data="contact_support")],
+                [InlineKeyboardButton("🚪 结束会话", callback_data="back_home")],
+            ]),
+        )
+        await cleanup_admin_reply_prompt(context, user_id, context.user_data, reason='send_success')
+        await update.message.reply_text("✅ 回复已送达，已进入会话状态。")
+    except Exception as e:
+        await update.message.reply_text(f"❌ 发送失败：{e}")
+        admin_done_kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回上一页", callback_data=back_cb)]])
+        await update.message.reply_text("你可以重试，或返回上一页。", reply_markup=admin_done_kb)
+    del context.user_data['reply_to_uid']
+    context.user_data.pop('reply_back_cb', None)
+
+
+async def _msg_setting_notify(update, context, text):
+    if text.isdigit():
+        await aset_setting_value('notify_days', text)
+        context.user_data['setting_notify'] = False
+        await update.message.reply_text(f"✅ 已设置：到期前 {text} 天提醒。", reply_markup=BACK_HOME_KB)
+    else: await update.message.reply_text("❌ 请输入数字", reply_markup=CANCEL_OP_KB)
+
+
+async def _msg_setting_cleanup(update, context, text):
+    if text.isdigit():
+        await aset_setting_value('cleanup_days', text)
+        context.user_data['setting_cleanup'] = False
+        await update.message.reply_text(f"✅ 已设置：过期后 {text} 天自动删除。", reply_markup=BACK_HOME_KB)
+    else: await update.message.reply_text("❌ 请输入数字", reply_markup=CANCEL_OP_KB)
+
+
+async def _msg_setting_anomaly_interval(update, context, text):
+    try:
+        val = float(text)
+        if val <= 0: raise ValueError
+        await aset_setting_value('anomaly_interval', text)
+        context.user_data['setting_anomaly_interval'] = False
+        await reschedule_anomaly_job(context.application, val)
+        await update.message.reply_text(f"✅ 周期已更新：每 {val} 小时检测一次。", reply_markup=ANOMALY_MENU_BACK_KB)
+    except (ValueError, TypeError):
+        await update.message.reply_text("❌ 请输入有效的数字 (例如 0.5 或 1)", reply_markup=CANCEL_OP_KB)
+
+
+async def _msg_setting_anomaly_threshold(update, context, text):
+    if text.isdigit():
+        await aset_setting_value('anomaly_threshold', text)
+        context.user_data['setting_anomaly_threshold'] = False
+        await update.message.reply_text(f"✅ 阈值已更新：> {text} IP 封禁。", reply_markup=ANOMALY_MENU_BACK_KB)
+    else: await update.message.reply_text("❌ 请输入整数", reply_markup=CANCEL_OP_KB)
+
+
+async def _msg_add_anomaly_whitelist(update, context, text):
+    value = text.strip()
+    if len(value) < 8:
+        await update.message.reply_text("❌ 请输入有效 UUID")
         return
+    await add_anomaly_whitelist(value)
+    context.user_data['add_anomaly_whitelist'] = False
+    await update.message.reply_text("✅ 白名单已添加。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="anomaly_whitelist_menu")]]))
 
-    if user_id == ADMIN_ID and context.user_data.get('panel_user_lookup_mode') and text:
-        raw = text.strip()
-        lookup_type = "auto"
-        lookup_value = raw
-        if ":" in raw:
-            lookup_type, lookup_value = [x.strip() for x in raw.split(":", 1)]
-            lookup_type = lookup_type.lower()
-        panel_user = None
-        if lookup_type in {"tg", "telegram", "telegram_id", "auto"} and lookup_value.isdigit():
-            panel_user = await get_user_by_telegram_id(int(lookup_value))
-            lookup_type = "telegramId"
-        elif lookup_type in {"username", "user"}:
-            panel_user = await get_user_by_username(lookup_value)
-            lookup_type = "username"
-        elif lookup_type in {"uuid"}:
-            panel_user = await get_panel_user(lookup_value)
-            lookup_type = "uuid"
-        elif lookup_type in {"short", "short_uuid"}:
-            panel_user = await get_user_by_short_uuid(lookup_value)
-            lookup_type = "shortUuid"
-        elif lookup_value.isdigit():
-            panel_user = await get_user_by_telegram_id(int(lookup_value))
-            lookup_type = "telegramId"
-        else:
-            panel_user = await get_user_by_username(lookup_value)
-            lookup_type = "username"
 
-        if not isinstance(panel_user, dict):
+async def _msg_bulk_action(update, context, text):
+    action = context.user_data.get('bulk_action')
+    try:
+        pending = context.user_data.get('bulk_pending')
+        if pending:
+            if text.strip() != '确认执行':
+                context.user_data.pop('bulk_pending', None)
+                context.user_data.pop('bulk_action', None)
+                await update.message.reply_text(
+                    '已取消批量执行。',
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_bulk_menu")]]),
+                )
+                return
+            uuids = pending['uuids']
+            extra = pending.get('extra')
+            ok, fail = await run_bulk_action(safe_api_request, action, uuids, extra_fields=extra)
+            context.user_data.pop('bulk_action', None)
+            context.user_data.pop('bulk_pending', None)
             await update.message.reply_text(
-                "❌ 未找到面板用户，或当前 Token 无权限访问该检索接口。",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔎 继续检索", callback_data="admin_panel_user_lookup")], [InlineKeyboardButton("🏠 返回主页", callback_data="back_home")]]),
+                f"✅ 批量操作完成\n成功: {ok}\n失败: {fail}",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_bulk_menu")]]),
             )
             return
 
-        puuid = panel_user.get('uuid') or '-'
-        puser = panel_user.get('username') or '-'
-        ptg = panel_user.get('telegramId')
-        pstatus = panel_user.get('status') or '-'
-        pstrategy = panel_user.get('trafficLimitStrategy') or '-'
-        lines = [
-            "✅ 检索到面板用户",
-            f"检索方式: {lookup_type}",
-            f"UUID: {puuid}",
-            f"用户名: {puser}",
-            f"Telegram ID: {ptg if ptg is not None else '-'}",
-            f"状态: {pstatus}",
-            f"重置策略: {pstrategy}",
-        ]
-        kb = [[InlineKeyboardButton("🔎 继续检索", callback_data="admin_panel_user_lookup")], [InlineKeyboardButton("🏠 返回主页", callback_data="back_home")]]
-        if puuid != '-' and isinstance(ptg, int):
-            kb.insert(0, [InlineKeyboardButton("🔗 绑定到本地订阅", callback_data=f"bind_panel_user_{ptg}_{puuid}")])
-        await update.message.reply_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(kb))
-        return
+        if action in {'reset', 'disable', 'delete'}:
+            uuids = parse_uuids(text)
+            extra = None
+            preview = {'reset': '批量重置流量', 'disable': '批量禁用', 'delete': '批量删除'}[action]
+        elif action == 'expire':
+            expire_at, uuids = parse_expire_days_and_uuids(text)
+            extra = {'expireAt': expire_at}
+            preview = f"批量改到期时间 -> {expire_at}"
+        elif action == 'traffic':
+            traffic_bytes, uuids = parse_traffic_and_uuids(text)
+            extra = {'trafficLimitBytes': traffic_bytes}
+            preview = f"批量改流量包 -> {traffic_bytes // (1024**3)}GB"
+        else:
+            await update.message.reply_text("❌ 未知操作类型", reply_markup=CANCEL_OP_KB)
+            return
 
-    if user_id == ADMIN_ID and context.user_data.get('broadcast_mode'):
-        user_rows = db_query("SELECT DISTINCT tg_id FROM subscriptions")
-        order_rows = db_query("SELECT DISTINCT tg_id FROM orders")
-        targets = {int(dict(r)['tg_id']) for r in user_rows} | {int(dict(r)['tg_id']) for r in order_rows}
-        ok = 0
-        fail = 0
-        for uid in targets:
-            try:
-                await context.bot.copy_message(chat_id=uid, from_chat_id=user_id, message_id=update.message.message_id)
-                ok += 1
-            except Exception:
-                fail += 1
-        context.user_data.pop('broadcast_mode', None)
-        await update.message.reply_text(f"📢 群发完成\n成功: {ok}\n失败: {fail}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")]]))
-        return
-    if user_id == ADMIN_ID and context.user_data.get('panelcfg_input_url') and text:
-        save_runtime_config(panel_url=text.strip())
-        context.user_data.pop('panelcfg_input_url', None)
-        await cleanup_panelcfg_prompt_message(context, user_id)
-        await update.message.reply_text("✅ 面板地址已更新", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_panel_config")]]))
-        return
-    if user_id == ADMIN_ID and context.user_data.get('panelcfg_input_token') and text:
-        save_runtime_config(panel_token=text.strip())
-        context.user_data.pop('panelcfg_input_token', None)
-        await cleanup_panelcfg_prompt_message(context, user_id)
-        await update.message.reply_text("✅ 面板 Token 已更新", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_panel_config")]]))
-        return
-    if user_id == ADMIN_ID and context.user_data.get('panelcfg_input_subdomain') and text:
-        save_runtime_config(sub_domain=text.strip())
-        context.user_data.pop('panelcfg_input_subdomain', None)
-        await cleanup_panelcfg_prompt_message(context, user_id)
-        await update.message.reply_text("✅ 订阅域名已更新", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_panel_config")]]))
-        return
-    if user_id == ADMIN_ID and context.user_data.get('panelcfg_input_group') and text:
-        save_runtime_config(group_uuid=text.strip())
-        context.user_data.pop('panelcfg_input_group', None)
-        await cleanup_panelcfg_prompt_message(context, user_id)
-        await update.message.reply_text("✅ 默认组 UUID 已更新", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_panel_config")]]))
-        return
-    if user_id == ADMIN_ID and context.user_data.get('edit_subscription_settings') and text:
-        try:
-            payload = json.loads(text)
-            if not isinstance(payload, dict):
-                raise ValueError('必须是JSON对象')
-            current = await get_subscription_settings()
-            push_subscription_settings_snapshot(current, source='手工JSON变更前自动备份')
-            resp = await patch_subscription_settings(payload)
-            context.user_data.pop('edit_subscription_settings', None)
-            if resp and resp.status_code in (200, 204):
-                append_ops_timeline('配置', '手动更新订阅设置', json.dumps(payload, ensure_ascii=False)[:180], actor=user_id)
-                await update.message.reply_text("✅ 订阅设置已更新", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_subscription_settings")]]))
-            else:
-                await update.message.reply_text("❌ 更新失败，请检查字段", reply_markup=cancel_kb)
-        except Exception as exc:
-            await update.message.reply_text(f"❌ JSON解析或更新失败: {exc}", reply_markup=cancel_kb)
-        return
+        if not uuids:
+            await update.message.reply_text("❌ 未解析到有效UUID，请检查输入格式", reply_markup=CANCEL_OP_KB)
+            return
 
-    if user_id == ADMIN_ID and context.user_data.get('squad_bulk_move') and text:
-        try:
-            lines = [x.strip() for x in text.splitlines() if x.strip()]
-            if len(lines) < 2:
-                raise ValueError('格式不正确，至少需要分组UUID和1个用户UUID')
-            squad_uuid = lines[0]
-            uuids = parse_uuids("\n".join(lines[1:]))
-            if not uuids:
-                raise ValueError('未解析到有效用户UUID')
-            resp = await bulk_move_users_to_squad(uuids, squad_uuid)
-            context.user_data.pop('squad_bulk_move', None)
-            if resp and resp.status_code in (200, 201, 204):
-                await update.message.reply_text(f"✅ 已提交批量迁移，目标{len(uuids)}个用户", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_squads_menu")]]))
-            else:
-                await update.message.reply_text("❌ 迁移失败，请检查分组UUID与用户UUID", reply_markup=cancel_kb)
-        except Exception as exc:
-            await update.message.reply_text(f"❌ 迁移失败: {exc}", reply_markup=cancel_kb)
-        return
+        context.user_data['bulk_pending'] = {'uuids': uuids, 'extra': extra}
+        await update.message.reply_text(
+            f"🧪 预检查完成\n操作: {preview}\n目标数量: {len(uuids)}\n\n如确认执行，请回复：确认执行\n回复其他任意内容将取消。",
+            reply_markup=CANCEL_OP_KB,
+        )
+    except Exception as exc:
+        context.user_data.pop('bulk_pending', None)
+        await update.message.reply_text(f"❌ 批量操作失败: {exc}", reply_markup=CANCEL_OP_KB)
+
+
+async def _msg_add_plan_step(update, context, text):
+    step = context.user_data['add_plan_step']
+    if step == 'name':
+        context.user_data['new_plan'] = {'name': text}
+        context.user_data['add_plan_step'] = 'price'
+        await update.message.reply_text("📝 **步骤 2/6：请输入人民币价格**\n(例如: 200元)", reply_markup=CANCEL_OP_KB, parse_mode='Markdown')
+    elif step == 'price':
+        context.user_data['new_plan']['price'] = text
+        context.user_data['add_plan_step'] = 'usdt_price'
+        await update.message.reply_text("🪙 **步骤 3/6：请输入 USDT 价格**\n(例如: 28)", reply_markup=CANCEL_OP_KB, parse_mode='Markdown')
+    elif step == 'usdt_price':
+        if not text or not text.strip():
+            return await update.message.reply_text("❌ USDT 价格不能为空", reply_markup=CANCEL_OP_KB)
+        context.user_data['new_plan']['usdt_price'] = text.strip()
+        context.user_data['add_plan_step'] = 'days'
+        await update.message.reply_text("📅 **步骤 4/6：请输入有效期天数**\n(请输入纯数字，例如: 30)", reply_markup=CANCEL_OP_KB, parse_mode='Markdown')
+    elif step == 'days':
+        if not text.isdigit(): return await update.message.reply_text("❌ 请输入数字", reply_markup=CANCEL_OP_KB)
+        context.user_data['new_plan']['days'] = int(text)
+        context.user_data['add_plan_step'] = 'gb'
+        await update.message.reply_text("📡 **步骤 5/6：请输入流量限制 GB**\n(请输入纯数字，例如: 100)", reply_markup=CANCEL_OP_KB, parse_mode='Markdown')
+    elif step == 'gb':
+        if not text.isdigit(): return await update.message.reply_text("❌ 请输入数字", reply_markup=CANCEL_OP_KB)
+        context.user_data['new_plan']['gb'] = int(text)
+        keyboard = [[InlineKeyboardButton("🚫 永不重置", callback_data="set_strategy_NO_RESET")], [InlineKeyboardButton("📅 每日重置", callback_data="set_strategy_DAY")], [InlineKeyboardButton("🗓 每周重置", callback_data="set_strategy_WEEK")], [InlineKeyboardButton("🌝 每月重置", callback_data="set_strategy_MONTH")], [InlineKeyboardButton("🌙 按开通日每月重置", callback_data="set_strategy_MONTH_ROLLING")], [InlineKeyboardButton("❌ 取消", callback_data="cancel_op")]]
+        await update.message.reply_text("🔄 **步骤 6/6：请选择流量重置策略**", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+
+# 管理员输入态按原有优先级排列；客服会话转发位于两组之间
+_ADMIN_MESSAGE_STATES = (
+    MessageState('set_payimg', _msg_set_payimg, needs_text=False),
+    MessageState('paycfg_input_usdt_network', _msg_paycfg_input_usdt_network),
+    MessageState('paycfg_input_usdt_address', _msg_paycfg_input_usdt_address),
+    MessageState('panel_user_lookup_mode', _msg_panel_user_lookup_mode),
+    MessageState('broadcast_mode', _msg_broadcast_mode, needs_text=False),
+    MessageState('panelcfg_input_url', _msg_panelcfg_input_url),
+    MessageState('panelcfg_input_token', _msg_panelcfg_input_token),
+    MessageState('panelcfg_input_subdomain', _msg_panelcfg_input_subdomain),
+    MessageState('panelcfg_input_group', _msg_panelcfg_input_group),
+    MessageState('edit_subscription_settings', _msg_edit_subscription_settings),
+    MessageState('squad_bulk_move', _msg_squad_bulk_move),
+    MessageState('edit_risk_policy', _msg_edit_risk_policy),
+    MessageState('edit_risk_unfreeze_hours', _msg_edit_risk_unfreeze_hours),
+    MessageState('reply_to_uid', _msg_reply_to_uid, needs_text=False, by_presence=True),
+)
+_ADMIN_MESSAGE_STATES_AFTER_SUPPORT = (
+    MessageState('setting_notify', _msg_setting_notify),
+    MessageState('setting_cleanup', _msg_setting_cleanup),
+    MessageState('setting_anomaly_interval', _msg_setting_anomaly_interval),
+    MessageState('setting_anomaly_threshold', _msg_setting_anomaly_threshold),
+    MessageState('add_anomaly_whitelist', _msg_add_anomaly_whitelist),
+    MessageState('bulk_action', _msg_bulk_action),
+    MessageState('add_plan_step', _msg_add_plan_step, by_presence=True),
+)
 
-    if user_id == ADMIN_ID and context.user_data.get('edit_risk_policy') and text:
-        try:
-            low_text, high_text = [x.strip() for x in text.split(',', 1)]
-            low = int(low_text)
-            high = int(high_text)
-            if low <= 0 or high <= low:
-                raise ValueError('要求 低阈值>0 且 高阈值>低阈值')
-            set_setting_value('risk_low_score', low)
-            set_setting_value('risk_high_score', high)
-            context.user_data.pop('edit_risk_policy', None)
-            await update.message.reply_text(f"✅ 风控策略已更新：低={low} 高={high}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_anomaly_menu")]]))
-        except Exception as exc:
-            await update.message.reply_text(f"❌ 参数错误: {exc}", reply_markup=cancel_kb)
-        return
-    if user_id == ADMIN_ID and context.user_data.get('edit_risk_unfreeze_hours') and text:
-        try:
-            val = int(text.strip())
-            if val <= 0:
-                raise ValueError('必须大于0')
-            set_setting_value('risk_auto_unfreeze_hours', val)
-            context.user_data.pop('edit_risk_unfreeze_hours', None)
-            append_ops_timeline('风控', '修改自动解封时长', f'hours={val}', actor=user_id)
-            await update.message.reply_text(f"✅ 自动解封时长已更新为 {val} 小时", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_risk_policy")]]))
-        except Exception as exc:
-            await update.message.reply_text(f"❌ 参数错误: {exc}", reply_markup=cancel_kb)
-        return
-    if user_id == ADMIN_ID and 'reply_to_uid' in context.user_data:
-        target_uid = context.user_data['reply_to_uid']
-        back_cb = context.user_data.get('reply_back_cb', 'back_home')
-        try:
-            await context.bot.copy_message(chat_id=target_uid, from_chat_id=user_id, message_id=update.message.message_id)
-            set_support_reply_session(context, target_uid, source='admin_direct_reply', admin_id=user_id)
-            logger.info("admin message delivered and support context activated: admin=%s target_user=%s", user_id, target_uid)
-            await upsert_support_control_message(
-                context,
-                target_uid,
-                "👆 **来自客服/管理员的回复**\n你现在处于客服会话模式，下一条消息将直接发送给客服。",
-                InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✉️ 继续回复客服", callback_data="contact_support")],
-                    [InlineKeyboardButton("🚪 结束会话", callback_data="back_home")],
-                ]),
-            )
-            await cleanup_admin_reply_prompt(context, user_id, context.user_data, reason='send_success')
-            await update.message.reply_text("✅ 回复已送达，已进入会话状态。")
-        except Exception as e:
-            await update.message.reply_text(f"❌ 发送失败：{e}")
-            admin_done_kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回上一页", callback_data=back_cb)]])
-            await update.message.reply_text("你可以重试，或返回上一页。", reply_markup=admin_done_kb)
-        del context.user_data['reply_to_uid']
-        context.user_data.pop('reply_back_cb', None)
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message or not update.effective_user:
+        logger.debug("skip message update without effective_user or message")
         return
+    user_id = update.effective_user.id
+    text = update.message.text
+
+    if user_id == ADMIN_ID:
+        handler = resolve_message_state(context.user_data, bool(text), _ADMIN_MESSAGE_STATES)
+        if handler is not None:
+            await handler(update, context, text)
+            return
     support_ctx = get_support_reply_session(context, user_id)
     if not support_ctx and context.user_data.get('chat_mode') == 'support':
         fallback_ctx = context.user_data.get('support_reply_context') or {}
@@ -2511,129 +3459,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             InlineKeyboardMarkup([[InlineKeyboardButton("🚪 结束会话", callback_data="back_home")]]),
         )
         return
-    if user_id == ADMIN_ID and context.user_data.get('setting_notify') and text:
-        if text.isdigit():
-            db_execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('notify_days', ?)", (text,))
-            context.user_data['setting_notify'] = False
-            await update.message.reply_text(f"✅ 已设置：到期前 {text} 天提醒。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
-        else: await update.message.reply_text("❌ 请输入数字", reply_markup=cancel_kb)
-        return
-    if user_id == ADMIN_ID and context.user_data.get('setting_cleanup') and text:
-        if text.isdigit():
-            db_execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('cleanup_days', ?)", (text,))
-            context.user_data['setting_cleanup'] = False
-            await update.message.reply_text(f"✅ 已设置：过期后 {text} 天自动删除。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]]))
-        else: await update.message.reply_text("❌ 请输入数字", reply_markup=cancel_kb)
-        return
-    if user_id == ADMIN_ID and context.user_data.get('setting_anomaly_interval') and text:
-        try:
-            val = float(text)
-            if val <= 0: raise ValueError
-            db_execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('anomaly_interval', ?)", (text,))
-            context.user_data['setting_anomaly_interval'] = False
-            await reschedule_anomaly_job(context.application, val)
-            await update.message.reply_text(f"✅ 周期已更新：每 {val} 小时检测一次。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_anomaly_menu")]]))
-        except (ValueError, TypeError):
-            await update.message.reply_text("❌ 请输入有效的数字 (例如 0.5 或 1)", reply_markup=cancel_kb)
-        return
-    if user_id == ADMIN_ID and context.user_data.get('setting_anomaly_threshold') and text:
-        if text.isdigit():
-            db_execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('anomaly_threshold', ?)", (text,))
-            context.user_data['setting_anomaly_threshold'] = False
-            await update.message.reply_text(f"✅ 阈值已更新：> {text} IP 封禁。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_anomaly_menu")]]))
-        else: await update.message.reply_text("❌ 请输入整数", reply_markup=cancel_kb)
-        return
-
-    if user_id == ADMIN_ID and context.user_data.get('add_anomaly_whitelist') and text:
-        value = text.strip()
-        if len(value) < 8:
-            await update.message.reply_text("❌ 请输入有效 UUID")
+    if user_id == ADMIN_ID:
+        handler = resolve_message_state(context.user_data, bool(text), _ADMIN_MESSAGE_STATES_AFTER_SUPPORT)
+        if handler is not None:
+            await handler(update, context, text)
             return
-        db_execute("INSERT OR IGNORE INTO anomaly_whitelist (user_uuid, created_at) VALUES (?, ?)", (value, int(time.time())))
-        context.user_data['add_anomaly_whitelist'] = False
-        await update.message.reply_text("✅ 白名单已添加。", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="anomaly_whitelist_menu")]]))
-        return
-    if user_id == ADMIN_ID and context.user_data.get('bulk_action') and text:
-        action = context.user_data.get('bulk_action')
-        try:
-            pending = context.user_data.get('bulk_pending')
-            if pending:
-                if text.strip() != '确认执行':
-                    context.user_data.pop('bulk_pending', None)
-                    context.user_data.pop('bulk_action', None)
-                    await update.message.reply_text(
-                        '已取消批量执行。',
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_bulk_menu")]]),
-                    )
-                    return
-                uuids = pending['uuids']
-                extra = pending.get('extra')
-                ok, fail = await run_bulk_action(safe_api_request, action, uuids, extra_fields=extra)
-                context.user_data.pop('bulk_action', None)
-                context.user_data.pop('bulk_pending', None)
-                await update.message.reply_text(
-                    f"✅ 批量操作完成\n成功: {ok}\n失败: {fail}",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="admin_bulk_menu")]]),
-                )
-                return
-
-            if action in {'reset', 'disable', 'delete'}:
-                uuids = parse_uuids(text)
-                extra = None
-                preview = {'reset': '批量重置流量', 'disable': '批量禁用', 'delete': '批量删除'}[action]
-            elif action == 'expire':
-                expire_at, uuids = parse_expire_days_and_uuids(text)
-                extra = {'expireAt': expire_at}
-                preview = f"批量改到期时间 -> {expire_at}"
-            elif action == 'traffic':
-                traffic_bytes, uuids = parse_traffic_and_uuids(text)
-                extra = {'trafficLimitBytes': traffic_bytes}
-                preview = f"批量改流量包 -> {traffic_bytes // (1024**3)}GB"
-            else:
-                await update.message.reply_text("❌ 未知操作类型", reply_markup=cancel_kb)
-                return
-
-            if not uuids:
-                await update.message.reply_text("❌ 未解析到有效UUID，请检查输入格式", reply_markup=cancel_kb)
-                return
-
-            context.user_data['bulk_pending'] = {'uuids': uuids, 'extra': extra}
-            await update.message.reply_text(
-                f"🧪 预检查完成\n操作: {preview}\n目标数量: {len(uuids)}\n\n如确认执行，请回复：确认执行\n回复其他任意内容将取消。",
-                reply_markup=cancel_kb,
-            )
-        except Exception as exc:
-            context.user_data.pop('bulk_pending', None)
-            await update.message.reply_text(f"❌ 批量操作失败: {exc}", reply_markup=cancel_kb)
-        return
-    if user_id == ADMIN_ID and 'add_plan_step' in context.user_data and text:
-        step = context.user_data['add_plan_step']
-        if step == 'name':
-            context.user_data['new_plan'] = {'name': text}
-            context.user_data['add_plan_step'] = 'price'
-            await update.message.reply_text("📝 **步骤 2/6：请输入人民币价格**\n(例如: 200元)", reply_markup=cancel_kb, parse_mode='Markdown')
-        elif step == 'price':
-            context.user_data['new_plan']['price'] = text
-            context.user_data['add_plan_step'] = 'usdt_price'
-            await update.message.reply_text("🪙 **步骤 3/6：请输入 USDT 价格**\n(例如: 28)", reply_markup=cancel_kb, parse_mode='Markdown')
-        elif step == 'usdt_price':
-            if not text or not text.strip():
-                return await update.message.reply_text("❌ USDT 价格不能为空", reply_markup=cancel_kb)
-            context.user_data['new_plan']['usdt_price'] = text.strip()
-            context.user_data['add_plan_step'] = 'days'
-            await update.message.reply_text("📅 **步骤 4/6：请输入有效期天数**\n(请输入纯数字，例如: 30)", reply_markup=cancel_kb, parse_mode='Markdown')
-        elif step == 'days':
-            if not text.isdigit(): return await update.message.reply_text("❌ 请输入数字", reply_markup=cancel_kb)
-            context.user_data['new_plan']['days'] = int(text)
-            context.user_data['add_plan_step'] = 'gb'
-            await update.message.reply_text("📡 **步骤 5/6：请输入流量限制 GB**\n(请输入纯数字，例如: 100)", reply_markup=cancel_kb, parse_mode='Markdown')
-        elif step == 'gb':
-            if not text.isdigit(): return await update.message.reply_text("❌ 请输入数字", reply_markup=cancel_kb)
-            context.user_data['new_plan']['gb'] = int(text)
-            keyboard = [[InlineKeyboardButton("🚫 永不重置", callback_data="set_strategy_NO_RESET")], [InlineKeyboardButton("📅 每日重置", callback_data="set_strategy_DAY")], [InlineKeyboardButton("🗓 每周重置", callback_data="set_strategy_WEEK")], [InlineKeyboardButton("🌝 每月重置", callback_data="set_strategy_MONTH")], [InlineKeyboardButton("🌙 按开通日每月重置", callback_data="set_strategy_MONTH_ROLLING")], [InlineKeyboardButton("❌ 取消", callback_data="cancel_op")]]
-            await update.message.reply_text("🔄 **步骤 6/6：请选择流量重置策略**", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-        return
-    pending_order = get_pending_order_for_user(db_query, user_id)
+    pending_order = await aget_pending_order_for_user(user_id)
     if pending_order:
         logger.info("user message routed to pending-order proof: user=%s order=%s", user_id, pending_order.get('order_id'))
         awaiting_order_id = context.user_data.get('awaiting_manual_review_proof_order_id')
@@ -2656,21 +3487,28 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         proof['order_id'] = pending_order['order_id']
         context.user_data['pending_payment_proof'] = proof
-        await submit_manual_review_proof(update, context, pending_order, proof)
+        async with _user_order_lock(context.application, user_id):
+            await submit_manual_review_proof(update, context, pending_order, proof)
         return
 
 async def add_plan_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     context.user_data['add_plan_step'] = 'name'
-    await query.edit_message_text("📝 **步骤 1/6：开始添加套餐**\n\n请输入套餐名称:", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ 取消", callback_data="cancel_op")]]), parse_mode='Markdown')
+    await query.edit_message_text("📝 **步骤 1/6：开始添加套餐**\n\n请输入套餐名称:", reply_markup=CANCEL_OP_KB, parse_mode='Markdown')
 
 async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer()
+    # 批量审核时限制同时进行的面板写入与消息发送
+    async with PANEL_WORK_SEMAPHORE:
+        await _process_order(update, context)
+
+
+async def _process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     data = query.data
-    client_return_btn = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")]])
-    admin_return_btn = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")]])
+    client_return_btn = RETURN_HOME_KB
+    admin_return_btn = RETURN_HOME_KB
     async def clean_user_waiting_msg(order_record):
         uid = int(order_record.get('tg_id', 0) or 0)
         waiting_message_id = order_record.get('waiting_message_id')
@@ -2685,7 +3523,7 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await context.bot.delete_message(chat_id=uid, message_id=menu_message_id)
             except Exception as exc:
                 logger.debug("failed to delete menu message for uid=%s order=%s: %s", uid, order_record.get('order_id'), exc)
-        db_execute(
+        await adb_execute(
             "UPDATE orders SET waiting_message_id=NULL, menu_message_id=NULL, updated_at=? WHERE order_id=?",
             (int(time.time()), order_record.get('order_id')),
         )
@@ -2707,7 +3545,7 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("rj_"):
         parts = data.split("_")
         order_id = parts[1]
-        order = get_order(db_query, order_id)
+        order = await asyncio.to_thread(get_order, db_query, order_id)
         if not order:
             await query.edit_message_text("⚠️ 订单不存在", reply_markup=admin_return_btn)
             return
@@ -2718,8 +3556,8 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 [InlineKeyboardButton("🧾 再次审核", callback_data=f"review_{parts[1]}_{parts[2]}_{parts[3]}_{parts[4]}")],
                 [InlineKeyboardButton("🔙 返回主菜单", callback_data="back_home")]
             ])
-        update_order_status(db_execute, order_id, [STATUS_PENDING, STATUS_APPROVED], STATUS_REJECTED, error_message='rejected_by_admin')
-        append_order_audit_log(db_execute, order_id, 'reject', query.from_user.id, 'admin_rejected')
+        await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_PENDING, STATUS_APPROVED], STATUS_REJECTED, error_message='rejected_by_admin')
+        await asyncio.to_thread(append_order_audit_log, db_execute, order_id, 'reject', query.from_user.id, 'admin_rejected')
         await query.edit_message_text("❌ 已拒绝", reply_markup=retry_markup)
         await clean_user_waiting_msg(order)
         try:
@@ -2729,16 +3567,16 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if data.startswith("rt_"):
-        order_id = data.split("_", 1)[1]
-        order = get_order(db_query, order_id)
+        order_id = data.removeprefix("rt_")
+        order = await asyncio.to_thread(get_order, db_query, order_id)
         if not order:
             await query.edit_message_text("⚠️ 订单不存在", reply_markup=admin_return_btn)
             return
         if order.get('status') != STATUS_FAILED:
             await query.edit_message_text("⚠️ 仅允许重试失败订单", reply_markup=admin_return_btn)
             return
-        switched = update_order_status(db_execute, order_id, [STATUS_FAILED], STATUS_APPROVED, error_message='retry_by_admin')
-        append_order_audit_log(db_execute, order_id, 'retry', query.from_user.id, 'retry_by_admin')
+        switched = await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_FAILED], STATUS_APPROVED, error_message='retry_by_admin')
+        await asyncio.to_thread(append_order_audit_log, db_execute, order_id, 'retry', query.from_user.id, 'retry_by_admin')
         if not switched:
             await query.edit_message_text("⚠️ 订单状态更新失败，请重试", reply_markup=admin_return_btn)
             return
@@ -2751,7 +3589,7 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     _, order_id, short_id = data.split("_", 2)
-    order = get_order(db_query, order_id)
+    order = await asyncio.to_thread(get_order, db_query, order_id)
     if not order:
         await query.edit_message_text("⚠️ 订单不存在或已过期", reply_markup=admin_return_btn)
         return
@@ -2764,7 +3602,7 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(f"⚠️ 当前订单状态不可处理: {order.get('status')}", reply_markup=admin_return_btn)
         return
 
-    claimed = update_order_status(db_execute, order_id, [STATUS_PENDING], STATUS_APPROVED)
+    claimed = await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_PENDING], STATUS_APPROVED)
     if not claimed and order.get('status') != STATUS_APPROVED:
         await query.edit_message_text("⚠️ 订单正在被其他操作处理，请稍后重试", reply_markup=admin_return_btn)
         return
@@ -2774,9 +3612,9 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     order_type = order['order_type']
     target_uuid = order['target_uuid'] if order['target_uuid'] != '0' else get_real_uuid(short_id)
 
-    plan = db_query("SELECT * FROM plans WHERE key = ?", (plan_key,), one=True)
+    plan = get_plan_row(plan_key)
     if not plan:
-        update_order_status(db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message='reason:business_validation|plan_deleted')
+        await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message='reason:business_validation|plan_deleted')
         await query.edit_message_text("❌ 套餐已删除", reply_markup=admin_return_btn)
         return
 
@@ -2790,22 +3628,18 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         if order_type == 'renew':
             if not target_uuid:
-                update_order_status(db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message='reason:business_validation|missing_target_uuid')
+                await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message='reason:business_validation|missing_target_uuid')
                 await query.edit_message_text("⚠️ 订单数据已过期", reply_markup=admin_return_btn)
                 return
             user_info = await get_panel_user(target_uuid)
             if not user_info:
-                update_order_status(db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message='user_not_found')
+                await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message='user_not_found')
                 await query.edit_message_text("⚠️ 用户不存在", reply_markup=admin_return_btn)
                 return
-            current_expire_str = user_info.get('expireAt', '').split('.')[0].replace('Z', '')
             now = datetime.datetime.utcnow()
-            try:
-                current_expire = datetime.datetime.strptime(current_expire_str, "%Y-%m-%dT%H:%M:%S")
-            except ValueError:
-                current_expire = now
+            current_expire = parse_expire_datetime(user_info.get('expireAt', '')) or now
             new_expire = (current_expire + datetime.timedelta(days=add_days)) if current_expire > now else (now + datetime.timedelta(days=add_days))
-            expire_iso = new_expire.strftime("%Y-%m-%dT%H:%M:%SZ")
+            expire_iso = format_iso_z(new_expire)
             new_limit = user_info.get('trafficLimitBytes', 0)
             if reset_strategy == 'NO_RESET':
                 new_limit += add_traffic
@@ -2821,8 +3655,8 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await enable_panel_user(target_uuid)
             r = await patch_panel_user(update_payload)
             if r and r.status_code in [200, 204]:
-                update_order_status(db_execute, order_id, [STATUS_APPROVED], STATUS_DELIVERED, delivered_uuid=target_uuid)
-                append_order_audit_log(db_execute, order_id, 'deliver_success', query.from_user.id, 'renew')
+                await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_APPROVED], STATUS_DELIVERED, delivered_uuid=target_uuid)
+                await asyncio.to_thread(append_order_audit_log, db_execute, order_id, 'deliver_success', query.from_user.id, 'renew')
                 await sync_user_metadata(target_uuid, uid, plan_key=plan_key, order_id=order_id)
                 await query.edit_message_text(f"✅ 续费成功\n用户: {uid}", reply_markup=admin_return_btn)
                 sub_url = user_info.get('subscriptionUrl', '')
@@ -2836,16 +3670,15 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 await clean_user_waiting_msg(order)
                 if sub_url and sub_url.startswith('http'):
-                    qr = generate_qr(sub_url)
-                    await context.bot.send_photo(uid, photo=qr, caption=msg, parse_mode='MarkdownV2', reply_markup=client_return_btn)
+                    await send_sub_qr_photo(context.bot, uid, sub_url, caption=msg, parse_mode='MarkdownV2', reply_markup=client_return_btn)
                 else:
                     await context.bot.send_message(uid, msg, parse_mode='MarkdownV2', reply_markup=client_return_btn)
             else:
-                update_order_status(db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message='reason:network|panel_api_error_renew')
+                await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message='reason:network|panel_api_error_renew')
                 await query.edit_message_text("❌ API报错", reply_markup=admin_return_btn)
         else:
             new_expire = datetime.datetime.utcnow() + datetime.timedelta(days=add_days)
-            expire_iso = new_expire.strftime("%Y-%m-%dT%H:%M:%SZ")
+            expire_iso = format_iso_z(new_expire)
             payload = {
                 "username": f"tg_{uid}_{int(time.time())}",
                 "status": USER_STATUS_ACTIVE,
@@ -2860,12 +3693,12 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if r and r.status_code in [200, 201]:
                 resp_data = extract_payload(r)
                 user_uuid = resp_data.get('uuid')
-                db_execute(
+                await adb_execute(
                     "INSERT INTO subscriptions (tg_id, uuid, created_at, plan_key) VALUES (?, ?, ?, ?)",
                     (uid, user_uuid, int(time.time()), plan_key),
                 )
-                update_order_status(db_execute, order_id, [STATUS_APPROVED], STATUS_DELIVERED, delivered_uuid=user_uuid)
-                append_order_audit_log(db_execute, order_id, 'deliver_success', query.from_user.id, 'new')
+                await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_APPROVED], STATUS_DELIVERED, delivered_uuid=user_uuid)
+                await asyncio.to_thread(append_order_audit_log, db_execute, order_id, 'deliver_success', query.from_user.id, 'new')
                 await sync_user_metadata(user_uuid, uid, plan_key=plan_key, order_id=order_id)
                 await query.edit_message_text(f"✅ 开通成功\n用户: {uid}", reply_markup=admin_return_btn)
                 sub_url = resp_data.get('subscriptionUrl', '')
@@ -2879,105 +3712,154 @@ async def process_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 await clean_user_waiting_msg(order)
                 if sub_url and sub_url.startswith('http'):
-                    qr = generate_qr(sub_url)
-                    await context.bot.send_photo(uid, photo=qr, caption=msg, parse_mode='MarkdownV2', reply_markup=client_return_btn)
+                    await send_sub_qr_photo(context.bot, uid, sub_url, caption=msg, parse_mode='MarkdownV2', reply_markup=client_return_btn)
                 else:
                     await context.bot.send_message(uid, msg, parse_mode='MarkdownV2', reply_markup=client_return_btn)
             else:
-                update_order_status(db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message='reason:network|panel_api_error_new')
+                await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message='reason:network|panel_api_error_new')
                 await query.edit_message_text("❌ 失败", reply_markup=admin_return_btn)
     except Exception as exc:
         logger.exception("Order processing failed for %s", order_id)
         reason = classify_order_failure(str(exc))
         detail = f"reason:{reason}|{str(exc)[:320]}"
-        update_order_status(db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message=detail)
-        append_order_audit_log(db_execute, order_id, 'deliver_failed', query.from_user.id, detail)
+        await asyncio.to_thread(update_order_status, db_execute, order_id, [STATUS_APPROVED], STATUS_FAILED, error_message=detail)
+        await asyncio.to_thread(append_order_audit_log, db_execute, order_id, 'deliver_failed', query.from_user.id, detail)
         await query.edit_message_text(f"❌ 错误: {exc}", reply_markup=admin_return_btn)
 
 async def process_bulk_jobs_job(context: ContextTypes.DEFAULT_TYPE):
     try:
-        rows = db_query("SELECT * FROM bulk_jobs WHERE status='pending' ORDER BY created_at ASC LIMIT 1")
+        rows = await adb_query("SELECT * FROM bulk_jobs WHERE status='pending' ORDER BY created_at ASC LIMIT 1")
         if not rows:
             return
         job = dict(rows[0])
-        db_execute("UPDATE bulk_jobs SET status='running', updated_at=? WHERE id=?", (int(time.time()), job['id']))
-        payload = json.loads(job.get('payload_json') or '{}')
+        await adb_execute("UPDATE bulk_jobs SET status='running', updated_at=? WHERE id=?", (int(time.time()), job['id']))
+        payload = _json_loads(job.get('payload_json') or '{}')
         uuids = payload.get('uuids') or []
         extra = payload.get('extra') or {}
         ok, fail = await run_bulk_action(safe_api_request, job['action'], uuids, extra_fields=extra)
         result = {'ok': ok, 'fail': fail}
         status = 'done' if fail == 0 else 'partial'
-        db_execute("UPDATE bulk_jobs SET status=?, result_json=?, updated_at=? WHERE id=?", (status, json.dumps(result, ensure_ascii=False), int(time.time()), job['id']))
-        append_ops_timeline('批量', '批量任务完成', f"job={job['id']},action={job['action']},ok={ok},fail={fail}", actor='系统')
+        await adb_execute("UPDATE bulk_jobs SET status=?, result_json=?, updated_at=? WHERE id=?", (status, _json_dumps(result), int(time.time()), job['id']))
+        await asyncio.to_thread(append_ops_timeline, '批量', '批量任务完成', f"job={job['id']},action={job['action']},ok={ok},fail={fail}", actor='系统')
     except Exception as exc:
         logger.exception('process_bulk_jobs_job failed: %s', exc)
 
 async def check_expiry_job(context: ContextTypes.DEFAULT_TYPE):
     try: 
-        val = db_query("SELECT value FROM settings WHERE key='notify_days'", one=True)
-        notify_days = int(val['value']) if val else 3
-        val_clean = db_query("SELECT value FROM settings WHERE key='cleanup_days'", one=True)
-        cleanup_days = int(val_clean['value']) if val_clean else 7
+        retention = await aget_setting_values({'notify_days': 3, 'cleanup_days': 7})
+        notify_days = int(retention['notify_days'])
+        cleanup_days = int(retention['cleanup_days'])
     except Exception as exc:
         logger.warning("failed to load expiry job settings: %s", exc)
         notify_days = 3
         cleanup_days = 7
-    subs = db_query("SELECT * FROM subscriptions")
+    subs = await adb_query("SELECT uuid, tg_id, last_notify_expire_at, last_notify_days_left, last_notify_at FROM subscriptions")
     if not subs: return
     now = datetime.datetime.utcnow()
     to_delete_uuids = []
     to_disable_uuids = []
-    sem = asyncio.Semaphore(10)
+    notify_updates = []
+    traffic_updates = []
+    panel_users = {}
+    if len(subs) >= EXPIRY_BULK_FETCH_MIN_SUBS:
+        # 订阅较多时分页拉取全量用户，避免逐个 GET /users/{uuid}
+        all_users = await get_all_panel_users()
+        if all_users:
+            panel_users = {u.get('uuid'): u for u in all_users}
     async def check_single_sub(sub):
-        async with sem:
-            u_dict = dict(sub)
-            info = await get_panel_user(u_dict['uuid'])
+        async with PANEL_WORK_SEMAPHORE:
+            uuid = sub['uuid']
+            tg_id = sub['tg_id']
+            info = panel_users.get(uuid)
+            if info is None:
+                info = await get_panel_user(uuid)
             if not info: return
+            traffic_updates.append(_subscription_traffic_row(uuid, info, int(time.time())))
             try:
-                ex_str = info.get('expireAt', '').split('.')[0].replace('Z','')
-                ex_dt = datetime.datetime.strptime(ex_str, "%Y-%m-%dT%H:%M:%S")
+                ex_dt = parse_expire_datetime(info.get('expireAt', ''))
+                if ex_dt is None:
+                    raise ValueError(f"invalid expireAt: {info.get('expireAt')!r}")
+                # 与历史记录的 last_notify_expire_at 格式保持一致（秒级、无时区后缀）
+                ex_str = ex_dt.isoformat(timespec='seconds')
                 days_left = (ex_dt - now).days
                 if 0 <= days_left <= notify_days:
-                    last_notify_expire = u_dict.get('last_notify_expire_at')
-                    last_notify_days_left = u_dict.get('last_notify_days_left')
-                    last_notify_at = int(u_dict.get('last_notify_at') or 0)
+                    last_notify_expire = sub['last_notify_expire_at']
+                    last_notify_days_left = sub['last_notify_days_left']
+                    last_notify_at = int(sub['last_notify_at'] or 0)
                     now_ts = int(time.time())
                     can_send_by_daily_limit = should_send_expire_notice(last_notify_at, now_ts)
                     if (str(last_notify_expire or '') != ex_str or int(last_notify_days_left or -999) != days_left) and can_send_by_daily_limit:
-                        sid = get_short_id(u_dict['uuid'])
+                        sid = get_short_id(uuid)
                         kb = [[InlineKeyboardButton("💳 立即续费", callback_data=f"selrenew_{sid}")]]
-                        msg = f"⚠️ **续费提醒**\n\n您的订阅 (UUID: `{u_dict['uuid'][:8]}...`) \n将在 **{days_left}** 天后到期。\n请及时续费以免服务中断。"
+                        msg = f"⚠️ **续费提醒**\n\n您的订阅 (UUID: `{uuid[:8]}...`) \n将在 **{days_left}** 天后到期。\n请及时续费以免服务中断。"
                         try:
-                            await context.bot.send_message(u_dict['tg_id'], msg, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
-                            db_execute(
-                                "UPDATE subscriptions SET last_notify_expire_at = ?, last_notify_days_left = ?, last_notify_at = ? WHERE uuid = ?",
-                                (ex_str, days_left, int(time.time()), u_dict['uuid']),
-                            )
+                            await context.bot.send_message(tg_id, msg, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(kb))
+                            notify_updates.append((ex_str, days_left, int(time.time()), uuid))
                         except Exception as exc:
-                            logger.warning("Failed to send expiry notice to %s: %s", u_dict['tg_id'], exc)
+                            logger.warning("Failed to send expiry notice to %s: %s", tg_id, exc)
                 if days_left == -1 and str(info.get('status', '')).lower() == 'active':
-                    to_disable_uuids.append(u_dict['uuid'])
+                    to_disable_uuids.append(uuid)
                 if days_left < -cleanup_days:
-                    to_delete_uuids.append(u_dict['uuid'])
-                    db_execute("DELETE FROM subscriptions WHERE uuid = ?", (u_dict['uuid'],))
+                    to_delete_uuids.append(uuid)
                     try:
-                        await context.bot.send_message(u_dict['tg_id'], f"🗑 您的订阅因过期超过 {cleanup_days} 天已被系统回收。")
+                        await context.bot.send_message(tg_id, f"🗑 您的订阅因过期超过 {cleanup_days} 天已被系统回收。")
                     except Exception as exc:
-                        logger.warning("Failed to notify cleanup to %s: %s", u_dict['tg_id'], exc)
+                        logger.warning("Failed to notify cleanup to %s: %s", tg_id, exc)
             except Exception as e:
-                logger.warning("check_single_sub failed for %s: %s", u_dict.get('uuid'), e)
+                logger.warning("check_single_sub failed for %s: %s", uuid, e)
     tasks = [check_single_sub(sub) for sub in subs]
     await asyncio.gather(*tasks)
+    # 本轮的流量快照、提醒标记与回收删除合并为一个事务提交
+    if traffic_updates or notify_updates or to_delete_uuids:
+        await adb_execute_batch([
+            (_SUB_TRAFFIC_UPDATE_SQL, traffic_updates),
+            ("UPDATE subscriptions SET last_notify_expire_at = ?, last_notify_days_left = ?, last_notify_at = ? WHERE uuid = ?", notify_updates),
+            ("DELETE FROM subscriptions WHERE uuid = ?", [(uuid,) for uuid in to_delete_uuids]),
+        ])
     if to_disable_uuids:
         await apply_user_status_bulk_with_fallback(to_disable_uuids, USER_STATUS_DISABLED)
     if to_delete_uuids:
         await bulk_delete_panel_users(to_delete_uuids)
+        for uuid in to_delete_uuids:
+            forget_short_id(uuid)
+
+async def _dispatch_anomaly_incident(context, item, risk_level, action_taken, score, ip_control_enabled):
+    uid = item['uid']
+    await sync_user_metadata(uid, tg_id="-", risk_level=risk_level)
+
+    if ip_control_enabled and risk_level == '高':
+        for ev in item.get('evidence', [])[:3]:
+            ip = str(ev.get('ip') or '').strip()
+            if ip and ip not in {"-", "unknown"}:
+                await block_panel_ip(ip, f"anomaly_high_risk_score_{score}")
+
+    try:
+        lines = [
+            "🚨 *异常检测（可解释）*",
+            f"风险等级: `{risk_level}` \| 处置: `{action_taken}`",
+            f"用户: `{escape_markdown_v2(uid)}`",
+            f"风险评分: `{score}`",
+            f"IP数量: `{item['ip_count']}` \| UA分散: `{item['ua_diversity']}` \| 请求密度: `{item['density']}`",
+            "证据（最近10条）:",
+        ]
+        for ev in item['evidence'][:10]:
+            lines.append(
+                f"- `{escape_markdown_v2(str(ev['ts']))}` \| `{escape_markdown_v2(str(ev['ip']))}` \| `{escape_markdown_v2(str(ev['ua']))}`"
+            )
+        quick_kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("➕ 加入白名单", callback_data=f"anomaly_quick_whitelist_{uid}")],
+            [InlineKeyboardButton("✅ 尝试解封", callback_data=f"anomaly_quick_enable_{uid}")],
+        ])
+        await context.bot.send_message(ADMIN_ID, "\n".join(lines), parse_mode='MarkdownV2', reply_markup=quick_kb)
+    except Exception as exc:
+        logger.warning("Failed to notify anomaly admin: %s", exc)
+
 
 async def check_anomalies_job(context: ContextTypes.DEFAULT_TYPE):
     try:
         # 自动解封（中风险限速后，低风险持续一段时间自动恢复）
         auto_hours = int(get_setting_value('risk_auto_unfreeze_hours', '12') or '12')
-        candidates = get_json_setting('risk_unfreeze_candidates', {})
+        candidates = await asyncio.to_thread(get_json_setting, 'risk_unfreeze_candidates', {})
         if isinstance(candidates, dict) and candidates:
             now_ts = int(time.time())
             changed = False
@@ -2991,44 +3873,26 @@ async def check_anomalies_job(context: ContextTypes.DEFAULT_TYPE):
                     if resp and resp.status_code in (200, 201, 204):
                         changed = True
                         candidates.pop(uid, None)
-                        append_ops_timeline('风控', '自动解封', f'uid={uid},after={auto_hours}h', actor='系统', target=uid)
+                        await asyncio.to_thread(append_ops_timeline, '风控', '自动解封', f'uid={uid},after={auto_hours}h', actor='系统', target=uid)
             if changed:
-                set_json_setting('risk_unfreeze_candidates', candidates)
+                await aset_setting_value('risk_unfreeze_candidates', _json_dumps(candidates))
 
-        val_thr = db_query("SELECT value FROM settings WHERE key='anomaly_threshold'", one=True)
-        limit = int(val_thr['value']) if val_thr else 50
+        limit = int(get_setting_value('anomaly_threshold', 50))
         logs = await get_subscription_request_history()
         if not isinstance(logs, list) or not logs:
             return
 
-        val_scan = db_query("SELECT value FROM settings WHERE key='anomaly_last_scan_ts'", one=True)
-        last_scan_ts = int(val_scan['value']) if val_scan else 0
-        whitelist_rows = db_query("SELECT user_uuid FROM anomaly_whitelist")
-        whitelist = {dict(r)['user_uuid'] for r in whitelist_rows}
-
-        def _extract_log_ts(log):
-            for key in ('createdAt', 'requestAt', 'timestamp', 'time'):
-                value = log.get(key)
-                if value is None:
-                    continue
-                if isinstance(value, (int, float)):
-                    return int(value)
-                if isinstance(value, str):
-                    try:
-                        if value.isdigit():
-                            return int(value)
-                        dt = datetime.datetime.strptime(value.split('.')[0].replace('Z', ''), "%Y-%m-%dT%H:%M:%S")
-                        return int(dt.timestamp())
-                    except Exception:
-                        continue
-            return 0
+        last_scan_ts = int(get_setting_value('anomaly_last_scan_ts', 0))
+        whitelist = await get_anomaly_whitelist()
 
+        # 面板接口不支持按时间过滤，也未约定返回顺序；逐条跳过已扫描过的记录，不提前终止
         prepared = []
         for row in logs:
             rec = dict(row)
-            ts = _extract_log_ts(rec)
+            ts = extract_log_ts(rec)
+            if ts and ts <= last_scan_ts:
+                continue
             rec['_ts'] = ts
-            rec['_fmt_time'] = datetime.datetime.utcfromtimestamp(ts).strftime('%m-%d %H:%M') if ts else '-'
             prepared.append(rec)
 
         incidents, max_seen_ts = build_anomaly_incidents(prepared, last_scan_ts, whitelist, limit)
@@ -3037,12 +3901,14 @@ async def check_anomalies_job(context: ContextTypes.DEFAULT_TYPE):
         high_score = int(get_setting_value('risk_high_score', '130'))
         enforce_mode = get_setting_value('risk_enforce_mode', 'enforce')
         watchlist = get_risk_watchlist()
-        unfreeze_candidates = get_json_setting('risk_unfreeze_candidates', {})
+        unfreeze_candidates = await asyncio.to_thread(get_json_setting, 'risk_unfreeze_candidates', {})
         if not isinstance(unfreeze_candidates, dict):
             unfreeze_candidates = {}
         high_risk_disable_uuids = []
         mid_risk_limited_uuids = []
         ip_control_enabled = capability_enabled("ip_control", default=False)
+        event_rows = []
+        incident_tasks = []
 
         for item in incidents:
             uid = item['uid']
@@ -3075,110 +3941,137 @@ async def check_anomalies_job(context: ContextTypes.DEFAULT_TYPE):
                 watchlist.add(uid)
 
             evidence_summary = '; '.join(f"{e['ip']}@{e['ts']}" for e in item['evidence'][:3])
-            db_execute(
-                "INSERT INTO anomaly_events (user_uuid, risk_level, risk_score, ip_count, ua_diversity, density, action_taken, evidence_summary, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (uid, risk_level, score, int(item['ip_count']), int(item['ua_diversity']), int(item['density']), action_taken, evidence_summary[:400], int(time.time())),
-            )
-            append_ops_timeline('风控', '异常处置', f'uid={uid},level={risk_level},action={action_taken},score={score}', actor='系统', target=uid)
-            await sync_user_metadata(uid, tg_id="-", risk_level=risk_level)
+            event_rows.append((uid, risk_level, score, int(item['ip_count']), int(item['ua_diversity']), int(item['density']), action_taken, evidence_summary[:400], int(time.time())))
+            await asyncio.to_thread(append_ops_timeline, '风控', '异常处置', f'uid={uid},level={risk_level},action={action_taken},score={score}', actor='系统', target=uid)
+            incident_tasks.append(_dispatch_anomaly_incident(context, item, risk_level, action_taken, score, ip_control_enabled))
 
-            if ip_control_enabled and risk_level == '高':
-                for ev in item.get('evidence', [])[:3]:
-                    ip = str(ev.get('ip') or '').strip()
-                    if ip and ip not in {"-", "unknown"}:
-                        await block_panel_ip(ip, f"anomaly_high_risk_score_{score}")
-
-            try:
-                lines = [
-                    "🚨 *异常检测（可解释）*",
-                    f"风险等级: `{risk_level}` \| 处置: `{action_taken}`",
-                    f"用户: `{escape_markdown_v2(uid)}`",
-                    f"风险评分: `{score}`",
-                    f"IP数量: `{item['ip_count']}` \| UA分散: `{item['ua_diversity']}` \| 请求密度: `{item['density']}`",
-                    "证据（最近10条）:",
-                ]
-                for ev in item['evidence'][:10]:
-                    lines.append(
-                        f"- `{escape_markdown_v2(str(ev['ts']))}` \| `{escape_markdown_v2(str(ev['ip']))}` \| `{escape_markdown_v2(str(ev['ua']))}`"
-                    )
-                quick_kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("➕ 加入白名单", callback_data=f"anomaly_quick_whitelist_{uid}")],
-                    [InlineKeyboardButton("✅ 尝试解封", callback_data=f"anomaly_quick_enable_{uid}")],
-                ])
-                await context.bot.send_message(ADMIN_ID, "\n".join(lines), parse_mode='MarkdownV2', reply_markup=quick_kb)
-            except Exception as exc:
-                logger.warning("Failed to notify anomaly admin: %s", exc)
+        if event_rows:
+            await adb_execute_batch([(
+                "INSERT INTO anomaly_events (user_uuid, risk_level, risk_score, ip_count, ua_diversity, density, action_taken, evidence_summary, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                event_rows,
+            )])
+        # 各事件的面板同步、封禁 IP 与管理员通知互不依赖，并发执行
+        for result in await asyncio.gather(*incident_tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.warning("anomaly incident dispatch failed: %s", result)
 
         if high_risk_disable_uuids:
             await apply_user_status_bulk_with_fallback(high_risk_disable_uuids, USER_STATUS_DISABLED)
         if mid_risk_limited_uuids:
             await apply_user_status_bulk_with_fallback(mid_risk_limited_uuids, USER_STATUS_LIMITED)
 
-        set_risk_watchlist(watchlist)
-        set_json_setting('risk_unfreeze_candidates', unfreeze_candidates)
-
+        # 观察名单、解封候选与扫描游标合并为一次事务写入
+        scan_state = {
+            'risk_watchlist': dump_risk_watchlist(watchlist),
+            'risk_unfreeze_candidates': _json_dumps(unfreeze_candidates),
+        }
         if max_seen_ts > last_scan_ts:
-            db_execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('anomaly_last_scan_ts', ?)", (str(max_seen_ts),))
+            scan_state['anomaly_last_scan_ts'] = str(max_seen_ts)
+        await aset_setting_values(scan_state)
     except Exception as exc:
         logger.exception("check_anomalies_job failed: %s", exc)
 
+_CALLBACK_EXACT_ROUTES = {
+    "cancel_op": admin_menu_handler,
+    "add_plan_start": add_plan_start,
+    "back_home": client_menu_handler,
+    "contact_support": client_menu_handler,
+    "client_nodes": client_menu_handler,
+}
+_CALLBACK_PREFIX_ROUTES = build_prefix_table({
+    "admin_": admin_menu_handler,
+    "del_plan_": admin_menu_handler,
+    "plan_detail_": admin_menu_handler,
+    "manage_user_": admin_menu_handler,
+    "user_reqhist_": admin_menu_handler,
+    "list_user_subs_": admin_menu_handler,
+    "confirm_del_user_": admin_menu_handler,
+    "reset_traffic_": admin_menu_handler,
+    "set_strategy_": admin_menu_handler,
+    "set_payimg_": admin_menu_handler,
+    "set_pay_usdt_": admin_menu_handler,
+    "toggle_pay_": admin_menu_handler,
+    "reply_user_": admin_menu_handler,
+    "set_anomaly_": admin_menu_handler,
+    "panelcfg_": admin_menu_handler,
+    "anomaly_whitelist_": admin_menu_handler,
+    "anomaly_quick_": admin_menu_handler,
+    "bulk_": admin_menu_handler,
+    "bind_panel_user_": admin_menu_handler,
+    "tpl_": admin_menu_handler,
+    "client_": client_menu_handler,
+    "selrenew_": client_menu_handler,
+    "order_": client_menu_handler,
+    "manualreview_": client_menu_handler,
+    "paymethod_": client_menu_handler,
+    "cancel_order": client_menu_handler,
+    "view_sub_": client_menu_handler,
+    "ap_": process_order,
+    "rj_": process_order,
+    "review_": process_order,
+})
+
+
+async def route_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # 单一入口按 callback_data 查表分发，替代逐个正则匹配的 CallbackQueryHandler
+    handler = resolve_callback_handler(update.callback_query.data or "", _CALLBACK_EXACT_ROUTES, _CALLBACK_PREFIX_ROUTES)
+    if handler is not None:
+        await handler(update, context)
+
+
+def get_anomaly_interval_seconds(default=3600.0):
+    try:
+        interval_sec = float(get_setting_value('anomaly_interval', 1)) * 3600
+    except (TypeError, ValueError) as exc:
+        logger.warning("invalid anomaly_interval setting, using default: %s", exc)
+        return default
+    return interval_sec if interval_sec > 0 else default
+
+
+async def post_init(application):
+    # 在 PTB 实际运行的事件循环内完成启动期任务
+    if panel_config_ready():
+        application.create_task(warmup_panel_runtime_data())
+
+
+async def post_shutdown(application):
+    # 与轮询共用同一事件循环收尾，先排空 HTTP 连接池再关闭共享数据库连接
+    await close_all_clients()
+    await asyncio.to_thread(storage_close_connections)
+
+
 if __name__ == '__main__':
     import urllib3
     urllib3.disable_warnings()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^admin_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^del_plan_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^plan_detail_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^cancel_op$"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^manage_user_")) 
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^user_reqhist_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^list_user_subs_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^confirm_del_user_")) 
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^reset_traffic_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^set_strategy_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^set_payimg_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^set_pay_usdt_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^toggle_pay_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^reply_user_")) 
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^set_anomaly_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^admin_orders_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^admin_order_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^panelcfg_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^anomaly_whitelist_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^anomaly_quick_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^bulk_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^bind_panel_user_"))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^tpl_"))
-    app.add_handler(CallbackQueryHandler(add_plan_start, pattern="^add_plan_start$"))
-    app.add_handler(CallbackQueryHandler(client_menu_handler, pattern="^client_"))
-    app.add_handler(CallbackQueryHandler(client_menu_handler, pattern="^selrenew_"))
-    app.add_handler(CallbackQueryHandler(client_menu_handler, pattern="^order_"))
-    app.add_handler(CallbackQueryHandler(client_menu_handler, pattern="^manualreview_"))
-    app.add_handler(CallbackQueryHandler(client_menu_handler, pattern="^paymethod_"))
-    app.add_handler(CallbackQueryHandler(client_menu_handler, pattern="^cancel_order"))
-    app.add_handler(CallbackQueryHandler(client_menu_handler, pattern="^back_home$"))
-    app.add_handler(CallbackQueryHandler(client_menu_handler, pattern="^contact_support$"))
-    app.add_handler(CallbackQueryHandler(client_menu_handler, pattern="^client_nodes$"))
-    app.add_handler(CallbackQueryHandler(client_menu_handler, pattern="^view_sub_"))
-    app.add_handler(CallbackQueryHandler(process_order, pattern="^(ap|rj|review)_"))
-    app.add_handler(MessageHandler(filters.ALL & (~filters.COMMAND), handle_message))
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:  # uvloop 为可选加速依赖，缺失时使用默认事件循环
+        pass
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .connection_pool_size(64)
+        .pool_timeout(10.0)
+        # 全局约 30 条/秒、单聊 1 条/秒限速，遇到 RetryAfter 自动等待重试
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    app.add_handlers([
+        CommandHandler("start", start),
+        CallbackQueryHandler(route_callback_query),
+        MessageHandler(NOT_COMMAND, handle_message),
+    ])
     app.add_error_handler(telegram_error_handler)
     
     app.job_queue.run_daily(check_expiry_job, time=datetime.time(hour=12, minute=0, second=0))
-    app.job_queue.run_repeating(check_anomalies_job, interval=3600, first=60, name='check_anomalies_job')
+    # 启动时直接按已保存的周期注册一次，避免先建默认任务再重排
+    anomaly_interval_seconds = get_anomaly_interval_seconds()
+    app.job_queue.run_repeating(check_anomalies_job, interval=anomaly_interval_seconds, first=60, name='check_anomalies_job', data={'interval': anomaly_interval_seconds})
     
-    try:
-        val_int = db_query("SELECT value FROM settings WHERE key='anomaly_interval'", one=True)
-        if val_int:
-            interval_sec = float(val_int['value']) * 3600
-            if interval_sec > 0:
-                loop = asyncio.get_event_loop()
-                loop.create_task(reschedule_anomaly_job(app, val_int['value']))
-        if panel_config_ready():
-            asyncio.get_event_loop().create_task(warmup_panel_runtime_data())
-    except Exception as exc:
-        logger.warning("Failed to reschedule anomaly job at startup: %s", exc)
-
-    print(f"🚀 RemnaShop-Pro {APP_VERSION} 已启动 | 监听中...")
-    app.run_polling()
+    logger.info("🚀 RemnaShop-Pro %s 已启动 | 监听中...", APP_VERSION)
+    # 只订阅实际处理的更新类型，其余类型由 Telegram 服务端直接过滤
+    app.run_polling(allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY])
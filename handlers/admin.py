@@ -1,4 +1,8 @@
 import datetime
+import re
+import sqlite3
+
+from utils.formatting import format_minute
 
 STATUS_CN = {
     'pending': '待审核',
@@ -55,18 +59,36 @@ def action_label(action: str) -> str:
     return ACTION_CN.get(action, action)
 
 
-def format_order_row(item: dict) -> str:
-    ts = datetime.datetime.fromtimestamp(int(item['created_at'])).strftime('%m-%d %H:%M')
-    status = order_status_label(item.get('status', ''))
-    icon = {
-        '待审核': '🟡',
-        '已发货': '✅',
-        '失败': '❌',
-        '已拒绝': '⛔',
-    }.get(status, '📄')
+STATUS_ICON = {
+    'pending': '🟡',
+    'delivered': '✅',
+    'failed': '❌',
+    'rejected': '⛔',
+}
+
+
+# admin_orders_page_{status}_{page}[_{n|p}_{created_at}_{id}]，旧按钮只有前两段
+ORDERS_PAGE_RE = re.compile(
+    r"admin_orders_page_(?P<status>[a-z_]+)_(?P<page>\d+)(?:_(?P<direction>[np])_(?P<ts>\d+)_(?P<id>\d+))?$"
+)
+
+
+def parse_orders_page_callback(data: str):
+    m = ORDERS_PAGE_RE.match(data)
+    if not m:
+        return None, 0, None
+    status = None if m['status'] == 'all' else m['status']
+    cursor = (m['direction'], int(m['ts']), int(m['id'])) if m['direction'] else None
+    return status, int(m['page']), cursor
+
+
+def format_order_row(item: "sqlite3.Row | dict") -> str:
+    # 只用下标取值，sqlite3.Row 可直接传入，无需先转成 dict
+    ts = format_minute(item['created_at'])
+    status = item['status'] or ''
     return (
-        f"{icon} {status} | {item['order_id']} | {item['tg_id']} | "
-        f"{item.get('plan_key')}/{item.get('order_type')} | {ts}"
+        f"{STATUS_ICON.get(status, '📄')} {order_status_label(status)} | {item['order_id']} | {item['tg_id']} | "
+        f"{item['plan_key']}/{item['order_type']} | {ts}"
     )
 
 
@@ -74,7 +96,7 @@ def format_order_detail(item: dict, logs: list[dict]) -> str:
     created = datetime.datetime.fromtimestamp(int(item['created_at'])).strftime('%Y-%m-%d %H:%M')
     log_lines = []
     for it in logs:
-        ts = datetime.datetime.fromtimestamp(int(it['created_at'])).strftime('%m-%d %H:%M')
+        ts = format_minute(it['created_at'])
         action = action_label(it.get('action', ''))
         detail = _translate_reason_detail(str(it.get('detail', '')))
         log_lines.append(f"- {ts} | {action} | {detail[:40]}")
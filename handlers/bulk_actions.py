@@ -3,10 +3,11 @@ import re
 from typing import Iterable
 
 UUID_RE = re.compile(r"^[0-9a-fA-F-]{32,36}$")
+UUID_SEPARATOR_RE = re.compile(r"[\s,;]+")
 
 
 def parse_uuids(text: str) -> list[str]:
-    raw = re.split(r"[\s,;]+", (text or "").strip())
+    raw = UUID_SEPARATOR_RE.split((text or "").strip())
     uuids = []
     seen = set()
     for item in raw:
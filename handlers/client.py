@@ -1,17 +1,21 @@
 import datetime
 
+_ONLINE_STATUSES = frozenset({'connected', 'healthy', 'online', 'active', 'true'})
+_ONLINE_LINE = "🟢 **{}** | 在线"
+_OFFLINE_LINE = "🔴 **{}** | 离线"
+
+
+def is_node_online(node: dict) -> bool:
+    return str(node.get('status', '')).lower() in _ONLINE_STATUSES or node.get('isConnected') is True
+
 
 def build_nodes_status_message(nodes: list[dict]) -> str:
     msg_list = ["🌍 **节点状态**\n"]
     if not nodes:
         msg_list.append("⚠️ 暂无节点信息")
     else:
+        append = msg_list.append
         for node in nodes:
-            name = node.get('name', '未知节点')
-            status_raw = str(node.get('status', '')).lower()
-            is_online = status_raw in ['connected', 'healthy', 'online', 'active', 'true'] or node.get('isConnected') is True
-            icon = "🟢" if is_online else "🔴"
-            stat_text = "在线" if is_online else "离线"
-            msg_list.append(f"{icon} **{name}** | {stat_text}")
+            append((_ONLINE_LINE if is_node_online(node) else _OFFLINE_LINE).format(node.get('name', '未知节点')))
     msg_list.append(f"\n_更新时间: {datetime.datetime.now().strftime('%H:%M:%S')}_")
     return "\n".join(msg_list)
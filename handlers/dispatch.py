@@ -0,0 +1,57 @@
+import re
+from typing import Any, Callable, Mapping, NamedTuple
+
+from telegram import Message, MessageEntity
+from telegram.ext import filters
+
+
+class PrefixTable(NamedTuple):
+    pattern: re.Pattern
+    handlers: dict[str, Callable[..., Any]]
+
+
+def build_prefix_table(prefix_handlers: Mapping[str, Callable[..., Any]]) -> PrefixTable:
+    # 最长前缀优先，避免 admin_squad_ 抢先匹配 admin_squad_suggest_
+    prefixes = sorted(prefix_handlers, key=len, reverse=True)
+    # 所有前缀编译成一个交替正则，每次分发只做一次 match
+    pattern = re.compile("|".join(map(re.escape, prefixes)) if prefixes else r"(?!)")
+    return PrefixTable(pattern, dict(prefix_handlers))
+
+
+def resolve_callback_handler(data: str, exact_handlers: Mapping[str, Callable[..., Any]], prefix_table: PrefixTable):
+    handler = exact_handlers.get(data)
+    if handler is not None:
+        return handler
+    match = prefix_table.pattern.match(data)
+    return prefix_table.handlers[match.group(0)] if match else None
+
+
+class MessageState(NamedTuple):
+    key: str
+    handler: Callable[..., Any]
+    needs_text: bool = True
+    # True 时只要键存在即命中（值可能为 0 或空），否则要求值为真
+    by_presence: bool = False
+
+
+def resolve_message_state(user_data: Mapping[str, Any], has_text: bool, states: tuple[MessageState, ...]):
+    # 输入态标记由各回调独立设置，可能同时存在多个，按表中顺序取第一个命中的
+    for state in states:
+        if state.needs_text and not has_text:
+            continue
+        if (state.key in user_data) if state.by_presence else user_data.get(state.key):
+            return state.handler
+    return None
+
+
+class NotCommandFilter(filters.MessageFilter):
+    """等价于 filters.ALL & ~filters.COMMAND，但只做一次判断。"""
+
+    __slots__ = ()
+
+    def filter(self, message: Message) -> bool:
+        entities = message.entities
+        return not (entities and entities[0].type == MessageEntity.BOT_COMMAND and entities[0].offset == 0)
+
+
+NOT_COMMAND = NotCommandFilter(name="NotCommand")
@@ -1,10 +1,44 @@
-from collections import defaultdict
+import datetime
+from collections import Counter, defaultdict
+
+EVIDENCE_ROWS_PER_USER = 10
+DENSITY_CAP = 20
+_LOG_TS_KEYS = ('createdAt', 'requestAt', 'timestamp', 'time')
+
+
+def extract_log_ts(log):
+    for key in _LOG_TS_KEYS:
+        value = log.get(key)
+        if value is None:
+            continue
+        if isinstance(value, (int, float)):
+            return int(value)
+        if isinstance(value, str):
+            if value.isdigit():
+                return int(value)
+            try:
+                # 与旧的 strptime 解析保持一致：去掉毫秒与 Z 后按本地时间解析
+                return int(datetime.datetime.fromisoformat(value.split('.', 1)[0].removesuffix('Z')).timestamp())
+            except ValueError:
+                continue
+    return 0
+
+
+def _format_evidence_ts(row):
+    fmt = row.get('_fmt_time')
+    if fmt:
+        return fmt
+    ts = int(row.get('_ts', 0) or 0)
+    if ts:
+        return datetime.datetime.utcfromtimestamp(ts).strftime('%m-%d %H:%M')
+    return row.get('requestAt') or row.get('createdAt') or '-'
 
 
 def build_anomaly_incidents(logs, last_scan_ts, whitelist, ip_threshold):
     user_ip_map = defaultdict(set)
     user_ua_map = defaultdict(set)
-    user_logs = defaultdict(list)
+    user_log_counts = Counter()
+    user_evidence_rows = defaultdict(list)
     max_seen_ts = last_scan_ts
 
     for item in logs:
@@ -22,20 +56,24 @@ def build_anomaly_incidents(logs, last_scan_ts, whitelist, ip_threshold):
         user_ip_map[uid].add(ip)
         if ua:
             user_ua_map[uid].add(ua[:120])
-        user_logs[uid].append(item)
+        user_log_counts[uid] += 1
+        # 只保留证据所需的前几行，避免为每个用户缓存全部日志
+        evidence_rows = user_evidence_rows[uid]
+        if len(evidence_rows) < EVIDENCE_ROWS_PER_USER:
+            evidence_rows.append(item)
 
     incidents = []
     for uid, ips in user_ip_map.items():
         ip_count = len(ips)
-        ua_diversity = len(user_ua_map.get(uid, set()))
-        density = min(len(user_logs.get(uid, [])), 20)
+        ua_diversity = len(user_ua_map.get(uid, ()))
+        density = min(user_log_counts[uid], DENSITY_CAP)
         score = ip_count * 2 + ua_diversity + density // 3
         if ip_count <= ip_threshold and score < (ip_threshold * 2):
             continue
         evidence = []
-        for row in user_logs.get(uid, [])[:10]:
+        for row in user_evidence_rows[uid]:
             evidence.append({
-                "ts": row.get('_fmt_time') or row.get('requestAt') or row.get('createdAt') or '-',
+                "ts": _format_evidence_ts(row),
                 "ip": row.get('ip') or row.get('requestIp') or '-',
                 "ua": (row.get('userAgent') or '-')[:40],
             })
@@ -11,6 +11,10 @@ def parse_expire_datetime(iso_str: str):
     if not iso_str:
         return None
     try:
-        return datetime.datetime.strptime(iso_str.split('.')[0].replace('Z', ''), "%Y-%m-%dT%H:%M:%S")
-    except Exception:
+        dt = datetime.datetime.fromisoformat(iso_str)
+    except (TypeError, ValueError):
         return None
+    if dt.tzinfo is not None:
+        # 统一转换为 naive UTC，便于与 utcnow() 比较
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt
@@ -1,4 +1,5 @@
 import asyncio
+import importlib.util
 import logging
 from typing import Any, Optional
 
@@ -8,6 +9,10 @@ logger = logging.getLogger(__name__)
 
 _RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
 _CLIENTS: dict[bool, httpx.AsyncClient] = {}
+# 装了 h2 时对 HTTPS 面板启用 HTTP/2 多路复用，否则保持 HTTP/1.1 长连接
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+PANEL_MAX_CONNECTIONS = 64
+PANEL_MAX_KEEPALIVE_CONNECTIONS = 32
 
 IP_CONTROL_ENDPOINT_SPECS: tuple[tuple[str, str], ...] = (
     ('POST', '/ip-control/drop-connections'),
@@ -19,7 +24,15 @@ IP_CONTROL_ENDPOINT_SPECS: tuple[tuple[str, str], ...] = (
 def _get_client(verify_tls: bool) -> httpx.AsyncClient:
     client = _CLIENTS.get(verify_tls)
     if client is None or client.is_closed:
-        client = httpx.AsyncClient(timeout=20.0, verify=verify_tls)
+        client = httpx.AsyncClient(
+            timeout=20.0,
+            verify=verify_tls,
+            http2=_HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=PANEL_MAX_CONNECTIONS,
+                max_keepalive_connections=PANEL_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+        )
         _CLIENTS[verify_tls] = client
     return client
 
@@ -104,6 +117,24 @@ async def get_panel_user(uuid, panel_url, headers, verify_tls=True):
     return None
 
 
+async def get_all_panel_users(panel_url, headers, verify_tls=True, page_size=500):
+    users: list[dict] = []
+    start = 0
+    while True:
+        resp = await safe_api_request('GET', '/users', panel_url, headers, verify_tls, params={"start": start, "size": page_size})
+        if not resp or resp.status_code != 200:
+            return None
+        payload = extract_payload(resp)
+        page = payload.get('users') if isinstance(payload, dict) else None
+        if not isinstance(page, list):
+            return None
+        users.extend(u for u in page if isinstance(u, dict))
+        start += len(page)
+        total = payload.get('total')
+        if not page or len(page) < page_size or (isinstance(total, (int, float)) and start >= total):
+            return users
+
+
 async def get_user_by_telegram_id(telegram_id, panel_url, headers, verify_tls=True):
     resp = await safe_api_request('GET', f"/users/by-telegram-id/{telegram_id}", panel_url, headers, verify_tls)
     if resp and resp.status_code == 200:
@@ -1,15 +1,39 @@
 import sqlite3
+import threading
 from typing import Any, Iterable
 
+_SHARED_CONNECTIONS: dict[str, sqlite3.Connection] = {}
+_SHARED_LOCK = threading.RLock()
 
-def _connect(db_file: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_file)
+
+def _connect(db_file: str, shared: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_file, check_same_thread=not shared, cached_statements=256)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL")
     conn.execute("PRAGMA busy_timeout=5000")
+    if shared:
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # 常驻连接的页缓存跨查询保留，放大到约 20MB（负数单位为 KiB）
+        conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+
+def _shared_connection(db_file: str) -> sqlite3.Connection:
+    # 调用方需持有 _SHARED_LOCK；连接常驻，复用 sqlite3 自带的语句缓存
+    conn = _SHARED_CONNECTIONS.get(db_file)
+    if conn is None:
+        conn = _connect(db_file, shared=True)
+        _SHARED_CONNECTIONS[db_file] = conn
     return conn
 
 
+def close_connections() -> None:
+    with _SHARED_LOCK:
+        for conn in _SHARED_CONNECTIONS.values():
+            conn.close()
+        _SHARED_CONNECTIONS.clear()
+
+
 def init_db(db_file: str) -> None:
     conn = _connect(db_file)
     c = conn.cursor()
@@ -34,6 +58,11 @@ def init_db(db_file: str) -> None:
         c.execute("ALTER TABLE subscriptions ADD COLUMN last_notify_at INTEGER")
     except sqlite3.OperationalError:
         pass
+    for column in ("cached_limit INTEGER", "cached_used INTEGER", "cached_at INTEGER"):
+        try:
+            c.execute(f"ALTER TABLE subscriptions ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            pass
     try:
         c.execute("ALTER TABLE plans ADD COLUMN reset_strategy TEXT DEFAULT 'NO_RESET'")
     except sqlite3.OperationalError:
@@ -118,13 +147,46 @@ def init_db(db_file: str) -> None:
         created_at INTEGER NOT NULL
     )''')
 
+    # 用户列表只看每个 tg_id 最近一次开通时间，由触发器维护汇总表，避免每次全表 GROUP BY
+    c.execute('''CREATE TABLE IF NOT EXISTS user_last_seen (
+        tg_id INTEGER PRIMARY KEY,
+        created_at INTEGER NOT NULL
+    )''')
+    # 旧库 subscriptions.created_at 允许为 NULL，汇总表统一按 0 记录；先删后建以便旧库拿到新版触发器
+    c.execute("DROP TRIGGER IF EXISTS trg_subscriptions_last_seen_insert")
+    c.execute("DROP TRIGGER IF EXISTS trg_subscriptions_last_seen_delete")
+    c.execute('''CREATE TRIGGER trg_subscriptions_last_seen_insert
+        AFTER INSERT ON subscriptions WHEN NEW.tg_id IS NOT NULL
+        BEGIN
+            INSERT INTO user_last_seen (tg_id, created_at) VALUES (NEW.tg_id, COALESCE(NEW.created_at, 0))
+            ON CONFLICT(tg_id) DO UPDATE SET created_at = MAX(created_at, excluded.created_at);
+        END''')
+    c.execute('''CREATE TRIGGER trg_subscriptions_last_seen_delete
+        AFTER DELETE ON subscriptions WHEN OLD.tg_id IS NOT NULL
+        BEGIN
+            DELETE FROM user_last_seen WHERE tg_id = OLD.tg_id;
+            INSERT INTO user_last_seen (tg_id, created_at)
+            SELECT tg_id, COALESCE(MAX(created_at), 0) FROM subscriptions WHERE tg_id = OLD.tg_id GROUP BY tg_id;
+        END''')
+    # 启动时按 subscriptions 重建一次，兼容旧库和触发器建立前写入的数据
+    c.execute("DELETE FROM user_last_seen")
+    c.execute(
+        "INSERT INTO user_last_seen (tg_id, created_at) "
+        "SELECT tg_id, COALESCE(MAX(created_at), 0) FROM subscriptions WHERE tg_id IS NOT NULL GROUP BY tg_id"
+    )
+
     c.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_tg_id ON subscriptions (tg_id)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_uuid ON subscriptions (uuid)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_tg_created ON subscriptions (tg_id, created_at DESC)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_orders_tg_id_status ON orders (tg_id, status)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_orders_order_id ON orders (order_id)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at DESC)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_order_audit_order_id ON order_audit_logs (order_id, created_at DESC)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_anomaly_events_user_created ON anomaly_events (user_uuid, created_at DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_audit_created ON order_audit_logs (created_at DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_anomaly_events_created ON anomaly_events (created_at DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_last_seen_created ON user_last_seen (created_at DESC)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_bulk_jobs_status_created ON bulk_jobs (status, created_at DESC)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_ops_templates_created ON ops_templates (created_at DESC)")
 
@@ -147,19 +209,26 @@ def init_db(db_file: str) -> None:
 
 
 def db_query(db_file: str, query: str, args: Iterable[Any] = (), one: bool = False):
-    conn = _connect(db_file)
-    cur = conn.cursor()
-    cur.execute(query, tuple(args))
-    rv = cur.fetchall()
-    conn.close()
+    with _SHARED_LOCK:
+        cur = _shared_connection(db_file).execute(query, tuple(args))
+        rv = cur.fetchall()
     return (rv[0] if rv else None) if one else rv
 
 
 def db_execute(db_file: str, query: str, args: Iterable[Any] = ()) -> int:
-    conn = _connect(db_file)
-    cur = conn.cursor()
-    cur.execute(query, tuple(args))
-    conn.commit()
-    changed = cur.rowcount
-    conn.close()
+    with _SHARED_LOCK:
+        conn = _shared_connection(db_file)
+        with conn:
+            cur = conn.execute(query, tuple(args))
+        return cur.rowcount
+
+
+def db_execute_batch(db_file: str, statements: Iterable[tuple[str, Iterable[Iterable[Any]]]]) -> int:
+    changed = 0
+    with _SHARED_LOCK:
+        conn = _shared_connection(db_file)
+        with conn:
+            for query, rows in statements:
+                cur = conn.executemany(query, [tuple(r) for r in rows])
+                changed += cur.rowcount
     return changed
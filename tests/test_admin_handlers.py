@@ -0,0 +1,32 @@
+import datetime
+import sqlite3
+import unittest
+
+from handlers.admin import format_order_row, parse_orders_page_callback
+
+
+class TestAdminHandlers(unittest.TestCase):
+    def test_format_order_row_accepts_sqlite_row_and_dict(self):
+        conn = sqlite3.connect(":memory:")
+        conn.row_factory = sqlite3.Row
+        row = conn.execute(
+            "SELECT 'o1' AS order_id, 42 AS tg_id, 'p1' AS plan_key, 'new' AS order_type, 'pending' AS status, 0 AS created_at"
+        ).fetchone()
+        conn.close()
+        ts = datetime.datetime.fromtimestamp(0).strftime('%m-%d %H:%M')
+        self.assertEqual(format_order_row(row), f"🟡 待审核 | o1 | 42 | p1/new | {ts}")
+        self.assertEqual(format_order_row(dict(row)), format_order_row(row))
+
+    def test_format_order_row_unknown_status(self):
+        item = {'order_id': 'o2', 'tg_id': 1, 'plan_key': 'p2', 'order_type': 'renew', 'status': 'approved', 'created_at': 0}
+        self.assertTrue(format_order_row(item).startswith("📄 已通过(处理中) | o2"))
+
+    def test_parse_orders_page_callback(self):
+        self.assertEqual(parse_orders_page_callback("admin_orders_page_all_2_n_1700000000_15"), (None, 2, ("n", 1700000000, 15)))
+        self.assertEqual(parse_orders_page_callback("admin_orders_page_pending_1_p_5_3"), ("pending", 1, ("p", 5, 3)))
+        self.assertEqual(parse_orders_page_callback("admin_orders_page_failed_3"), ("failed", 3, None))
+        self.assertEqual(parse_orders_page_callback("admin_orders_page_bad"), (None, 0, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
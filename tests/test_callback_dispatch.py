@@ -0,0 +1,70 @@
+import unittest
+
+import datetime
+
+from telegram import Chat, Message, MessageEntity, Update
+from telegram.ext import filters
+
+from handlers.dispatch import NOT_COMMAND, MessageState, build_prefix_table, resolve_callback_handler, resolve_message_state
+
+
+class TestCallbackDispatch(unittest.TestCase):
+    def setUp(self):
+        self.exact = {"admin_squad_bulk_move": "bulk_move", "client_orders": "orders"}
+        self.prefixes = build_prefix_table({
+            "admin_squad_": "squad",
+            "admin_squad_suggest_": "suggest",
+            "client_order_": "order",
+            "client_order_cancel_": "cancel",
+        })
+
+    def test_exact_match_wins_over_prefix(self):
+        self.assertEqual(resolve_callback_handler("admin_squad_bulk_move", self.exact, self.prefixes), "bulk_move")
+        self.assertEqual(resolve_callback_handler("client_orders", self.exact, self.prefixes), "orders")
+
+    def test_longest_prefix_wins(self):
+        self.assertEqual(resolve_callback_handler("admin_squad_suggest_a__b__3", self.exact, self.prefixes), "suggest")
+        self.assertEqual(resolve_callback_handler("admin_squad_abc", self.exact, self.prefixes), "squad")
+        self.assertEqual(resolve_callback_handler("client_order_cancel_x1", self.exact, self.prefixes), "cancel")
+        self.assertEqual(resolve_callback_handler("client_order_x1", self.exact, self.prefixes), "order")
+
+    def test_unknown_callback_returns_none(self):
+        self.assertIsNone(resolve_callback_handler("unknown_cb", self.exact, self.prefixes))
+        self.assertIsNone(resolve_callback_handler("x_admin_squad_", self.exact, self.prefixes))
+        self.assertIsNone(resolve_callback_handler("anything", {}, build_prefix_table({})))
+
+    def test_prefix_with_regex_metacharacters_is_literal(self):
+        table = build_prefix_table({"a.b_": "dot", "a+": "plus"})
+        self.assertEqual(resolve_callback_handler("a.b_1", {}, table), "dot")
+        self.assertIsNone(resolve_callback_handler("axb_1", {}, table))
+        self.assertEqual(resolve_callback_handler("a+1", {}, table), "plus")
+
+    def test_resolve_message_state_respects_order_and_text(self):
+        states = (
+            MessageState('set_payimg', 'payimg', needs_text=False),
+            MessageState('reply_to_uid', 'reply', needs_text=False, by_presence=True),
+            MessageState('setting_notify', 'notify'),
+        )
+        self.assertEqual(resolve_message_state({'setting_notify': True, 'set_payimg': 'usdt'}, True, states), 'payimg')
+        self.assertEqual(resolve_message_state({'reply_to_uid': 0}, False, states), 'reply')
+        self.assertEqual(resolve_message_state({'setting_notify': True}, True, states), 'notify')
+        self.assertIsNone(resolve_message_state({'setting_notify': True}, False, states))
+        self.assertIsNone(resolve_message_state({'setting_notify': False}, True, states))
+
+    def test_not_command_filter_matches_builtin_filters(self):
+        chat = Chat(id=1, type=Chat.PRIVATE)
+        date = datetime.datetime(2024, 1, 1)
+        samples = [
+            Message(1, date, chat, text="hello"),
+            Message(2, date, chat, text="/start", entities=[MessageEntity(MessageEntity.BOT_COMMAND, 0, 6)]),
+            Message(3, date, chat, text="hi /start", entities=[MessageEntity(MessageEntity.BOT_COMMAND, 3, 6)]),
+            Message(4, date, chat),
+        ]
+        builtin = filters.ALL & (~filters.COMMAND)
+        for message in samples:
+            update = Update(message.message_id, message=message)
+            self.assertEqual(bool(NOT_COMMAND.check_update(update)), bool(builtin.check_update(update)), message.text)
+
+
+if __name__ == "__main__":
+    unittest.main()
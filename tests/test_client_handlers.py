@@ -0,0 +1,22 @@
+import unittest
+
+from handlers.client import build_nodes_status_message, is_node_online
+
+
+class TestClientHandlers(unittest.TestCase):
+    def test_is_node_online(self):
+        self.assertTrue(is_node_online({"status": "Connected"}))
+        self.assertTrue(is_node_online({"status": "", "isConnected": True}))
+        self.assertFalse(is_node_online({"status": "disabled", "isConnected": "true"}))
+        self.assertFalse(is_node_online({}))
+
+    def test_build_nodes_status_message(self):
+        msg = build_nodes_status_message([{"name": "hk", "status": "online"}, {"status": "down"}])
+        lines = msg.split("\n")
+        self.assertEqual(lines[2], "🟢 **hk** | 在线")
+        self.assertEqual(lines[3], "🔴 **未知节点** | 离线")
+        self.assertIn("⚠️ 暂无节点信息", build_nodes_status_message([]))
+
+
+if __name__ == "__main__":
+    unittest.main()
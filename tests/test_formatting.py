@@ -0,0 +1,23 @@
+import datetime
+import unittest
+
+from utils.formatting import escape_markdown_v2, format_minute
+
+
+class TestFormatting(unittest.TestCase):
+    def test_escape_markdown_v2_escapes_every_special(self):
+        self.assertEqual(escape_markdown_v2("a_b*c[d](e)~`>#+-=|{}.!"), r"a\_b\*c\[d\]\(e\)\~\`\>\#\+\-\=\|\{\}\.\!")
+
+    def test_escape_markdown_v2_handles_none_and_non_str(self):
+        self.assertEqual(escape_markdown_v2(None), "")
+        self.assertEqual(escape_markdown_v2(1.5), r"1\.5")
+
+    def test_format_minute_matches_strftime(self):
+        ts = 1714566645
+        expected = datetime.datetime.fromtimestamp(ts).strftime('%m-%d %H:%M')
+        self.assertEqual(format_minute(ts), expected)
+        self.assertEqual(format_minute(str(ts)), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
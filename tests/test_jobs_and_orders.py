@@ -1,8 +1,9 @@
+import datetime
 import unittest
 import sqlite3
 
-from jobs.anomaly import build_anomaly_incidents
-from jobs.expiry import should_send_expire_notice
+from jobs.anomaly import build_anomaly_incidents, extract_log_ts
+from jobs.expiry import parse_expire_datetime, should_send_expire_notice
 from services.orders import STATUS_PENDING, classify_order_failure, create_order
 
 
@@ -51,6 +52,14 @@ class TestJobsAndOrders(unittest.TestCase):
         self.assertFalse(should_send_expire_notice(190, 200, cool_down_seconds=20))
         self.assertTrue(should_send_expire_notice(100, 200, cool_down_seconds=20))
 
+    def test_parse_expire_datetime(self):
+        expected = datetime.datetime(2024, 5, 1, 12, 30, 0, 123000)
+        self.assertEqual(parse_expire_datetime("2024-05-01T12:30:00.123Z"), expected)
+        self.assertEqual(parse_expire_datetime("2024-05-01T20:30:00.123+08:00"), expected)
+        self.assertEqual(parse_expire_datetime("2024-05-01T12:30:00"), expected.replace(microsecond=0))
+        self.assertIsNone(parse_expire_datetime("bad"))
+        self.assertIsNone(parse_expire_datetime(""))
+
     def test_build_anomaly_incidents(self):
         logs = [
             {"_ts": 101, "userUuid": "u1", "requestIp": "1.1.1.1", "userAgent": "a", "_fmt_time": "t1"},
@@ -61,6 +70,24 @@ class TestJobsAndOrders(unittest.TestCase):
         self.assertEqual(max_ts, 103)
         self.assertTrue(any(item["uid"] == "u1" for item in incidents))
 
+    def test_build_anomaly_incidents_caps_evidence_and_formats_ts(self):
+        logs = [
+            {"_ts": 1000 + i, "userUuid": "u1", "requestIp": f"10.0.0.{i}", "userAgent": "ua"}
+            for i in range(30)
+        ]
+        incidents, _ = build_anomaly_incidents(logs, last_scan_ts=0, whitelist=set(), ip_threshold=1)
+        self.assertEqual(len(incidents), 1)
+        self.assertEqual(incidents[0]["density"], 20)
+        self.assertEqual(len(incidents[0]["evidence"]), 10)
+        self.assertEqual(incidents[0]["evidence"][0]["ts"], "01-01 00:16")
+
+    def test_extract_log_ts(self):
+        expected = int(datetime.datetime(2024, 5, 1, 12, 30, 0).timestamp())
+        self.assertEqual(extract_log_ts({"createdAt": "2024-05-01T12:30:00.123Z"}), expected)
+        self.assertEqual(extract_log_ts({"requestAt": "1714566600"}), 1714566600)
+        self.assertEqual(extract_log_ts({"createdAt": "bad", "timestamp": 42.9}), 42)
+        self.assertEqual(extract_log_ts({}), 0)
+
     def test_classify_order_failure(self):
         self.assertEqual(classify_order_failure("timeout from api"), "network")
         self.assertEqual(classify_order_failure("sqlite constraint failed"), "database")
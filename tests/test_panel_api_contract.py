@@ -47,6 +47,22 @@ class TestPanelApiMetadataContract(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(captured["json_data"], {"metadata": {"k": "v"}})
         self.assertNotIn("userUuid", captured["json_data"])
 
+    async def test_get_all_panel_users_paginates_with_start_and_size(self):
+        calls = []
+        pages = {0: [{"uuid": "a"}, {"uuid": "b"}], 2: [{"uuid": "c"}]}
+
+        async def fake_request(method, endpoint, panel_url, headers, verify_tls=True, json_data=None, params=None):
+            calls.append((method, endpoint, dict(params or {})))
+            resp = _Resp(200)
+            resp.json = lambda: {"response": {"users": pages.get(params["start"], []), "total": 3}}
+            return resp
+
+        with patch("services.panel_api.safe_api_request", new=fake_request):
+            users = await panel_api.get_all_panel_users("https://panel.example/api", {}, True, page_size=2)
+
+        self.assertEqual([u["uuid"] for u in users], ["a", "b", "c"])
+        self.assertEqual(calls, [("GET", "/users", {"start": 0, "size": 2}), ("GET", "/users", {"start": 2, "size": 2})])
+
     def test_bot_sync_user_metadata_has_failed_response_logging_branch(self):
         source = Path("bot.py").read_text(encoding="utf-8")
         self.assertIn("resp.status_code >= 400", source)
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from storage.db import close_connections, db_execute_batch, db_query, init_db
+
+
+class TestStorageDb(unittest.TestCase):
+    def setUp(self):
+        fd, self.db_file = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        init_db(self.db_file)
+
+    def tearDown(self):
+        close_connections()
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.db_file + suffix)
+            except FileNotFoundError:
+                pass
+
+    def test_db_execute_batch_applies_all_statements(self):
+        db_execute_batch(self.db_file, [
+            ("INSERT INTO subscriptions (tg_id, uuid, created_at) VALUES (?, ?, ?)", [(1, "u1", 0), (1, "u2", 0), (2, "u3", 0)]),
+            ("UPDATE subscriptions SET last_notify_days_left = ? WHERE uuid = ?", [(3, "u1")]),
+            ("DELETE FROM subscriptions WHERE uuid = ?", [("u2",)]),
+        ])
+        rows = db_query(self.db_file, "SELECT uuid, last_notify_days_left FROM subscriptions ORDER BY uuid")
+        self.assertEqual([(r["uuid"], r["last_notify_days_left"]) for r in rows], [("u1", 3), ("u3", None)])
+
+    def test_db_query_reuses_shared_connection(self):
+        db_query(self.db_file, "SELECT 1")
+        with patch("storage.db._connect", side_effect=AssertionError("reconnected")):
+            self.assertEqual(db_query(self.db_file, "SELECT COUNT(*) AS c FROM plans", one=True)["c"], 2)
+
+    def test_shared_connection_uses_enlarged_page_cache(self):
+        self.assertEqual(db_query(self.db_file, "PRAGMA cache_size", one=True)[0], -20000)
+
+    def test_db_execute_batch_rolls_back_on_error(self):
+        with self.assertRaises(Exception):
+            db_execute_batch(self.db_file, [
+                ("INSERT INTO subscriptions (tg_id, uuid, created_at) VALUES (?, ?, ?)", [(1, "u1", 0)]),
+                ("UPDATE missing_table SET x = ?", [(1,)]),
+            ])
+        self.assertEqual(db_query(self.db_file, "SELECT COUNT(*) AS c FROM subscriptions", one=True)["c"], 0)
+
+    def test_user_last_seen_tracks_latest_subscription(self):
+        db_execute_batch(self.db_file, [
+            ("INSERT INTO subscriptions (tg_id, uuid, created_at) VALUES (?, ?, ?)", [(1, "u1", 10), (1, "u2", 30), (2, "u3", 20)]),
+        ])
+        rows = db_query(self.db_file, "SELECT tg_id, created_at FROM user_last_seen ORDER BY created_at DESC")
+        self.assertEqual([(r["tg_id"], r["created_at"]) for r in rows], [(1, 30), (2, 20)])
+
+        db_execute_batch(self.db_file, [("DELETE FROM subscriptions WHERE uuid = ?", [("u2",), ("u3",)])])
+        rows = db_query(self.db_file, "SELECT tg_id, created_at FROM user_last_seen")
+        self.assertEqual([(r["tg_id"], r["created_at"]) for r in rows], [(1, 10)])
+
+    def test_user_last_seen_accepts_null_created_at(self):
+        db_execute_batch(self.db_file, [
+            ("INSERT INTO subscriptions (tg_id, uuid) VALUES (?, ?)", [(1, "u1"), (2, "u2")]),
+            ("INSERT INTO subscriptions (tg_id, uuid, created_at) VALUES (?, ?, ?)", [(2, "u3", 20)]),
+        ])
+        db_execute_batch(self.db_file, [("DELETE FROM subscriptions WHERE uuid = ?", [("u3",)])])
+        close_connections()
+        init_db(self.db_file)
+        rows = db_query(self.db_file, "SELECT tg_id, created_at FROM user_last_seen ORDER BY tg_id")
+        self.assertEqual([(r["tg_id"], r["created_at"]) for r in rows], [(1, 0), (2, 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,21 @@
-import re
+import datetime
+import functools
 
 MDV2_SPECIALS = r"_*[]()~`>#+-=|{}.!"
+_MDV2_ESCAPE_TABLE = str.maketrans({c: "\\" + c for c in MDV2_SPECIALS})
 
 
 def escape_markdown_v2(text):
     if text is None:
         return ""
-    pattern = f"([{re.escape(MDV2_SPECIALS)}])"
-    return re.sub(pattern, r"\\\1", str(text))
+    return str(text).translate(_MDV2_ESCAPE_TABLE)
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_minute(ts_min: int) -> str:
+    return datetime.datetime.fromtimestamp(ts_min * 60).strftime('%m-%d %H:%M')
+
+
+def format_minute(ts) -> str:
+    # 只精确到分钟，同一分钟内的时间戳共用一次格式化结果
+    return _format_minute(int(ts) // 60)